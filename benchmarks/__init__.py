@@ -0,0 +1 @@
+#This package benchmarks launch control against a simulated fleet; a moto server for EC2/STS and one local sshd standing in for every instance
@@ -0,0 +1,101 @@
+#This module is the benchmark entry point, `python -m benchmarks`
+import json
+import os
+import sys
+
+import click
+
+from benchmarks.fleet import FakeFleet
+from benchmarks.latency import COMMANDS, run_latency, print_latency
+from benchmarks.scenarios import SIZES, run_benchmarks, compare, print_comparison
+from benchmarks.startup import STARTUP_BUDGET, run_startup, print_startup
+from benchmarks.transfer import run_transfer, print_transfer
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+@click.command()
+@click.option('--sizes', default=','.join(str(size) for size in SIZES), help='comma separated fleet sizes to run every scenario at')
+@click.option('--output', default='bench_results.json', help='where to write the results')
+@click.option('--baseline', default=DEFAULT_BASELINE, help='results to compare against')
+@click.option('--save_baseline', is_flag=True, default=False, help='store the results as the new baseline instead of comparing')
+@click.option('--ssh_latency', default=0.0, type=float, help='seconds the fake sshd waits before answering each command')
+@click.option('--keep', is_flag=True, default=False, help='keep the fleet HOME with the lc output of every phase')
+@click.option('--startup_budget', default=STARTUP_BUDGET, type=float, help='seconds `lc -v`, `lc info` and every `--help` may take in a fresh interpreter')
+@click.option('--startup_only', is_flag=True, default=False, help='only check the cli cold start, no fleet needed')
+@click.option('--latency_commands', default=COMMANDS, type=click.IntRange(min=1), help='commands timed per mode of the ssh latency comparison')
+@click.option('--latency_only', is_flag=True, default=False, help='only compare per command ssh latency, cold versus pooled and multiplexed')
+@click.option('--transfer_only', is_flag=True, default=False, help='only check pull throughput of a file split into chunks')
+def main(sizes, output, baseline, save_baseline=False, ssh_latency=0.0, keep=False, startup_budget=STARTUP_BUDGET, startup_only=False,
+         latency_commands=COMMANDS, latency_only=False, transfer_only=False):
+    '''
+    Benchmark launch, list, bash fan out and terminate at fleet scale against moto and a local fake sshd.
+
+    The cli cold start is checked first; every startup path must stay under its budget without importing boto3, botocore,
+    paramiko, fabric or yaml. Per command ssh latency is compared last; a handshake per command against pooled and
+    multiplexed connections, then pull throughput of a file split into chunks against one pulled whole.
+    Exits non zero when a check or phase fails, or a metric regressed against the baseline.
+    '''
+    sizes = [int(size) for size in sizes.split(',') if size]
+
+    startup = run_startup(budget=startup_budget)
+    startup_failed = [record for record in startup if record['problems']]
+    if startup_failed:
+        print()
+        print_startup(startup, budget=startup_budget)
+    if startup_only:
+        sys.exit(1 if startup_failed else 0)
+
+    with FakeFleet(ssh_latency=ssh_latency, keep=keep) as fleet:
+        if latency_only:
+            latency = run_latency(fleet, latency_commands)
+            print()
+            print_latency(latency)
+            sys.exit(1 if startup_failed or any(record['error'] for record in latency) else 0)
+        if transfer_only:
+            transfer = run_transfer(fleet)
+            print()
+            print_transfer(transfer)
+            sys.exit(1 if startup_failed or any(record['problems'] for record in transfer) else 0)
+
+        results = run_benchmarks(fleet, sizes)
+        latency = run_latency(fleet, latency_commands)
+        print()
+        print_latency(latency)
+        transfer = run_transfer(fleet)
+        print()
+        print_transfer(transfer)
+        if keep:
+            print(f'fleet home kept at {fleet.home}')
+    results['startup'] = startup
+    results['latency'] = latency
+    results['transfer'] = transfer
+    ssh_failed = any(record['error'] for record in latency) or any(record['problems'] for record in transfer)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {output}')
+
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'baseline saved to {baseline}')
+        sys.exit(1 if startup_failed or ssh_failed or any(record['error'] for record in results['results']) else 0)
+
+    if not os.path.exists(baseline):
+        print(f'no baseline at {baseline}, run with --save_baseline to create one')
+        sys.exit(1 if startup_failed or ssh_failed else 0)
+
+    with open(baseline) as f:
+        rows, regressions = compare(results, json.load(f))
+    print()
+    print_comparison(rows)
+
+    if regressions:
+        print()
+        for (scenario, count), metric, old, new in regressions:
+            print(f'{scenario} x{count}: {metric} {old} -> {new}')
+    if regressions or startup_failed or ssh_failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
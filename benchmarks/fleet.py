@@ -0,0 +1,343 @@
+#This module simulates a fleet for the benchmarks; a moto server for EC2/STS and an in-process paramiko sshd answering for every instance
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+REGION = 'eu-west-1'
+
+# a public amazon linux image moto ships with
+IMAGE_ID = 'ami-12c6146b'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class FakeSshServer:
+    '''
+    One sshd on 127.0.0.1 that every simulated instance resolves to.
+
+    Any key is accepted. Commands are not executed; each exec is counted, optionally delayed by `latency` seconds and
+    answered with exit code 0, so the benchmarks measure launch control's own overhead rather than remote work.
+    `connections` and `execs` count ssh handshakes and round trips.
+
+    root: str = local directory served over sftp, remote absolute paths resolve under it; no sftp when not given
+    '''
+    def __init__(self, latency: float = 0, root: str = None):
+        self.latency = latency
+        self.root = root
+        self.connections = 0
+        self.execs = 0
+        self.port = None
+        self._lock = threading.Lock()
+        self._sock = None
+        self._transports = []
+
+    def start(self):
+        import logging
+        import paramiko
+
+        # clients that only probe the port (`tcp_probe`) make paramiko log a traceback per connection
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+        self._interface = _interface_class()
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(1024)
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            # the key exchange blocks, so it must not hold up the next accept
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        import paramiko
+
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self._host_key)
+        if self.root is not None:
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _sftp_interface_class(), self.root)
+        with self._lock:
+            self.connections += 1
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=self._interface(self))
+        except Exception:
+            transport.close()
+
+    def _exec(self, channel, command: str):
+        with self._lock:
+            self.execs += 1
+
+        # paramiko confirms the exec only after `check_channel_exec_request` returns, a channel closed before that makes the
+        # client fail with "Channel closed"; output, exit status and eof are fine in any order, the client closes the channel
+        def _reply():
+            if self.latency:
+                time.sleep(self.latency)
+            if command.strip().startswith('uname'):
+                channel.sendall(b'Linux\n')
+            channel.send_exit_status(0)
+            channel.shutdown_write()
+
+        threading.Thread(target=_reply, daemon=True).start()
+
+    def counters(self):
+        with self._lock:
+            return {'ssh_connections': self.connections, 'ssh_round_trips': self.execs}
+
+    def stop(self):
+        self._sock.close()
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
+            self._transports = []
+
+def _interface_class():
+    '''paramiko is imported lazily, so its `ServerInterface` subclass is built on first use'''
+    import paramiko
+
+    class ServerInterface(paramiko.ServerInterface):
+        def __init__(self, server):
+            self.server = server
+
+        def get_allowed_auths(self, username):
+            return 'publickey,none'
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_auth_none(self, username):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+        def check_channel_pty_request(self, *args):
+            return True
+
+        def check_channel_exec_request(self, channel, command):
+            self.server._exec(channel, command.decode('utf-8', errors='replace'))
+            return True
+
+    return ServerInterface
+
+def _sftp_interface_class():
+    '''the sftp side of `FakeSshServer`, enough of it for `TransferEngine`; built on first use like `_interface_class`'''
+    import paramiko
+
+    class SFTPHandle(paramiko.SFTPHandle):
+        def stat(self):
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        def chattr(self, attr):
+            return paramiko.SFTPServer.set_file_attr(self.filename, attr) or paramiko.SFTP_OK
+
+    class SFTPInterface(paramiko.SFTPServerInterface):
+        def __init__(self, server, root: str):
+            super().__init__(server)
+            self.root = root
+
+        def _local(self, path: str):
+            return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+        def _attributes(self, path: str, follow: bool = True):
+            try:
+                return paramiko.SFTPAttributes.from_stat((os.stat if follow else os.lstat)(self._local(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            return self._attributes(path)
+
+        def lstat(self, path):
+            return self._attributes(path, follow=False)
+
+        def list_folder(self, path):
+            local = self._local(path)
+            try:
+                return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)), name) for name in os.listdir(local)]
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def open(self, path, flags, attr):
+            local = self._local(path)
+            mode = 'r+b' if flags & os.O_RDWR else 'wb' if flags & os.O_WRONLY else 'rb'
+            try:
+                if flags & os.O_CREAT and not os.path.exists(local):
+                    open(local, 'wb').close()
+                f = open(local, mode)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            handle = SFTPHandle(flags)
+            handle.filename = local
+            handle.readfile = f
+            handle.writefile = f if mode != 'rb' else None
+            return handle
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(self._local(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+    return SFTPInterface
+
+class FakeFleet:
+    '''
+    Everything a benchmarked `lc` process needs, started once and shared by every scenario;
+
+    - a moto server standing in for EC2 and STS, reached through AWS_ENDPOINT_URL
+    - a `FakeSshServer` that every instance ip resolves to; fabric finds it through ~/.ssh/config and the OpenSSH client
+      (multiplexed connections) through an `ssh` wrapper on the PATH, one ControlMaster per instance as in real use;
+      its sftp serves `remote_root` as the instances' file system
+    - a throw away HOME with an lc config, key pair and registry
+
+    `env` is the environment to run `lc` processes with.
+    '''
+    def __init__(self, ssh_latency: float = 0, keep: bool = False):
+        self.ssh_latency = ssh_latency
+        self.keep = keep
+        self.home = None
+        self.moto = None
+        self.moto_port = None
+        self.ssh = None
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.moto_port}'
+
+    @property
+    def remote_root(self):
+        return f'{self.home}/remote'
+
+    @property
+    def control_dir(self):
+        return f'{self.home}/.launch_control/cm'
+
+    def start(self):
+        import logging
+        from moto.server import ThreadedMotoServer
+
+        # werkzeug logs every request
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        self.home = tempfile.mkdtemp(prefix='lc-bench-')
+        self.moto_port = free_port()
+        self.moto = ThreadedMotoServer(ip_address='127.0.0.1', port=self.moto_port, verbose=False)
+        self.moto.start()
+        os.makedirs(self.remote_root)
+        self.ssh = FakeSshServer(latency=self.ssh_latency, root=self.remote_root).start()
+
+        self._write_ssh_setup()
+        self._write_config(*self._create_account_resources())
+
+        return self
+
+    def _create_account_resources(self):
+        '''security group and instance profile the launches reference'''
+        import boto3
+
+        session = boto3.session.Session(aws_access_key_id='bench', aws_secret_access_key='bench', region_name=REGION)
+        ec2 = session.client('ec2', endpoint_url=self.endpoint)
+        iam = session.client('iam', endpoint_url=self.endpoint)
+        security_group_id = ec2.create_security_group(GroupName='lc-bench', Description='launch control benchmarks')['GroupId']
+        iam_role_arn = iam.create_instance_profile(InstanceProfileName='lc-bench')['InstanceProfile']['Arn']
+        ec2.create_key_pair(KeyName='lc-bench')
+
+        return security_group_id, iam_role_arn
+
+    def _write_ssh_setup(self):
+        import paramiko
+
+        ssh_dir = f'{self.home}/.ssh'
+        os.makedirs(ssh_dir, mode=0o700)
+        self.key_path = f'{ssh_dir}/lc-bench.pem'
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.key_path)
+        os.chmod(self.key_path, 0o600)
+
+        # moto hands out private ips from the default vpc (172.31/16) or subnets in 10/8
+        with open(f'{ssh_dir}/config', 'w') as f:
+            f.write(f'Host 10.* 172.*\n    HostName 127.0.0.1\n    Port {self.ssh.port}\n')
+
+        # OpenSSH reads the config of the real user, not $HOME; keep the instance ip as the host so ControlPath (%C)
+        # stays per instance and relay the connection to the fake sshd
+        bin_dir = f'{self.home}/bin'
+        os.makedirs(bin_dir)
+        relay = f'bash -c "exec 3<>/dev/tcp/127.0.0.1/{self.ssh.port}; cat <&3 & exec cat >&3"'
+        with open(f'{bin_dir}/ssh', 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write(f"exec {shutil.which('ssh')} -o 'ProxyCommand={relay}' -o UserKnownHostsFile=/dev/null "
+                    '-o StrictHostKeyChecking=no -o LogLevel=ERROR "$@"\n')
+        os.chmod(f'{bin_dir}/ssh', 0o755)
+
+    def _write_config(self, security_group_id: str, iam_role_arn: str):
+        from launch_control.utils import write_yaml
+
+        write_yaml({
+            'FULL_NAME': 'lc bench',
+            'TEAM': 'bench',
+            'EC2_KEY_PAIR_NAME': 'lc-bench',
+            'EC2_KEY_PAIR_PATH': self.key_path,
+            'GITHUB_PAT': 'bench',
+            'GITHUB_ORG': 'bench',
+            'GIT_USERNAME': 'bench',
+            'GIT_USEREMAIL': 'bench@example.com',
+            'AWS_DEFAULT_REGION': REGION,
+            'AWS_PROFILE': None,
+            'IMAGE_ID': IMAGE_ID,
+            'SECURITY_GROUP_ID': security_group_id,
+            'IAM_ROLE_ARN': iam_role_arn,
+        }, f'{self.home}/.launch_control/config.yaml')
+
+    @property
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'HOME': self.home,
+            'PATH': f"{self.home}/bin{os.pathsep}{os.environ.get('PATH', '')}",
+            'AWS_ENDPOINT_URL': self.endpoint,
+            'AWS_ACCESS_KEY_ID': 'bench',
+            'AWS_SECRET_ACCESS_KEY': 'bench',
+            'AWS_DEFAULT_REGION': REGION,
+            'AWS_CONFIG_FILE': os.devnull,
+            'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+        })
+        env.pop('AWS_PROFILE', None)
+        env.pop('AWS_SESSION_TOKEN', None)
+        return env
+
+    def close_masters(self):
+        '''stop the OpenSSH ControlMasters left behind by multiplexed connections'''
+        import subprocess
+
+        if not os.path.isdir(self.control_dir):
+            return
+        for name in os.listdir(self.control_dir):
+            subprocess.run(['ssh', '-o', f'ControlPath={self.control_dir}/{name}', '-O', 'exit', 'lc-bench'], env=self.env, capture_output=True)
+
+    def stop(self):
+        self.close_masters()
+        if self.ssh is not None:
+            self.ssh.stop()
+        if self.moto is not None:
+            self.moto.stop()
+        if self.home and not self.keep:
+            shutil.rmtree(self.home, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
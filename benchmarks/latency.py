@@ -0,0 +1,147 @@
+#This module compares per command ssh latency against the fake sshd; a handshake per command versus pooled and multiplexed connections
+import json
+import os
+import subprocess
+import sys
+import time
+
+from launch_control.utils import print_table
+
+# commands timed per mode
+COMMANDS = 20
+
+# the fleet's ssh config and ssh wrapper send every 10.* address to the fake sshd
+HOST = '10.0.0.1'
+USER = 'ubuntu'
+
+# (mode, what it stands for); each mode runs in its own process so connection counts at the sshd are per mode
+MODES = [
+    ('fabric_cold', 'a new fabric connection and handshake per command, as before connections were reused'),
+    ('fabric_pooled', 'one fabric connection from `ConnectionPool` reused within a process'),
+    ('multiplex_cold', 'the OpenSSH client with the ControlMaster stopped before every command'),
+    ('multiplex_warm', 'the OpenSSH client through a running ControlMaster, as a later `lc` invocation finds it'),
+]
+
+def _timed(run, commands: int, before=None):
+    '''seconds each of `commands` calls of `run` took, `before` runs untimed ahead of every call'''
+    times = []
+    for _ in range(commands):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+def measure(mode: str, commands: int, key_filename: str):
+    '''per command seconds of `mode`, run inside a process with the fleet's environment'''
+    from launch_control.connections import ConnectionPool, MultiplexedConnection
+
+    if mode == 'fabric_cold':
+        import fabric
+
+        def run():
+            connection = fabric.Connection(HOST, user=USER, connect_kwargs={'key_filename': [key_filename]})
+            try:
+                connection.run('true', hide=True)
+            finally:
+                connection.close()
+
+        return _timed(run, commands)
+
+    if mode == 'fabric_pooled':
+        pool = ConnectionPool()
+        try:
+            # the first command pays the handshake like every `fabric_cold` one
+            return _timed(lambda: pool.get('i-latency', USER, key_filename, host=HOST).run('true', hide=True), commands)
+        finally:
+            pool.close_all()
+
+    connection = MultiplexedConnection(HOST, user=USER, key_filename=key_filename)
+    try:
+        if mode == 'multiplex_cold':
+            return _timed(lambda: connection.run('true', hide=True), commands, before=connection.stop)
+        if mode == 'multiplex_warm':
+            # open the master outside the timings, the timed commands find it running
+            connection.run('true', hide=True)
+            return _timed(lambda: connection.run('true', hide=True), commands)
+    finally:
+        connection.stop()
+
+    raise ValueError(f'unknown latency mode {mode}')
+
+def _percentile(times: list, fraction: float):
+    ordered = sorted(times)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_mode(fleet, mode: str, commands: int = COMMANDS):
+    '''time `commands` sequential commands of one mode in a fresh process, returns its record'''
+    from benchmarks.scenarios import REPO_ROOT, PHASE_TIMEOUT
+
+    log_dir = f'{fleet.home}/bench'
+    os.makedirs(log_dir, exist_ok=True)
+    result_path = f'{log_dir}/latency-{mode}.json'
+
+    env = fleet.env
+    env['PYTHONPATH'] = os.pathsep.join([REPO_ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+
+    before = fleet.ssh.counters()
+    try:
+        process = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.latency', result_path, mode, str(commands), fleet.key_path],
+            env=env, cwd=fleet.home, capture_output=True, text=True, timeout=PHASE_TIMEOUT,
+        )
+        error = None if process.returncode == 0 else (process.stderr.strip().splitlines() or [f'exited with {process.returncode}'])[-1]
+    except subprocess.TimeoutExpired:
+        error = f'timed out after {PHASE_TIMEOUT}s'
+    after = fleet.ssh.counters()
+
+    record = {'mode': mode, 'commands': commands, 'error': error}
+    if not error:
+        with open(result_path) as f:
+            times = json.load(f)
+        record.update({
+            'first_ms': times[0] * 1000,
+            'median_ms': _percentile(times, 0.5) * 1000,
+            'p95_ms': _percentile(times, 0.95) * 1000,
+        })
+    record.update({key: after[key] - before[key] for key in after})
+
+    return record
+
+def run_latency(fleet, commands: int = COMMANDS, progress=print):
+    '''every mode of `MODES` against the fleet's fake sshd, returns a record per mode'''
+    records = []
+    for mode, _ in MODES:
+        record = run_mode(fleet, mode, commands)
+        records.append(record)
+        if progress:
+            if record['error']:
+                progress(f"{mode:>14} FAILED ({record['error']})")
+            else:
+                progress(f"{mode:>14} {record['median_ms']:7.1f}ms median  {record['p95_ms']:7.1f}ms p95  "
+                         f"{record['ssh_connections']:3} ssh connections for {commands} commands")
+
+    return records
+
+def print_latency(records: list):
+    '''per command latency of each mode and its speed up over a handshake per command'''
+    cold = next((record for record in records if record['mode'] == 'fabric_cold' and not record['error']), None)
+    header = ['mode', 'commands', 'first_ms', 'median_ms', 'p95_ms', 'ssh connections', 'vs fabric_cold']
+    rows = []
+    for record in records:
+        if record['error']:
+            rows.append([record['mode'], record['commands'], '-', '-', '-', record['ssh_connections'], 'FAILED'])
+            continue
+        speedup = f"{cold['median_ms'] / record['median_ms']:.1f}x" if cold and record['median_ms'] else '-'
+        rows.append([
+            record['mode'], record['commands'], f"{record['first_ms']:.1f}", f"{record['median_ms']:.1f}",
+            f"{record['p95_ms']:.1f}", record['ssh_connections'], speedup,
+        ])
+    print_table(header, rows)
+
+if __name__ == '__main__':
+    result_path, mode, commands, key_filename = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+    with open(result_path, 'w') as f:
+        json.dump(measure(mode, commands, key_filename), f)
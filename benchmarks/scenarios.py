@@ -0,0 +1,145 @@
+#This module defines the benchmark scenarios, runs them against a `FakeFleet` and compares results with a baseline
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from launch_control.utils import print_table
+
+SIZES = [1, 10, 100, 500]
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a phase taking longer than this is reported as failed
+PHASE_TIMEOUT = 900
+
+# allowed relative growth over the baseline per metric; counts are deterministic against moto and the fake sshd
+TOLERANCES = {
+    'wall_s': 0.25,
+    'process_s': 0.25,
+    'peak_rss_mb': 0.15,
+    'api_calls': 0,
+    'ssh_round_trips': 0,
+    'ssh_connections': 0,
+}
+
+# differences below these are noise whatever the relative change
+NOISE_FLOOR = {
+    'wall_s': 0.05,
+    'process_s': 0.05,
+    'peak_rss_mb': 2,
+}
+
+def phases(count: int):
+    '''
+    (scenario, lc arguments, stdin) run in order for a fleet of `count` instances, each in a fresh `lc` process
+
+    later phases act on the instances `launch` created; `bash` opens an ssh ControlMaster per instance and `bash_warm`
+    reuses them, `terminate_all` leaves the registry empty for the next fleet size
+    '''
+    # several instances make `lc bash` ask which one, answer for all of them
+    select_all = 'all\n' if count > 1 else None
+    return [
+        ('launch', ['launch', '--instance_type', 'm5.xlarge', '--on_demand', '-n', str(count), '--idle', '0'], None),
+        ('list', ['list'], None),
+        ('bash', ['bash', '', 'true'], select_all),
+        ('bash_warm', ['bash', '', 'true'], select_all),
+        ('terminate_all', ['terminate', '--all'], None),
+    ]
+
+def run_phase(fleet, scenario: str, count: int, args: list, stdin: str = None):
+    '''run one `lc` invocation in a worker process, returns its result record'''
+    log_dir = f'{fleet.home}/bench'
+    os.makedirs(log_dir, exist_ok=True)
+    result_path = f'{log_dir}/{scenario}-{count}.json'
+    log_path = f'{log_dir}/{scenario}-{count}.log'
+
+    env = fleet.env
+    env['PYTHONPATH'] = os.pathsep.join([REPO_ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+
+    before = fleet.ssh.counters()
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        try:
+            process = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.worker', result_path] + args,
+                input=stdin or '', stdout=log, stderr=subprocess.STDOUT, env=env, cwd=fleet.home, text=True, timeout=PHASE_TIMEOUT,
+            )
+            error = None if process.returncode == 0 else f'worker exited with {process.returncode}'
+        except subprocess.TimeoutExpired:
+            error = f'timed out after {PHASE_TIMEOUT}s'
+    process_s = time.perf_counter() - start
+    after = fleet.ssh.counters()
+
+    record = {'scenario': scenario, 'instances': count, 'process_s': process_s}
+    if os.path.exists(result_path):
+        with open(result_path) as f:
+            record.update(json.load(f))
+    record['error'] = record.get('error') or error
+    record.update({key: after[key] - before[key] for key in after})
+    if record['error']:
+        record['log'] = log_path
+
+    return record
+
+def run_benchmarks(fleet, sizes: list = None, progress=print):
+    '''every phase for every fleet size, returns the results document'''
+    results = []
+    for count in sizes or SIZES:
+        for scenario, args, stdin in phases(count):
+            record = run_phase(fleet, scenario, count, args, stdin)
+            results.append(record)
+            if progress:
+                status = f"FAILED ({record['error']}, see {record['log']})" if record['error'] else 'ok'
+                progress(f"{scenario:>14} x{count:<4} {record.get('wall_s', 0):7.2f}s  {record.get('api_calls', 0):5} api calls  "
+                         f"{record['ssh_round_trips']:5} ssh round trips  {record.get('peak_rss_mb', 0):6.1f}MB  {status}")
+        fleet.close_masters()
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'sizes': sizes or SIZES,
+            'ssh_latency': fleet.ssh_latency,
+        },
+        'results': results,
+    }
+
+def compare(current: dict, baseline: dict, tolerances: dict = None):
+    '''
+    per (scenario, instances, metric) in both documents, returns (rows, regressions)
+
+    a metric regresses when it grew by more than its tolerance and more than its noise floor; failed phases always regress
+    '''
+    tolerances = TOLERANCES if tolerances is None else tolerances
+    baseline_records = {(record['scenario'], record['instances']): record for record in baseline['results']}
+
+    rows, regressions = [], []
+    for record in current['results']:
+        key = (record['scenario'], record['instances'])
+        if record.get('error'):
+            regressions.append((key, 'error', None, record['error']))
+            continue
+        base = baseline_records.get(key)
+        if base is None or base.get('error'):
+            continue
+        for metric, tolerance in tolerances.items():
+            if metric not in record or metric not in base:
+                continue
+            old, new = base[metric], record[metric]
+            change = (new - old) / old if old else (0 if new == old else float('inf'))
+            regressed = new - old > NOISE_FLOOR.get(metric, 0) and change > tolerance
+            rows.append([key[0], key[1], metric, _format(old), _format(new), f'{change:+.0%}' if change != float('inf') else 'new', 'REGRESSED' if regressed else ''])
+            if regressed:
+                regressions.append((key, metric, old, new))
+
+    return rows, regressions
+
+def _format(value):
+    return f'{value:.3f}' if isinstance(value, float) else value
+
+def print_comparison(rows: list):
+    print_table(['scenario', 'instances', 'metric', 'baseline', 'current', 'change', ''], rows)
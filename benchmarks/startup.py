@@ -0,0 +1,93 @@
+#This module checks the cold start of the `lc` cli; every subcommand's `--help`, `lc -v` and `lc info` on a cache hit, each in a fresh interpreter
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from launch_control.utils import print_table
+
+# none of these may be imported by a startup path, they cost hundreds of milliseconds between them
+HEAVY_MODULES = ['boto3', 'botocore', 'paramiko', 'fabric', 'yaml']
+
+# seconds per invocation, interpreter start included
+STARTUP_BUDGET = 0.5
+
+# runs per invocation, the median is held against the budget
+REPEATS = 5
+
+# runs `lc` as `python -m launch_control` would and writes which heavy modules got imported on exit
+PROBE = '''
+import atexit, json, runpy, sys
+result_path, heavy, args = sys.argv[1], sys.argv[2].split(','), sys.argv[3:]
+atexit.register(lambda: json.dump(sorted(name for name in sys.modules if name.split('.')[0] in heavy), open(result_path, 'w')))
+sys.argv = ['lc'] + args
+runpy.run_module('launch_control', run_name='__main__', alter_sys=True)
+'''
+
+def invocations():
+    '''(name, lc arguments) of every startup path that is checked'''
+    from launch_control.__main__ import cli
+
+    return [('-v', ['-v']), ('--help', ['--help'])] + [(f'{name} --help', [name, '--help']) for name in sorted(cli.commands)] + [('info', ['info'])]
+
+def _seed_home(home: str):
+    '''a registry with one instance whose ip is cached, so `lc info` is served without the EC2 api'''
+    from launch_control.registry import Registry
+
+    registry = Registry(f'{home}/.launch_control/registry.db', migrate=False)
+    registry.add('i-0123456789abcdef0', project='no_project', region='eu-west-1')
+    registry.set_metadata('i-0123456789abcdef0', {'state': 'running', 'private_ip_address': '10.0.0.1', 'public_ip_address': '54.0.0.1', 'cached_at': time.time()})
+
+def run_startup(budget: float = STARTUP_BUDGET, repeats: int = REPEATS, progress=print):
+    '''
+    time every invocation in fresh interpreters, returns a record per invocation
+
+    a record fails when its median time is over `budget`, it imported any of `HEAVY_MODULES` or exited with an error
+    '''
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    home = tempfile.mkdtemp(prefix='lc-startup-')
+    try:
+        _seed_home(home)
+        env = dict(os.environ, HOME=home)
+        env['PYTHONPATH'] = os.pathsep.join([repo_root] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+        result_path = f'{home}/modules.json'
+
+        records = []
+        for name, args in invocations():
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, '-c', PROBE, result_path, ','.join(HEAVY_MODULES)] + args, env=env, cwd=home, capture_output=True, text=True)
+                times.append(time.perf_counter() - start)
+            with open(result_path) as f:
+                modules = json.load(f)
+
+            seconds = sorted(times)[len(times) // 2]
+            # `lc -v` exits with the version as its message
+            error = None if process.returncode == 0 or name == '-v' else (process.stderr.strip().splitlines() or [f'exited with {process.returncode}'])[-1]
+            problems = []
+            if seconds > budget:
+                problems.append(f'over the {budget}s budget')
+            if modules:
+                problems.append(f"imported {', '.join(sorted(set(module.split('.')[0] for module in modules)))}")
+            if error:
+                problems.append(error)
+
+            records.append({'invocation': f'lc {name}', 'seconds': seconds, 'heavy_modules': modules, 'error': error, 'problems': problems})
+            if progress:
+                progress(f"{'lc ' + name:>20} {seconds:6.3f}s  {'; '.join(problems) or 'ok'}")
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    return records
+
+def print_startup(records: list, budget: float = STARTUP_BUDGET):
+    header = ['invocation', 'median_s', 'budget_s', 'heavy imports', '']
+    rows = [
+        [record['invocation'], f"{record['seconds']:.3f}", budget, ','.join(sorted(set(module.split('.')[0] for module in record['heavy_modules']))) or '-', 'FAILED' if record['problems'] else '']
+        for record in records
+    ]
+    print_table(header, rows)
@@ -0,0 +1,100 @@
+#This module checks `lc pull` throughput against the fake sshd's sftp; a file pulled whole versus split into chunks
+import os
+import shutil
+import time
+
+from launch_control.utils import print_table
+
+# size of the pulled file and of its chunks, the file must span several chunks
+FILE_MB = 64
+CHUNK_MB = 8
+
+# a chunked pull over one stream may not fall further behind the whole file pull than this, chunks after the first
+# that are read one request at a time instead of prefetched drop well below it
+CHUNKED_FLOOR = 0.5
+
+# the remote path, under the fleet's `remote_root`
+REMOTE_PATH = '/home/ubuntu/bench/pull.bin'
+
+def modes(file_mb: int = FILE_MB, chunk_mb: int = CHUNK_MB):
+    '''(mode, streams, chunk size in bytes) of every pull that is timed'''
+    from launch_control.transfer import STREAMS
+
+    return [
+        ('whole_file', 1, file_mb * 2 ** 20),
+        ('chunked', 1, chunk_mb * 2 ** 20),
+        ('chunked_streams', STREAMS, chunk_mb * 2 ** 20),
+    ]
+
+def _write_remote_file(fleet, file_mb: int):
+    path = os.path.join(fleet.remote_root, REMOTE_PATH.lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        for _ in range(file_mb):
+            f.write(os.urandom(2 ** 20))
+    return path
+
+def run_transfer(fleet, file_mb: int = FILE_MB, chunk_mb: int = CHUNK_MB, progress=print):
+    '''
+    pull a `file_mb` file from the fake sshd once per mode of `modes`, returns a record per mode
+
+    `chunked` fails when its throughput is under `CHUNKED_FLOOR` of `whole_file`'s or a pull errored or came back different
+    '''
+    from launch_control.transfer import TransferEngine
+
+    remote = _write_remote_file(fleet, file_mb)
+    local_dir = f'{fleet.home}/bench/pulled'
+    records = []
+    try:
+        for mode, streams, chunk_size in modes(file_mb, chunk_mb):
+            shutil.rmtree(local_dir, ignore_errors=True)
+            os.makedirs(local_dir)
+            local = f'{local_dir}/pull.bin'
+            record = {'mode': mode, 'streams': streams, 'chunks': -(-file_mb * 2 ** 20 // chunk_size), 'error': None, 'problems': []}
+
+            start = time.perf_counter()
+            try:
+                with TransferEngine('127.0.0.1', 'ubuntu', fleet.key_path, streams=streams, chunk_size=chunk_size, port=fleet.ssh.port) as engine:
+                    engine.pull(REMOTE_PATH, local)
+                seconds = time.perf_counter() - start
+                record.update({'seconds': seconds, 'mb_per_s': file_mb * 2 ** 20 / 1e6 / seconds})
+                if not _same(remote, local):
+                    record['error'] = 'pulled file differs from the remote one'
+            except BaseException as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+            if record['error']:
+                record['problems'].append(record['error'])
+            records.append(record)
+
+        whole = next(record for record in records if record['mode'] == 'whole_file')
+        chunked = next(record for record in records if record['mode'] == 'chunked')
+        if not whole['error'] and not chunked['error'] and chunked['mb_per_s'] < CHUNKED_FLOOR * whole['mb_per_s']:
+            chunked['problems'].append(f"{chunked['mb_per_s']:.1f}MB/s is under {CHUNKED_FLOOR:.0%} of a whole file pull")
+
+        if progress:
+            for record in records:
+                speed = f"{record['mb_per_s']:7.1f}MB/s" if 'mb_per_s' in record else ' ' * 11
+                progress(f"{record['mode']:>16} {speed}  {'; '.join(record['problems']) or 'ok'}")
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+        os.remove(remote)
+
+    return records
+
+def _same(a: str, b: str):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            block_a, block_b = fa.read(2 ** 20), fb.read(2 ** 20)
+            if block_a != block_b:
+                return False
+            if not block_a:
+                return True
+
+def print_transfer(records: list):
+    header = ['mode', 'streams', 'chunks', 'seconds', 'MB/s', '']
+    rows = [
+        [record['mode'], record['streams'], record['chunks'], f"{record['seconds']:.2f}" if 'seconds' in record else '-',
+         f"{record['mb_per_s']:.1f}" if 'mb_per_s' in record else '-', 'FAILED' if record['problems'] else '']
+        for record in records
+    ]
+    print_table(header, rows)
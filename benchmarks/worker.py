@@ -0,0 +1,58 @@
+#This module runs one `lc` invocation inside a benchmark worker process and writes what it cost as json
+import json
+import resource
+import sys
+import time
+
+def peak_rss_mb():
+    '''
+    high water mark of this process' resident memory
+
+    read from /proc where possible, `ru_maxrss` carries over the parent's peak across fork and exec
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on linux, bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 1024
+
+def run(result_path: str, args: list):
+    '''
+    run `lc <args>` in this process and write wall time, api calls and peak memory to `result_path`
+
+    the parent measures ssh round trips at the fake sshd and the process wall time including interpreter start
+    '''
+    start = time.perf_counter()
+    from launch_control.__main__ import cli
+    from launch_control.aws import api_stats
+    imported = time.perf_counter()
+
+    error = None
+    try:
+        cli.main(args, prog_name='lc', standalone_mode=False)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = str(e.code)
+    except BaseException as e:
+        error = f'{type(e).__name__}: {e}'
+    finished = time.perf_counter()
+
+    with open(result_path, 'w') as f:
+        json.dump({
+            'import_s': imported - start,
+            'wall_s': finished - imported,
+            'api_calls': api_stats.total,
+            'api_retries': api_stats.retries,
+            'api_throttled': api_stats.throttled,
+            'api_calls_by_method': api_stats.calls,
+            'peak_rss_mb': peak_rss_mb(),
+            'error': error,
+        }, f)
+
+if __name__ == '__main__':
+    run(sys.argv[1], sys.argv[2:])
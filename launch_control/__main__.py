@@ -1,24 +1,50 @@
 import sys
-import subprocess
-import pkg_resources 
 from pathlib import Path
 import ntpath
 
 import click
-import yaml
 import os
 
 import warnings
 warnings.filterwarnings("ignore") 
 
 from launch_control.config import LaunchControlConfig, load_lc_config
-from launch_control.utils import update_yaml_file, get_git_config, detect_ssh_keys, read_yaml, test_credentials
-from launch_control.vars import LAUNCH_CONTROL_CONFIG, LAUNCH_CONTROL_PROJECT_DIR, LAUNCH_CONTROL_INSTANCE_DIR
-from launch_control.ec2 import EC2InstanceFactory, EC2Instance
-from launch_control.project import MakeProject, detect_create_project, determine_project_type, GitProject
+from launch_control.utils import update_yaml_file, get_git_config, detect_ssh_keys, read_yaml
+from launch_control.vars import LAUNCH_CONTROL_CONFIG, LAUNCH_CONTROL_INSTANCE_DIR
+from launch_control.context import LaunchControlContext, resolve_project
+from launch_control.project import MakeProject, GitProject
+from launch_control.bootstrap import BootstrapPipeline, print_bootstrap_report
+from launch_control.readiness import timing_events
+from launch_control.trace import tracer, print_timings
+from launch_control.connections import MultiplexedConnection
+from launch_control.fanout import run_parallel, print_summary_table
+from launch_control.cache import metadata_cache
+from launch_control.registry import get_registry
+from launch_control.aws import api_stats
+from launch_control.pricing import BID_STRATEGIES, SpotPriceBook, rank_spot_offers, print_spot_offers, market_bid
+from launch_control.capacity import specs_from_offers
+from launch_control.sync import CodeSync, SYNC_MODES, sync_instances, print_sync_report
+from launch_control.transfer import STREAMS, CHUNK_SIZE, print_throughput
+from launch_control.bake import ImageBaker, find_baked_image, default_build_command, print_baked_images
+from launch_control.pool import WarmPool, release_instances, has_pool, refill_in_background, print_pool
+from launch_control.jobs import JobRunner, print_job_started, print_jobs, local_log_path
+from launch_control.mapper import MapScheduler, load_items, print_map_report
+from launch_control.lifecycle import DEFAULT_IDLE_MINUTES, Reaper, parse_duration, lifecycle_tags, expiry_time, print_reap_report
 
 __author__ = "Stefan Fouche"
 
+# boto3, botocore, fabric/paramiko and yaml are imported inside the code paths that use them,
+# so `lc -v`, `lc info` (on a cache hit) and flag typos don't pay for them
+
+def get_version():
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version('launch_control')
+    except PackageNotFoundError:
+        # run from a source checkout
+        return 'unknown, launch_control is not installed'
+
 def configure_launch_control(file=None, update_file=None):
     ##Check if launch control environment configs exist
     try:
@@ -53,6 +79,7 @@ def configure_launch_control(file=None, update_file=None):
         'EC2_KEY_PAIR_NAME': 'name of key used for your ec2 instance',
         'EC2_KEY_PAIR': 'file name in your ~/.ssh folder',
         'GITHUB_PAT' : 'your personal access token for jumo github acc',
+        'GITHUB_ORG' : 'github org projects are cloned from',
         'GIT_USERNAME' : 'your git username',
         'GIT_USEREMAIL' : 'your git email',
         'AWS_DEFAULT_REGION' : 'your aws region',
@@ -83,6 +110,7 @@ def configure_launch_control(file=None, update_file=None):
     setup_config['EC2_KEY_PAIR_NAME'] = click.prompt('Please enter EC2_KEY_PAIR_NAME', type=str, default="decision-science")
     setup_config['EC2_KEY_PAIR_PATH'] = click.prompt('Please enter EC2_KEY_PAIR_PATH', type=str, default = default_ssh)
     setup_config['GITHUB_PAT'] = click.prompt('Please enter GITHUB_PAT', type=str, default=os.environ["GITHUB_PAT"])
+    setup_config['GITHUB_ORG'] = click.prompt('Please enter GITHUB_ORG', type=str, default='jumo')
     setup_config['GIT_USERNAME'] = click.prompt('Please enter GIT_USERNAME', type=str, default=git_config["GIT_USERNAME"])
     setup_config['GIT_USEREMAIL'] = click.prompt('Please enter GIT_USEREMAIL', type=str, default=git_config["GIT_USEREMAIL"])
     setup_config['AWS_DEFAULT_REGION'] = click.prompt('Please enter AWS_DEFAULT_REGION', default='eu-west-1')
@@ -96,291 +124,707 @@ def configure_launch_control(file=None, update_file=None):
     sys.exit(f'credentials stored at {LAUNCH_CONTROL_CONFIG()}')
     # if setup_config_path.is_file():
 
-@click.command()
+pass_context = click.make_pass_decorator(LaunchControlContext)
+
+def select_instances(ctx: LaunchControlContext, project_name: str, allow_all: bool = False):
+    '''instance ids recorded for a project, prompting for one when there are several'''
+    # straight from the registry, building the factory would load the config and boto3
+    instances = [record['instance_id'] for record in get_registry().instances(project=project_name)] or None
+
+    if instances is None:
+        sys.exit('no instances found for this project')
+
+    if len(instances) > 1:
+        print()
+        choices = ['all'] if allow_all else []
+        for ins in instances:
+            choices.append(ins)
+
+        instance_choice = click.prompt(
+            'please select instance to run on:',
+            type=click.Choice([instance for instance in choices]),
+        )
+
+        if instance_choice != 'all':
+            instances = [instance_choice]
+
+    return instances
+
+def instance_tags(lc_config, instance_name: str):
+    return [
+        {'Key':'Name', 'Value': instance_name},
+        {'Key':'Username', 'Value': lc_config.FULL_NAME},
+        {'Key':'Team', 'Value': lc_config.TEAM},
+        {'Key':'Owner', 'Value': lc_config.TEAM},
+        {'Key':'Environment', 'Value': 'production'},
+        {'Key':'Classification', 'Value': 'restricted'},
+        {'Key':'Status', 'Value': 'active'},
+    ]
+
+def bootstrap_pipeline(lc_config, project, concurrency: int = 8, sync_mode: str = 'clone', depth: int = 1, idle_minutes: int = None, expires_at: float = None):
+    '''ready -> env vars, git and project code in one script, shared by `launch` and `bake`'''
+    env_vars = {
+        'GITHUB_PAT':lc_config.GITHUB_PAT,
+        'BUNDLE_GITHUB__COM':lc_config.GITHUB_PAT,
+        'GIT_USERNAME':lc_config.GIT_USERNAME,
+        'AWS_DEFAULT_REGION':lc_config.AWS_DEFAULT_REGION,
+    }
+
+    return BootstrapPipeline(
+        ssh_key_file=lc_config.EC2_KEY_PAIR_PATH,
+        env_vars=env_vars,
+        git_username=lc_config.GIT_USERNAME,
+        git_usermail=lc_config.GIT_USEREMAIL,
+        project=project,
+        pat=lc_config.GITHUB_PAT,
+        max_workers=concurrency,
+        code_sync=CodeSync(project, mode=sync_mode, pat=lc_config.GITHUB_PAT, org=getattr(lc_config, 'GITHUB_ORG', None), depth=depth) if isinstance(project, GitProject) else None,
+        idle_minutes=idle_minutes,
+        expires_at=expires_at,
+    )
+
+def public_dns(ip: str, region: str):
+    clean_ip = ip.replace('.','-')
+    return f'ec2-{clean_ip}.{region}.compute.amazonaws.com'
+
+@click.group(chain=True, invoke_without_command=True)
 @click.option('-v','--version', is_flag=True)
-@click.option('--configure', is_flag=True)
-@click.option('-f','--file')
-@click.option('-u','--update_file')
-@click.option('--launch', is_flag=True)
-@click.argument('project_path', default='')
-@click.option('--instance_type', default='')
-@click.argument('command', nargs=-1)
-@click.option('--on_demand', is_flag=True, default=False)
-@click.option('--spot_price', default='2')
-@click.option('--terminate', is_flag=True)
-@click.option('--terminate_all', is_flag=True)
 @click.option('--region')
 @click.option('--profile')
 @click.option('--key_pair_name')
-@click.option('-l','--list', is_flag=True)
-@click.option('--bash', is_flag=True)
-@click.option('--ssh', is_flag=True)
-@click.option('-i', '--info', is_flag=True)
-
-def cli(project_path='', info=None, ssh=None, command=None, list=False, terminate=None, version: bool = False, configure=False, file=None, update_file=None, launch=None, instance_type='', bash=None, terminate_all=None,region=None, key_pair_name=None, profile=None,  on_demand=False, spot_price='2'):
-
+@click.option('--trace', 'trace_path', default=None, help='write a chrome trace (chrome://tracing, ui.perfetto.dev) of every aws call, ssh command and bootstrap stage to this file')
+@click.option('--timings', is_flag=True, default=False, help='print a table of where the time went on exit')
+@click.pass_context
+def cli(click_ctx, version: bool = False, region=None, profile=None, key_pair_name=None, trace_path=None, timings=False):
+    '''
+    Launch projects on EC2.
+
+    Subcommands can be chained and share one lazily built aws session, e.g. `lc terminate . launch . -n 4`
+    '''
     if version:
-        ver = pkg_resources.require('launch_control')[0].version  
-        sys.exit(ver)
+        sys.exit(get_version())
 
-    if configure:
-        configure_launch_control(file,update_file)
-        sys.exit('configured')
+    if click_ctx.invoked_subcommand is None:
+        click.echo(click_ctx.get_help())
+        sys.exit(0)
 
-    try:
-        lc_config = load_lc_config(LAUNCH_CONTROL_CONFIG())
+    if trace_path or timings:
+        start_tracing(click_ctx, trace_path, timings)
 
-    except:
-        sys.exit('could not load credentials... Have you run `lc --configure`?')
+    click_ctx.obj = LaunchControlContext(region=region, profile=profile, key_pair_name=key_pair_name)
 
-    if project_path != '':
-        if project_path == '.':
-            project_path = os.getcwd()
+def start_tracing(click_ctx, trace_path: str = None, timings: bool = False):
+    '''enable `tracer` for the whole (chained) invocation and report once it is done, also when a command exits early'''
+    tracer.enable()
+    start = tracer.clock()
+    command_line = ' '.join(['lc'] + sys.argv[1:])
 
-        project_name = os.path.basename(os.path.abspath(project_path))
-        project_type = determine_project_type(project_path)
-        project = detect_create_project(project_path)
-        # print('We have detected the following project types:')
-        # print(project_type)
-    else:
-        # print('no project specified...')
-        project_name = 'no_project'
+    def _report():
+        tracer.record(command_line, 'cli', start, tracer.clock() - start)
+        if trace_path:
+            tracer.write_chrome_trace(trace_path)
+            print(f'trace written to {trace_path}')
+        if timings:
+            print()
+            print_timings(tracer.timings())
 
-    if not region:
-        region = lc_config.AWS_DEFAULT_REGION
+    click_ctx.call_on_close(_report)
 
-    if not profile:
-        profile = lc_config.AWS_PROFILE
+@cli.command()
+@click.option('-f','--file')
+@click.option('-u','--update_file')
+def configure(file=None, update_file=None):
+    '''set up ~/.launch_control/config.yaml'''
+    configure_launch_control(file,update_file)
+    sys.exit('configured')
+
+@cli.command()
+@click.argument('project_path', default='')
+@click.argument('command', nargs=-1)
+@click.option('--instance_type', multiple=True, help='acceptable instance type, repeat to give fallbacks in order of preference')
+@click.option('--subnet', multiple=True, help='acceptable subnet id (one per AZ), repeat to give fallbacks in order of preference')
+@click.option('--on_demand', is_flag=True, default=False)
+@click.option('--spot_price', default=None, help='max spot price in USD/hour, see --bid when not given')
+@click.option('--bid', default='on_demand', type=click.Choice(BID_STRATEGIES), help='without --spot_price, pay up to the on demand price or bid a little above the current market price')
+@click.option('--fallback_deadline', type=float, default=None, help='seconds to wait for spot capacity before falling back to on demand')
+@click.option('--min_vcpu', default=0, type=int, help='pick the cheapest instance type and AZ with at least this many vCPUs')
+@click.option('--min_mem', default=0, type=float, help='pick the cheapest instance type and AZ with at least this many GiB of memory')
+@click.option('--rank_by', default='vcpu', type=click.Choice(['vcpu', 'mem', 'price']), help='rank instance types by spot price per vCPU, per GiB or per instance')
+@click.option('-n','--count', default=1, type=click.IntRange(min=1), help='number of instances to launch in one request')
+@click.option('--concurrency', default=8, type=int, help='number of instances bootstrapped at the same time')
+@click.option('--sync', 'sync_mode', default='clone', type=click.Choice(SYNC_MODES), help='clone the pushed branch, upload the local working tree or push a git bundle')
+@click.option('--depth', default=1, type=int, help='history to clone, 0 for a blobless clone of the full history')
+@click.option('--fresh', is_flag=True, default=False, help='launch new instances from the configured IMAGE_ID, skipping baked images and the warm pool')
+@click.option('--detach', is_flag=True, default=False, help='run the command as a background job instead of holding the ssh session, see `lc logs`')
+@click.option('--ttl', default=None, help='terminate the instances after this long no matter what, e.g. 90m, 8h or 2d')
+@click.option('--idle', 'idle_minutes', default=DEFAULT_IDLE_MINUTES, type=click.IntRange(min=0), help='shut the instances down after this many minutes without cpu load, ssh sessions or running jobs, off (0) by default')
+@pass_context
+def launch(ctx, project_path='', command=None, instance_type=(), subnet=(), on_demand=False, spot_price=None, bid='on_demand', fallback_deadline=None, min_vcpu=0, min_mem=0, rank_by='vcpu', count=1, concurrency=8, sync_mode='clone', depth=1, fresh=False, detach=False, ttl=None, idle_minutes=DEFAULT_IDLE_MINUTES):
+    '''launch instances and bootstrap a project on them'''
+    lc_config = ctx.config
+    region = ctx.region
+    project_name, project = resolve_project(project_path)
+
+    ctx.check_credentials()
+
+    instance_types = list(instance_type)
+    instance_type = instance_types.pop(0) if instance_types else ''
+
+    capacity_specs = None
+    if instance_type == '' and (min_vcpu or min_mem):
+        ## pick type, AZ and bid from the live spot market
+        offers = rank_spot_offers(SpotPriceBook(ctx.client('ec2'), region), min_vcpu=min_vcpu, min_mem=min_mem, rank_by=rank_by)
+        if not offers:
+            raise BaseException(f'no spot prices found for instances with {min_vcpu} vCPUs and {min_mem} GiB in {region}')
+        print_spot_offers(offers, rank_by=rank_by, limit=5)
+
+        if subnet:
+            # subnets already pin the AZs, race the cheapest types across them
+            instance_types = list(dict.fromkeys(offer['instance_type'] for offer in offers))[:3]
+            instance_type = instance_types.pop(0)
+        else:
+            capacity_specs = specs_from_offers(offers, limit=3, spot_price=spot_price, market=bid == 'market')
 
-    if not key_pair_name:
-        key_pair_name = lc_config.EC2_KEY_PAIR_NAME
+    elif instance_type == '':
+        available_instances = ["m5.xlarge","r4.4xlarge","r4.8xlarge","r3.8xlarge","r5d.16xlarge","r5d.24xlarge"]
 
-    if launch:
-        test_credentials()
+        # click.prompt('please choose instance size', default='m5.xlarge')
+        instance_type = click.prompt(
+            'Please choose instance size (small to large):',
+            type=click.Choice([instance for instance in available_instances]),
+            show_default=True,
+        )
 
-        if instance_type == '':
-            available_instances = ["m5.xlarge","r4.4xlarge","r4.8xlarge","r3.8xlarge","r5d.16xlarge","r5d.24xlarge"]
+    if capacity_specs is None and not on_demand:
+        if spot_price is None and bid == 'market':
+            spot_price = market_bid(SpotPriceBook(ctx.client('ec2'), region), [instance_type] + instance_types)
+        print(f'bidding {spot_price} USD/hour' if spot_price else 'bidding up to the on demand price')
 
-            # click.prompt('please choose instance size', default='m5.xlarge')
-            instance_type = click.prompt(
-                'Please choose instance size (small to large):',
-                type=click.Choice([instance for instance in available_instances]),
-                show_default=True,
-            )
+    # print('tagging instance using:')
 
-        # print('tagging instance using:')
+    if not project_path:
+        instance_name = f'{lc_config.FULL_NAME} - Launch Control'
+    else:
+        instance_name = f'{lc_config.FULL_NAME} - {project_name}'
+
+    ttl_seconds = parse_duration(ttl) if ttl else None
+    expires_at = expiry_time(ttl_seconds) if ttl_seconds else None
+    tags = instance_tags(lc_config, instance_name) + lifecycle_tags(ttl_seconds, idle_minutes)
+
+    # print(tags)
+
+    image_id = lc_config.IMAGE_ID
+    if isinstance(project, GitProject) and not fresh:
+        ## boot ready from an image baked with `lc bake` for this commit
+        baked_image_id = find_baked_image(ctx.client('ec2'), project_name, project, region, lc_config.IMAGE_ID)
+        if baked_image_id:
+            print(f'using baked image {baked_image_id}')
+            image_id = baked_image_id
+
+    ec2_factory = ctx.factory()
+
+    ec2_instances = []
+    pool = None
+    if project_name != 'no_project' and not fresh and instance_type and not instance_types and capacity_specs is None:
+        ## start already bootstrapped instances from the warm pool first
+        pool = WarmPool(ec2_factory, project_name, instance_type)
+        ec2_instances = pool.claim(count, tags=tags)
+
+    if len(ec2_instances) < count:
+        ec2_instances += ec2_factory.launch_fleet(
+            count=count - len(ec2_instances),
+            project_name=project_name,
+            on_demand=on_demand,
+            spot_price=spot_price,
+            instance_types=instance_types,
+            subnet_ids=list(subnet),
+            fallback_deadline=fallback_deadline,
+            capacity_specs=capacity_specs,
+            tags=tags,
+            key_pair_name=lc_config.EC2_KEY_PAIR_NAME,
+            aws_profile=lc_config.AWS_PROFILE,
+            aws_region=lc_config.AWS_DEFAULT_REGION,
+            image_id=image_id,
+            instance_type=instance_type,
+            security_group_id=lc_config.SECURITY_GROUP_ID,
+            iam_role_arn=lc_config.IAM_ROLE_ARN
+        )
+
+    if pool is not None and pool.size and len(pool.members()) < pool.size:
+        refill_in_background(project_path, instance_type, region, ctx.profile)
+
+    run_make = False
+    if project_name != 'no_project' and not command and isinstance(project, MakeProject):
+        ## prompt for make command to run once for the whole fleet
+        print('We have detected a Makefile in your project...')
+        run_make = click.confirm('Do you want to launch with Make?')
+        if run_make:
+            make_command = click.prompt('Specify Make command', type=str, default='make run')
+
+    ## bootstrap every instance concurrently; ready -> env vars, git and clone in one script
+    pipeline = bootstrap_pipeline(lc_config, project, concurrency=concurrency, sync_mode=sync_mode, depth=depth, idle_minutes=idle_minutes, expires_at=expires_at)
+    results = pipeline.run(ec2_instances)
+    print_bootstrap_report(results)
+
+    print('readiness timings:')
+    for line in timing_events.summary():
+        print(line)
+
+    failed = [result.instance_id for result in results if not result.ok]
+    ec2_instances = [ec2_instance for ec2_instance in ec2_instances if ec2_instance.instance_id not in failed]
+
+    run_results = []
+    if project_name != 'no_project' and (command or run_make) and ec2_instances:
+        ## if command is provided run that, else detect run policy
+        run_command = ' '.join(command) if command else make_command
+        if isinstance(project, GitProject):
+            run_command = f'cd /home/ubuntu/{project.name} && ' + run_command
 
-        if not project_path:
-            instance_name = f'{lc_config.FULL_NAME} - Launch Control'
-        else:
-            instance_name = f'{lc_config.FULL_NAME} - {project_name}'
-
-        tags = [
-            {'Key':'Name', 'Value': instance_name},
-            {'Key':'Username', 'Value': lc_config.FULL_NAME},
-            {'Key':'Team', 'Value': lc_config.TEAM},
-            {'Key':'Owner', 'Value': lc_config.TEAM},
-            {'Key':'Environment', 'Value': 'production'},
-            {'Key':'Classification', 'Value': 'restricted'},
-            {'Key':'Status', 'Value': 'active'},
-        ]
-
-        # print(tags)
-
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-
-        if not on_demand:
-            ec2_instance = ec2_factory.boto_request_spot_instance(
-                tags=tags,
-                key_pair_name=lc_config.EC2_KEY_PAIR_NAME,
-                aws_profile=lc_config.AWS_PROFILE,
-                aws_region=lc_config.AWS_DEFAULT_REGION,
-                image_id=lc_config.IMAGE_ID,
-                instance_type=instance_type,
-                spot_price=spot_price,
-                security_group_id=lc_config.SECURITY_GROUP_ID,
-                iam_role_arn=lc_config.IAM_ROLE_ARN
-            )
+        if detach:
+            ## one job across the fleet, nothing holds the ssh sessions open
+            job_id, failed = JobRunner(lc_config.EC2_KEY_PAIR_PATH).start(ec2_instances, run_command, project=project_name)
+            print_job_started(job_id, ec2_instances, failed)
 
-        else:
-            ec2_instance = ec2_factory.boto_request_instance(
-                tags = tags,
-                key_pair_name=lc_config.EC2_KEY_PAIR_NAME,
-                aws_profile=lc_config.AWS_PROFILE,
-                aws_region=lc_config.AWS_DEFAULT_REGION,
-                image_id=lc_config.IMAGE_ID,
-                instance_type=instance_type,
-                security_group_id=lc_config.SECURITY_GROUP_ID,
-                iam_role_arn=lc_config.IAM_ROLE_ARN
-            )
-
-        print('request submitted...')
-        ec2_instance.to_yaml(f'{LAUNCH_CONTROL_PROJECT_DIR(project_name=project_name)}/{ec2_instance.instance_id}.yaml')
-
-        print(f'polling instance {ec2_instance.instance_id} untill running...')
-        ec2_factory.poll_instance_until_running(instance_id=ec2_instance.instance_id)
-
-        Path(LAUNCH_CONTROL_PROJECT_DIR(project_name=project_name)).mkdir(parents=True,exist_ok=True)
-
-        ## check if ec2 machine is ready
-        ec2_instance.poll_instance_ready(ssh_key_file=lc_config.EC2_KEY_PAIR_PATH)
-
-        ## setup environment variables
-        env_vars = {
-            'GITHUB_PAT':lc_config.GITHUB_PAT,
-            'BUNDLE_GITHUB__COM':lc_config.GITHUB_PAT,
-            'GIT_USERNAME':lc_config.GIT_USERNAME,
-            'AWS_DEFAULT_REGION':lc_config.AWS_DEFAULT_REGION,
-        }
-
-        ec2_instance._set_environment_variables(env_vars)
-        ec2_instance._setup_git(username=lc_config.GIT_USERNAME,usermail=lc_config.GIT_USEREMAIL)
-
-        # if git project clone on remote ec2 machine
-        if project_name != 'no_project':
-            if isinstance(project, GitProject):
-                project.clone_remote(ec2_instance, ssh_key_file=lc_config.EC2_KEY_PAIR_PATH,pat=lc_config.GITHUB_PAT)
-
-            ## if command is provided run that, else detect run policy
+        elif len(ec2_instances) == 1:
+            ## single host keeps the interactive pseudo terminal
             if command:
-                run_command = ' '.join(command)
-                if isinstance(project, GitProject):
-                    run_command = f'cd /home/ubuntu/{project.name} && ' + run_command
-                
-                ec2_instance.create_ssh_connection(ssh_key_file=lc_config.EC2_KEY_PAIR_PATH)
-                ec2_instance.run_bash_command(run_command,pty=True)
-
+                ec2_instances[0].run_bash_command(run_command,pty=True)
             else:
+                project.run(ec2_instance=ec2_instances[0], ssh_key_file=lc_config.EC2_KEY_PAIR_PATH, *make_command.split())
 
-                if isinstance(project, MakeProject):
-                    ## prompt for make command to run
-                    print('We have detected a Makefile in your project...')
-                    run_make = click.confirm('Do you want to launch with Make?')
-                    if run_make:
-                        make_command = click.prompt('Specify Make command', type=str, default='make run')
-                        project.run(ec2_instance=ec2_instance, ssh_key_file=lc_config.EC2_KEY_PAIR_PATH, *make_command.split())
+        else:
+            ## every host of the fleet runs at once, with host prefixed output
+            run_results = run_parallel(ec2_instances, run_command, ssh_key_file=lc_config.EC2_KEY_PAIR_PATH, parallel=len(ec2_instances))
+            print_summary_table(run_results)
 
-        ## Always print private IP of instance when done
+    ## Always print private IP of instance(s) when done
+    for ec2_instance in ec2_instances:
         private_ip = ec2_instance._get_private_ip_address()
         public_ip = ec2_instance._get_public_ip_address()
-        print('All tasks finished, Private IP adress is:')
+        print(f'All tasks finished for {ec2_instance.instance_id}, Private IP adress is:')
         print(private_ip)
         print('Public IP is:')
         print(public_ip)
-        clean_ip = public_ip.replace('.','-')
-        clean_ip = f'ec2-{clean_ip}.{region}.compute.amazonaws.com'
         print('url is:')
-        print(clean_ip)
-
-    if terminate:
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        ec2_factory.shutdown_project(project_name=project_name)
+        print(public_dns(public_ip, region))
 
-    if terminate_all:
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        ec2_factory.shutdown_all()
-
-
-    if list:
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        ec2_factory.list_instances()
-
-    if ssh:
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        proj_inst, proj_paths = ec2_factory.list_instances(project = project_name,verbose=False)
-
-        instances = proj_inst.get(project_name)
-
-        if instances is None:
-            sys.exit('no instances found for this project')
-
-        if len(instances) > 1:
-            print()
-            choices = []
-            for ins in instances:
-                choices.append(ins)
-
-            instances = click.prompt(
-                'please select instance to run on:',
-                type=click.Choice([instance for instance in choices]),
-            )
-
-        instance = EC2Instance(instances[0], region)
-        ip = instance._get_public_ip_address()
-        clean_ip = ip.replace('.','-')
-        clean_ip = f'ec2-{clean_ip}.{region}.compute.amazonaws.com'
-
-        key_file = ntpath.basename(lc_config.EC2_KEY_PAIR_PATH)
-        run_command = f'ssh -t -i ~/.ssh/{key_file} ubuntu@{clean_ip}'
-        # instance.create_ssh_connection(ssh_key_file=lc_config.EC2_KEY_PAIR_PATH)
-        # instance.run_bash_command(run_command,pty=True)
-
-        ##exit
-        # sys.exit(run_command)
-        print(run_command)
-
-    if info:
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        proj_inst, proj_paths = ec2_factory.list_instances(project = project_name,verbose=False)
-
-        instances = proj_inst.get(project_name)
-
-        if instances is None:
-            sys.exit('no instances found for this project')
-
-        if len(instances) > 1:
-            print()
-            choices = []
-            for ins in instances:
-                choices.append(ins)
-
-            instances = click.prompt(
-                'please select instance to run on:',
-                type=click.Choice([instance for instance in choices]),
-            )
+    print(f'metadata cache saved {metadata_cache.api_calls_saved} EC2 api calls ({metadata_cache.api_calls} made)')
+    print(f'ec2 api: {api_stats.total} call(s), {api_stats.retries} retried, {api_stats.throttled} throttled')
 
-        instance = EC2Instance(instances[0], region)
-        ip = instance._get_public_ip_address()
-        clean_ip = ip.replace('.','-')
-        clean_ip = f'ec2-{clean_ip}.{region}.compute.amazonaws.com'
+    if any(not result.ok for result in run_results):
+        sys.exit(1)
 
-        print(clean_ip)
-
-    if bash:
-
-        if command is None:
-            sys.exit('you must provide a bash command')
-
-        run_command = ' '.join(command)
+@cli.command()
+@click.argument('project_path', default='')
+@click.option('--all', 'terminate_all', is_flag=True, default=False, help='terminate every known instance across all projects')
+@click.option('--wait', is_flag=True, default=False, help='wait for terminated instances before removing their records')
+@click.option('--no_pool', is_flag=True, default=False, help='terminate even when the project has a warm pool with room')
+@pass_context
+def terminate(ctx, project_path='', terminate_all=False, wait=False, no_pool=False):
+    '''terminate all instances of a project, stopping them into its warm pool while it has room'''
+    if terminate_all:
+        ctx.factory().shutdown_all(wait=wait)
+    else:
+        project_name, _ = resolve_project(project_path)
+        if not no_pool and has_pool(project_name):
+            ec2_factory = ctx.factory()
+            release_instances(ec2_factory, project_name, ec2_factory.recorded_instances(project=project_name))
+            print('Done!')
+        else:
+            ctx.factory().shutdown_project(project_name=project_name, wait=wait)
+
+@cli.command()
+@click.option('--dry_run', is_flag=True, default=False, help='only report what would be terminated')
+@click.option('--everyone', is_flag=True, default=False, help='also reap expired instances launched by other people')
+@click.option('--prune', is_flag=True, default=False, help='also drop local records of instances that no longer exist')
+@pass_context
+def reap(ctx, dry_run=False, everyone=False, prune=False):
+    '''terminate expired instances (see `lc launch --ttl`) in bulk'''
+    ctx.check_credentials()
+    reaper = Reaper(ctx.factory(), username=ctx.config.FULL_NAME, everyone=everyone)
+
+    if prune:
+        gone = reaper.prune()
+        print(f'pruned {len(gone)} record(s) of instances that no longer exist')
+
+    rows = reaper.scan()
+    print_reap_report(rows)
+    doomed = [row for row in rows if row['reap']]
+    if dry_run or not doomed:
+        print(f'{len(doomed)} expired instance(s) to reap')
+        return
+
+    reaper.reap(rows)
+
+@cli.command('list')
+@click.option('-o','--output', default='table', type=click.Choice(['table','json','csv']), help='output format')
+@pass_context
+def list_(ctx, output='table'):
+    '''list every known instance with its state, ips, uptime and estimated cost'''
+    ec2_factory = ctx.factory()
+    ec2_factory.print_instance_details(ec2_factory.instance_details(), output=output)
+
+@cli.command()
+@click.option('--min_vcpu', default=0, type=int)
+@click.option('--min_mem', default=0, type=float, help='GiB')
+@click.option('--rank_by', default='vcpu', type=click.Choice(['vcpu', 'mem', 'price']))
+@click.option('-n', '--limit', default=10, type=int)
+@pass_context
+def prices(ctx, min_vcpu=0, min_mem=0, rank_by='vcpu', limit=10):
+    '''rank instance types and AZs by their current spot price'''
+    offers = rank_spot_offers(SpotPriceBook(ctx.client('ec2'), ctx.region), min_vcpu=min_vcpu, min_mem=min_mem, rank_by=rank_by)
+    print_spot_offers(offers, rank_by=rank_by, limit=limit)
+
+@cli.command()
+@click.argument('project_path', default='.')
+@click.option('--instance_type', default='m5.xlarge', help='instance type of the builder')
+@click.option('--build_command', default=None, help='run in the project folder before the snapshot, defaults to `make build` for Makefile projects')
+@click.option('--sync', 'sync_mode', default='clone', type=click.Choice(SYNC_MODES), help='how the project gets onto the builder')
+@click.option('--force', is_flag=True, default=False, help='bake again even if this commit already has an image')
+@click.option('--list', 'list_images', is_flag=True, default=False, help='list the baked images of the project instead')
+@pass_context
+def bake(ctx, project_path='.', instance_type='m5.xlarge', build_command=None, sync_mode='clone', force=False, list_images=False):
+    '''bootstrap and build a project once and snapshot it as an AMI that later launches boot from'''
+    lc_config = ctx.config
+    project_name, project = resolve_project(project_path)
+
+    if list_images:
+        print_baked_images(get_registry().amis(project=project_name))
+        return
+
+    if not isinstance(project, GitProject):
+        sys.exit('bake needs a git project')
+
+    ctx.check_credentials()
+
+    if not force:
+        baked_image_id = find_baked_image(ctx.client('ec2'), project_name, project, ctx.region, lc_config.IMAGE_ID)
+        if baked_image_id:
+            print(f'{project_name} is already baked at this commit as {baked_image_id}, use --force to bake again')
+            return
+
+    baker = ImageBaker(
+        ctx.factory(),
+        project_name,
+        project,
+        bootstrap_pipeline(lc_config, project, sync_mode=sync_mode),
+        base_image_id=lc_config.IMAGE_ID,
+        build_command=build_command or default_build_command(project),
+        org=getattr(lc_config, 'GITHUB_ORG', None),
+    )
+    baker.bake(
+        tags=instance_tags(lc_config, f'{lc_config.FULL_NAME} - {project_name} bake'),
+        key_pair_name=lc_config.EC2_KEY_PAIR_NAME,
+        aws_profile=lc_config.AWS_PROFILE,
+        aws_region=lc_config.AWS_DEFAULT_REGION,
+        instance_type=instance_type,
+        security_group_id=lc_config.SECURITY_GROUP_ID,
+        iam_role_arn=lc_config.IAM_ROLE_ARN,
+    )
+
+@cli.command()
+@click.argument('project_path', default='.')
+@click.option('--instance_type', default='m5.xlarge')
+@click.option('--size', type=int, default=None, help='number of stopped, bootstrapped instances to keep, 0 to disable the pool')
+@click.option('--fill', is_flag=True, default=False, help='launch, bootstrap and stop instances untill the pool is full')
+@click.option('--drain', is_flag=True, default=False, help='terminate every pooled instance')
+@pass_context
+def pool(ctx, project_path='.', instance_type='m5.xlarge', size=None, fill=False, drain=False):
+    '''manage the warm pool of stopped instances launches start from, prints its state by default'''
+    lc_config = ctx.config
+    project_name, project = resolve_project(project_path)
+    warm_pool = WarmPool(ctx.factory(), project_name, instance_type)
+
+    if size is not None:
+        warm_pool.size = size
+        print(f'{project_name} {instance_type} pool size set to {size}')
+
+    if drain:
+        warm_pool.drain()
+
+    if fill:
+        ctx.check_credentials()
+        image_id = lc_config.IMAGE_ID
         if isinstance(project, GitProject):
-            run_command = f'cd /home/ubuntu/{project.name} && ' + run_command
+            image_id = find_baked_image(ctx.client('ec2'), project_name, project, ctx.region, lc_config.IMAGE_ID) or image_id
+        warm_pool.fill(
+            bootstrap_pipeline(lc_config, project),
+            tags=instance_tags(lc_config, f'{lc_config.FULL_NAME} - {project_name} pool'),
+            key_pair_name=lc_config.EC2_KEY_PAIR_NAME,
+            aws_profile=lc_config.AWS_PROFILE,
+            aws_region=lc_config.AWS_DEFAULT_REGION,
+            image_id=image_id,
+            security_group_id=lc_config.SECURITY_GROUP_ID,
+            iam_role_arn=lc_config.IAM_ROLE_ARN,
+        )
+
+    print_pool(get_registry().pool_instances(project=project_name), get_registry().pool_sizes(project=project_name))
+
+@cli.command()
+@click.argument('project_path', default='')
+@pass_context
+def ssh(ctx, project_path=''):
+    '''print the ssh command for an instance of the project'''
+    lc_config = ctx.config
+    project_name, _ = resolve_project(project_path)
+    instances = select_instances(ctx, project_name)
 
-        ec2_factory = EC2InstanceFactory(region=region,profile_name=profile,key_pair_name=key_pair_name)
-        proj_inst, proj_paths = ec2_factory.list_instances(project = project_name,verbose=False)
+    instance = ctx.factory().instance(instances[0])
+    clean_ip = public_dns(instance._get_public_ip_address(), instance.region)
 
-        instances = proj_inst.get(project_name)
+    key_file = ntpath.basename(lc_config.EC2_KEY_PAIR_PATH)
+    mux = MultiplexedConnection(clean_ip, user='ubuntu', key_filename=f'~/.ssh/{key_file}')
+    run_command = ' '.join(mux.ssh_args() + ['-t', mux.target])
 
-        if instances is None:
-            sys.exit('no instances found for this project')
+    print(run_command)
 
-        if len(instances) > 1:
-            print()
-            choices = ['all']
-            for ins in instances:
-                choices.append(ins)
-            instance_choice = click.prompt(
-                'please select instance to run on:',
-                type=click.Choice([instance for instance in choices]),
-            )
+@cli.command()
+@click.argument('project_path', default='')
+@pass_context
+def info(ctx, project_path=''):
+    '''print the public dns name of an instance of the project'''
+    project_name, _ = resolve_project(project_path)
+    instances = select_instances(ctx, project_name)
 
-            if instance_choice != 'all':
-                instances = [instance_choice]
+    instance = ctx.instance(instances[0])
+    print(public_dns(instance._get_public_ip_address(), instance.region))
 
-        for ins in instances:
-            instance = EC2Instance(ins, region)
-            instance.create_ssh_connection(ssh_key_file=lc_config.EC2_KEY_PAIR_PATH)
-            instance.run_bash_command(run_command,pty=True)
+@cli.command()
+@click.argument('project_path', default='')
+@click.argument('command', nargs=-1)
+@click.option('--parallel', default=10, type=int, help='number of instances to run on at the same time')
+@click.option('--fail_fast', is_flag=True, default=False, help='stop starting new hosts once one fails')
+@click.option('--timeout', type=float, help='overall time budget in seconds across all instances')
+@click.option('--detach', is_flag=True, default=False, help='start the command as a background job and return straight away, see `lc logs`')
+@pass_context
+def bash(ctx, project_path='', command=None, parallel=10, fail_fast=False, timeout=None, detach=False):
+    '''run a bash command on one or all instances of the project'''
+    lc_config = ctx.config
+    project_name, project = resolve_project(project_path)
+
+    if not command:
+        sys.exit('you must provide a bash command')
+
+    run_command = ' '.join(command)
+    if isinstance(project, GitProject):
+        run_command = f'cd /home/ubuntu/{project.name} && ' + run_command
+
+    instances = select_instances(ctx, project_name, allow_all=True)
+
+    if detach:
+        ec2_instances = [ctx.factory().instance(ins) for ins in instances]
+        job_id, failed = JobRunner(lc_config.EC2_KEY_PAIR_PATH, parallel=parallel).start(ec2_instances, run_command, project=project_name)
+        print_job_started(job_id, ec2_instances, failed)
+        if failed:
+            sys.exit(1)
+
+    elif len(instances) == 1:
+        ## single host keeps the interactive pseudo terminal
+        instance = ctx.factory().instance(instances[0])
+        instance.create_ssh_connection(ssh_key_file=lc_config.EC2_KEY_PAIR_PATH, multiplex=True)
+        instance.run_bash_command(run_command,pty=True)
 
+    else:
+        results = run_parallel(
+            [ctx.factory().instance(ins) for ins in instances],
+            run_command,
+            ssh_key_file=lc_config.EC2_KEY_PAIR_PATH,
+            parallel=parallel,
+            fail_fast=fail_fast,
+            timeout=timeout,
+        )
+        print_summary_table(results)
+
+        if any(not result.ok for result in results):
+            sys.exit(1)
+
+@cli.command('map')
+@click.argument('project_path', default='')
+@click.argument('command', nargs=-1)
+@click.option('-i', '--items', 'source', required=True, help='file with one work item per line, or a glob of local paths inside the project, passed relative to the project folder')
+@click.option('--slots', default=0, type=int, help='items run at the same time per instance, defaults to its cpu count')
+@click.option('--retries', default=2, type=int, help='times a failed item is run again, on another instance where possible')
+@click.option('--timeout', type=float, help='seconds a single item may run')
+@click.option('--manifest', default=None, help='json lines results manifest, items already ok in an existing one are skipped')
+@pass_context
+def map_(ctx, project_path='', command=None, source=None, slots=0, retries=2, timeout=None, manifest=None):
+    '''run a command template once per work item, spread over every instance of the project'''
+    lc_config = ctx.config
+    project_name, project = resolve_project(project_path)
+
+    if not command:
+        sys.exit('you must provide a command template, e.g. `python fit.py --market {item}`')
+
+    instances = ctx.factory().list_instances(project=project_name, verbose=False).get(project_name)
+    if not instances:
+        sys.exit('no instances found for this project')
+
+    scheduler = MapScheduler(
+        [ctx.factory().instance(ins) for ins in instances],
+        ' '.join(command),
+        load_items(source, root=project.path if isinstance(project, GitProject) else None),
+        ssh_key_file=lc_config.EC2_KEY_PAIR_PATH,
+        project=project_name,
+        cd=f'/home/ubuntu/{project.name}' if isinstance(project, GitProject) else None,
+        slots=slots,
+        retries=retries,
+        timeout=timeout,
+        manifest_path=manifest,
+    )
+    print(f'mapping {len(scheduler.items)} item(s) over {len(instances)} instance(s), logs in {scheduler.log_dir}')
+    scheduler.run()
+    print_map_report(scheduler)
+
+    if any(not item.ok for item in scheduler.items):
+        sys.exit(1)
+
+@cli.command()
+@click.argument('project_path', default='.')
+@click.option('--mode', default='tree', type=click.Choice(SYNC_MODES), help='upload the local working tree, push a git bundle or re-clone the pushed branch')
+@click.option('--full', is_flag=True, default=False, help='send everything instead of only what changed')
+@click.option('--parallel', default=10, type=int, help='number of instances to sync at the same time')
+@pass_context
+def sync(ctx, project_path='.', mode='tree', full=False, parallel=10):
+    '''sync local project code to every instance of the project'''
+    lc_config = ctx.config
+    project_name, project = resolve_project(project_path)
+
+    if not isinstance(project, GitProject):
+        sys.exit('sync needs a git project')
+
+    instances = [ctx.factory().instance(ins) for ins in select_instances(ctx, project_name, allow_all=True)]
+    code_sync = CodeSync(project, mode=mode, pat=lc_config.GITHUB_PAT, org=getattr(lc_config, 'GITHUB_ORG', None), full=full)
+    results = sync_instances(code_sync, instances, ssh_key_file=lc_config.EC2_KEY_PAIR_PATH, parallel=parallel)
+    print_sync_report(instances, results)
+
+    if any(isinstance(result, BaseException) for result in results):
+        sys.exit(1)
+
+def _job_records(job_ids: tuple):
+    records = get_registry().jobs(job_ids=list(job_ids))
+    missing = set(job_ids) - set(record['job_id'] for record in records)
+    if missing:
+        sys.exit(f"unknown job(s) {', '.join(sorted(missing))}, see `lc jobs`")
+    return records
+
+@cli.command()
+@click.argument('project_path', default='')
+@click.option('--active', is_flag=True, default=False, help='only jobs that are still running')
+@click.option('-n', '--limit', default=20, type=int)
+@pass_context
+def jobs(ctx, project_path='', active=False, limit=20):
+    '''list detached jobs, refreshing the state of running ones'''
+    project_name = resolve_project(project_path)[0] if project_path else None
+    records = get_registry().jobs(project=project_name, active=active)[:limit]
+
+    running = [record for record in records if record['state'] == 'running']
+    if running:
+        JobRunner(ctx.config.EC2_KEY_PAIR_PATH).poll(running)
+    print_jobs([record for record in records if record['state'] == 'running'] if active else records)
+
+@cli.command()
+@click.argument('job_id')
+@click.option('-f', '--follow', is_flag=True, default=False, help='keep streaming untill the job finishes')
+@click.option('--instance', 'instance_id', default=None, help='only this instance of a multi instance job')
+@click.option('--interval', default=2, type=float, help='seconds between polls when following')
+@pass_context
+def logs(ctx, job_id, follow=False, instance_id=None, interval=2):
+    '''print the output of a detached job; only bytes not yet downloaded are fetched'''
+    records = [record for record in _job_records((job_id,)) if instance_id is None or record['instance_id'] == instance_id]
+    runner = JobRunner(ctx.config.EC2_KEY_PAIR_PATH)
+
+    if not follow:
+        # catch up on everything written so far without waiting for the job
+        active = [record for record in records if record['state'] == 'running']
+        while active:
+            active = [record for record, _, more in runner.poll(active) if more]
+
+    for record in records:
+        for stream, target in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+            path = local_log_path(record['job_id'], record['instance_id'], stream)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    text = f.read().decode('utf-8', errors='replace')
+                if len(records) > 1:
+                    text = ''.join(f"[{record['instance_id']}] {line}\n" for line in text.splitlines())
+                target.write(text)
+                target.flush()
+
+    if follow:
+        # only bytes past what was printed above
+        runner.follow(records, interval=interval)
+
+    for record in records:
+        if record['state'] != 'running':
+            exit_code = '' if record['exit_code'] is None else f" with exit code {record['exit_code']}"
+            print(f"{record['instance_id']}: {record['state']}{exit_code}", file=sys.stderr)
+
+@cli.command()
+@click.argument('job_ids', nargs=-1, required=True)
+@click.option('--timeout', type=float, default=None, help='give up after this many seconds')
+@click.option('--interval', default=5, type=float, help='seconds between polls')
+@pass_context
+def wait(ctx, job_ids, timeout=None, interval=5):
+    '''wait for detached jobs to finish, exits non zero if any failed, was lost or is still running'''
+    records = JobRunner(ctx.config.EC2_KEY_PAIR_PATH).wait(_job_records(job_ids), interval=interval, timeout=timeout)
+    print_jobs(records)
+
+    if any(record['state'] != 'exited' or record['exit_code'] != 0 for record in records):
+        sys.exit(1)
+
+def _transfer_options(command):
+    for option in reversed([
+        click.option('--include', multiple=True, help='only copy files matching this glob, repeatable'),
+        click.option('--exclude', multiple=True, help='skip files matching this glob, repeatable'),
+        click.option('--streams', default=STREAMS, type=int, help='parallel ssh connections'),
+        click.option('--chunk_mb', default=CHUNK_SIZE // 2 ** 20, type=int, help='files are split into chunks of this many MB'),
+        click.option('--compress', is_flag=True, default=False, help='compress on the wire'),
+    ]):
+        command = option(command)
+    return command
+
+@cli.command()
+@click.argument('project_path')
+@click.argument('local_path')
+@click.argument('remote_path')
+@_transfer_options
+@pass_context
+def push(ctx, project_path, local_path, remote_path, include=(), exclude=(), streams=STREAMS, chunk_mb=64, compress=False):
+    '''copy a local file or directory to the project's instances, resuming partial copies'''
+    lc_config = ctx.config
+    project_name, _ = resolve_project(project_path)
+
+    for instance_id in select_instances(ctx, project_name, allow_all=True):
+        instance = ctx.factory().instance(instance_id)
+        print(f'{instance_id}:')
+        with instance.transfer_engine(lc_config.EC2_KEY_PAIR_PATH, streams=streams, chunk_size=chunk_mb * 2 ** 20, compress=compress, progress=print_throughput) as engine:
+            stats = engine.push(local_path, remote_path, include=list(include), exclude=list(exclude))
+        print()
+        print(stats)
+
+@cli.command()
+@click.argument('project_path')
+@click.argument('remote_path')
+@click.argument('local_path')
+@_transfer_options
+@pass_context
+def pull(ctx, project_path, remote_path, local_path, include=(), exclude=(), streams=STREAMS, chunk_mb=64, compress=False):
+    '''copy a file or directory from the project's instances, into a folder per instance when there are several'''
+    lc_config = ctx.config
+    project_name, _ = resolve_project(project_path)
+
+    instance_ids = select_instances(ctx, project_name, allow_all=True)
+    for instance_id in instance_ids:
+        instance = ctx.factory().instance(instance_id)
+        destination = local_path
+        if len(instance_ids) > 1:
+            destination = os.path.join(local_path, instance_id)
+            os.makedirs(destination, exist_ok=True)
+        print(f'{instance_id}:')
+        with instance.transfer_engine(lc_config.EC2_KEY_PAIR_PATH, streams=streams, chunk_size=chunk_mb * 2 ** 20, compress=compress, progress=print_throughput) as engine:
+            stats = engine.pull(remote_path, destination, include=list(include), exclude=list(exclude))
+        print()
+        print(stats)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,239 @@
+#This module is the api layer every EC2 call goes through; a shared rate limiter, retry budget and per family concurrency caps
+import functools
+import random
+import threading
+import time
+
+from launch_control.trace import tracer
+
+THROTTLING_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+}
+
+# retried without slowing the shared rate down
+TRANSIENT_CODES = {
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+}
+
+# max calls in flight per api family, mutating families are kept low because their EC2 limits are much lower
+FAMILY_CONCURRENCY = {
+    'describe': 8,
+    'launch': 2,
+    'terminate': 4,
+    'mutate': 4,
+}
+
+def api_family(method: str):
+    if method.startswith(('describe_', 'get_', 'list_')):
+        return 'describe'
+    if method in ('run_instances', 'request_spot_instances', 'start_instances', 'create_fleet', 'create_image'):
+        return 'launch'
+    if method.startswith(('terminate_', 'cancel_', 'stop_')):
+        return 'terminate'
+    return 'mutate'
+
+def error_code(error: Exception):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+class TokenBucket:
+    '''
+    Thread safe token bucket shared by every call in the process.
+
+    The refill rate adapts; it halves on a throttling error and creeps back up on success (AIMD).
+    '''
+    def __init__(self, rate: float = 10, capacity: float = 20, min_rate: float = 0.5, max_rate: float = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1):
+        '''block untill `tokens` are available'''
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+class RetryBudget:
+    '''
+    Caps how many retries the process can make so a throttling storm backs off instead of amplifying itself.
+
+    Every retry costs `retry_cost` tokens, every success gives one back.
+    '''
+    def __init__(self, capacity: int = 100, retry_cost: int = 5):
+        self.capacity = capacity
+        self.retry_cost = retry_cost
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.tokens < self.retry_cost:
+                return False
+            self.tokens -= self.retry_cost
+            return True
+
+    def give(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+class ApiStats:
+    def __init__(self):
+        self.calls = {}
+        self.throttled = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def count(self, method: str):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def count_retry(self, throttled: bool):
+        with self._lock:
+            self.retries += 1
+            self.throttled += int(throttled)
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+# shared by every client in the process
+rate_limiter = TokenBucket()
+retry_budget = RetryBudget()
+api_stats = ApiStats()
+_family_semaphores = {family: threading.BoundedSemaphore(limit) for family, limit in FAMILY_CONCURRENCY.items()}
+
+class ApiPaginator:
+    '''paginator that sends every page request through the `ApiClient`, EC2 style NextToken/MaxResults paging'''
+    def __init__(self, api, method: str):
+        self.api = api
+        self.method = method
+
+    def paginate(self, PaginationConfig: dict = None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize')
+        # EC2 rejects MaxResults alongside explicit ids
+        if page_size and not any(key.endswith('Ids') for key in kwargs):
+            kwargs['MaxResults'] = page_size
+
+        while True:
+            page = self.api.call(self.method, **kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+            kwargs['NextToken'] = token
+
+class ApiClient:
+    '''
+    Wraps a boto3 client so every call goes through the shared rate limiter, per family concurrency caps and
+    throttling aware retries with backoff.
+
+    Behaves like the wrapped client (`api.describe_instances(...)`), `acall` runs a call on the default executor
+    for use with asyncio.
+    '''
+    def __init__(self, client, max_attempts: int = 8, base_delay: float = 0.5, max_delay: float = 20, sleep=time.sleep):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def call(self, method: str, **kwargs):
+        with tracer.span(method, 'aws', region=getattr(getattr(self.client, 'meta', None), 'region_name', None)) as span:
+            return self._call(method, span, **kwargs)
+
+    def _call(self, method: str, span: dict, **kwargs):
+        family = _family_semaphores[api_family(method)]
+        attempt = 0
+        while True:
+            rate_limiter.acquire()
+            api_stats.count(method)
+            with family:
+                try:
+                    response = getattr(self.client, method)(**kwargs)
+                except Exception as e:
+                    code = error_code(e)
+                    throttled = code in THROTTLING_CODES
+                    if not throttled and code not in TRANSIENT_CODES:
+                        raise
+                    if throttled:
+                        rate_limiter.throttled()
+
+                    attempt += 1
+                    if attempt >= self.max_attempts or not retry_budget.take():
+                        raise
+                    api_stats.count_retry(throttled)
+                    span['retries'] = attempt
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                else:
+                    rate_limiter.succeeded()
+                    retry_budget.give()
+                    return response
+
+            # back off outside the semaphore so other calls in the family can proceed
+            self.sleep(delay)
+
+    async def acall(self, method: str, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.call, method, **kwargs))
+
+    def get_paginator(self, method: str):
+        return ApiPaginator(self, method)
+
+    def get_waiter(self, name: str):
+        return self.client.get_waiter(name)
+
+    def __getattr__(self, method: str):
+        if method.startswith('_') or not hasattr(self.client, method):
+            raise AttributeError(method)
+        return functools.partial(self.call, method)
+
+def gather(*coroutines, return_exceptions: bool = False):
+    '''run coroutines concurrently from sync code and return their results in order'''
+    # asyncio is slow to import, keep it off the cli startup path
+    import asyncio
+
+    async def _gather():
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+    return asyncio.run(_gather())
+
+def api_client(session, service: str = 'ec2', region: str = None):
+    '''boto3 client built from `session`, wrapped in an `ApiClient`'''
+    from botocore.config import Config
+
+    # retries are owned by `ApiClient`; botocore's own would multiply them
+    config = Config(retries={'mode': 'standard', 'max_attempts': 1}, max_pool_connections=max(FAMILY_CONCURRENCY.values()) * 2)
+    return ApiClient(session.client(service, region_name=region, config=config))
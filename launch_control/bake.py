@@ -0,0 +1,152 @@
+#This module relates to baking projects into AMIs; bootstrap and build once on a builder instance, then boot ready from the snapshot
+import time
+
+from launch_control.aws import error_code
+from launch_control.ec2 import ProvisioningScript
+from launch_control.lifecycle import WATCHDOG_CRON, WATCHDOG_CONF
+from launch_control.project import MakeProject
+from launch_control.registry import get_registry
+from launch_control.sync import git, REMOTE_HOME
+from launch_control.utils import print_table
+
+# warms the docker layer cache so the first `make run` on a baked instance doesn't build from scratch
+DEFAULT_BUILD_COMMAND = 'make build'
+
+# image states that will never become available
+FAILED_IMAGE_STATES = ('invalid', 'deregistered', 'failed', 'error')
+
+def project_commit(project):
+    '''HEAD commit of the project, baked images are keyed by it'''
+    return git(project.path, 'rev-parse', 'HEAD')
+
+def default_build_command(project):
+    return DEFAULT_BUILD_COMMAND if isinstance(project, MakeProject) else None
+
+def find_baked_image(ec2_client, project_name: str, project, region: str, base_image_id: str):
+    '''
+    image id baked for the project's current commit on top of `base_image_id`, None if there is none
+
+    records of images that were deregistered or failed are dropped, an image still pending is ignored
+    '''
+    registry = get_registry()
+    record = registry.ami(project_name, project_commit(project), region, base_image_id)
+    if record is None:
+        return None
+
+    try:
+        images = ec2_client.describe_images(ImageIds=[record['image_id']])['Images']
+    except Exception as e:
+        if not (error_code(e) or '').startswith('InvalidAMIID'):
+            raise
+        images = []
+
+    if not images or images[0]['State'] in FAILED_IMAGE_STATES:
+        registry.remove_ami(record['image_id'])
+        return None
+    if images[0]['State'] != 'available':
+        return None
+
+    return record['image_id']
+
+class ImageBaker:
+    '''
+    Bakes a project into an AMI so later launches skip the slow part of the bootstrap;
+
+    1. launch a single on demand builder instance from the base image
+    2. run the usual bootstrap pipeline (env vars, git config, code) plus a warm build, `make build` for Makefile projects
+    3. remove the credentials the bootstrap wrote, snapshot the builder with `create_image` and wait for the image
+    4. record the image per (project, commit, region, base image) in the registry and terminate the builder
+
+    `lc launch` boots from the baked image while HEAD matches; the provisioning script then only rewrites the env vars
+    and fetches into the existing clone, and the docker build cache is already warm.
+    '''
+    def __init__(self, factory, project_name: str, project, pipeline, base_image_id: str, build_command: str = None, org: str = None):
+        '''
+        factory: EC2InstanceFactory = launches and terminates the builder
+        pipeline: BootstrapPipeline = bootstraps the builder exactly like a regular launch would
+        build_command: str = run in the project folder after the bootstrap, None to skip
+        '''
+        self.factory = factory
+        self.project_name = project_name
+        self.project = project
+        self.pipeline = pipeline
+        self.base_image_id = base_image_id
+        self.build_command = build_command
+        self.org = org
+
+    @property
+    def builder_project(self):
+        # recorded apart from the project so `lc bash`/`lc sync` never pick the builder, `lc terminate --all` still finds it
+        return f'{self.project_name}.bake'
+
+    def scrub_script(self):
+        '''an empty `ProvisioningScript` drops the managed ~/.profile block holding the github pat and other env vars'''
+        script = ProvisioningScript()
+        script.add_lines(
+            f'if [ -d {REMOTE_HOME}/{self.project.name}/.git ]; then git -C {REMOTE_HOME}/{self.project.name} remote set-url origin {self.project.remote_url(None, org=self.org)}; fi',
+            'rm -f ~/.bash_history ~/.git-credentials',
+            # never bake an expiry into the image
+            f'sudo rm -f {WATCHDOG_CRON} {WATCHDOG_CONF}',
+        )
+        return script
+
+    def bake(self, **launch_kwargs):
+        '''build and snapshot the project, returns the new image id'''
+        commit = project_commit(self.project)
+        region = self.factory.region
+
+        print(f'baking {self.project_name} at {commit[:12]} on top of {self.base_image_id}...')
+        builder = self.factory.launch_fleet(count=1, project_name=self.builder_project, on_demand=True, image_id=self.base_image_id, **launch_kwargs)[0]
+
+        try:
+            result = self.pipeline.run([builder])[0]
+            if not result.ok:
+                raise BaseException(f'bootstrapping the builder failed at {result.failed_stage}: {result.error}')
+
+            if self.build_command:
+                print(f'running `{self.build_command}`...')
+                builder.run_bash_command(f'cd {REMOTE_HOME}/{self.project.name} && {self.build_command}')
+
+            builder.provision(self.scrub_script())
+            image_id = self.create_image(builder.instance_id, commit)
+        finally:
+            self.factory.terminate_instances(get_registry().instances(project=self.builder_project))
+
+        get_registry().add_ami(self.project_name, commit, region, self.base_image_id, image_id, build_command=self.build_command)
+        print(f'baked {image_id} for {self.project_name} at {commit[:12]}')
+
+        return image_id
+
+    def create_image(self, instance_id: str, commit: str, delay: int = 15, max_attempts: int = 120):
+        '''snapshot the builder and wait untill the image can be launched'''
+        client = self.factory._ec2_client
+        response = client.create_image(
+            InstanceId=instance_id,
+            Name=f'lc-{self.project_name}-{commit[:12]}-{int(time.time())}',
+            Description=f'launch control bake of {self.project_name} at {commit}',
+            TagSpecifications=[
+                {
+                    'ResourceType': 'image',
+                    'Tags': [
+                        {'Key': 'Project', 'Value': self.project_name},
+                        {'Key': 'Commit', 'Value': commit},
+                        {'Key': 'BaseImage', 'Value': self.base_image_id},
+                    ],
+                },
+            ],
+        )
+        image_id = response['ImageId']
+
+        print(f'waiting for {image_id} to become available...')
+        client.get_waiter('image_available').wait(ImageIds=[image_id], WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+
+        return image_id
+
+def print_baked_images(records: list):
+    header = ['project', 'commit', 'region', 'image_id', 'base_image_id', 'build_command', 'baked']
+    rows = [
+        [record['project'], record['commit_hash'][:12], record['region'], record['image_id'], record['base_image_id'],
+         record['build_command'] or '-', time.strftime('%Y-%m-%d %H:%M', time.localtime(record['created_at']))]
+        for record in records
+    ]
+    print_table(header, rows)
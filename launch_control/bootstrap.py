@@ -0,0 +1,139 @@
+#This module runs the post launch bootstrap stages against many ec2 instances at once
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from launch_control.project import GitProject
+from launch_control.ec2 import ProvisioningScript
+from launch_control.utils import print_table
+from launch_control.sync import multiplexed_connection
+from launch_control.lifecycle import watchdog_lines
+from launch_control.trace import tracer
+
+class BootstrapResult:
+    '''per host outcome of a bootstrap run, with the time spent in each stage'''
+    def __init__(self, instance_id: str):
+        self.instance_id = instance_id
+        self.timings = {}
+        self.failed_stage = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+class BootstrapPipeline:
+    '''
+    Runs the ready -> provision stages for many `EC2Instance` objects on a thread pool.
+
+    The provision stage renders env vars, git config and the project clone into one `ProvisioningScript`,
+    so each host only pays a single remote round trip after it is ready.
+
+    max_workers: int = how many hosts are bootstrapped concurrently
+    code_sync: CodeSync = how the project gets onto the hosts, a shallow clone inside the provisioning script by default;
+        tree and bundle syncs run as an extra `sync` stage
+    idle_minutes: int = minutes of idleness after which the on instance watchdog shuts the host down
+    expires_at: float = epoch seconds after which the watchdog shuts the host down regardless
+    '''
+    def __init__(self, ssh_key_file: str, env_vars: dict = None, git_username: str = None, git_usermail: str = None, project=None, pat: str = None, max_workers: int = 8, code_sync=None, idle_minutes: int = None, expires_at: float = None):
+        self.ssh_key_file = ssh_key_file
+        self.env_vars = env_vars or {}
+        self.git_username = git_username
+        self.git_usermail = git_usermail
+        self.project = project
+        self.pat = pat
+        self.max_workers = max_workers
+        self.code_sync = code_sync
+        self.idle_minutes = idle_minutes
+        self.expires_at = expires_at
+        self.script = None
+
+        self.stages = [
+            ('ready', self._ready),
+            ('provision', self._provision),
+        ]
+        if code_sync is not None and code_sync.mode != 'clone':
+            self.stages.append(('sync', self._sync))
+
+    def _ready(self, ec2_instance):
+        ec2_instance.poll_instance_ready(ssh_key_file=self.ssh_key_file)
+
+    def provisioning_script(self):
+        script = ProvisioningScript().add_environment_variables(self.env_vars)
+        script.add_git_config(username=self.git_username, usermail=self.git_usermail)
+        script.add_lines(*watchdog_lines(self.idle_minutes, self.expires_at))
+        if self.code_sync is not None:
+            if self.code_sync.mode == 'clone':
+                script.add_lines(self.code_sync.clone_command())
+        elif isinstance(self.project, GitProject):
+            script.add_lines(self.project.clone_command(self.pat))
+
+        return script
+
+    def _provision(self, ec2_instance):
+        ec2_instance.provision(self.script)
+
+    def _sync(self, ec2_instance):
+        print(self.code_sync.sync(multiplexed_connection(ec2_instance, self.ssh_key_file)))
+
+    def bootstrap_instance(self, ec2_instance):
+        '''run every stage against a single instance, stopping at the first failure'''
+        result = BootstrapResult(ec2_instance.instance_id)
+
+        for name, stage in self.stages:
+            start = time.monotonic()
+            try:
+                with tracer.span(name, 'bootstrap', target=ec2_instance.instance_id):
+                    stage(ec2_instance)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                result.failed_stage = name
+                result.error = e
+            finally:
+                result.timings[name] = time.monotonic() - start
+
+            if not result.ok:
+                break
+
+        return result
+
+    def run(self, ec2_instances: list):
+        '''bootstrap all instances concurrently, returns a `BootstrapResult` per instance in input order'''
+        # render once locally instead of once per host
+        self.script = self.provisioning_script()
+        if self.code_sync is not None and self.code_sync.mode == 'tree':
+            # hash the local tree once, not once per host
+            self.code_sync.manifest
+
+        with tracer.span('bootstrap', 'bootstrap', hosts=len(ec2_instances)), ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+            results = list(pool.map(self.bootstrap_instance, ec2_instances))
+
+        return results
+
+def print_bootstrap_report(results: list):
+    '''print per host stage timings and failures'''
+    if not results:
+        return
+
+    stage_names = []
+    for result in results:
+        for name in result.timings:
+            if name not in stage_names:
+                stage_names.append(name)
+
+    header = ['instance_id'] + stage_names + ['total', 'status']
+    rows = []
+    for result in results:
+        row = [result.instance_id]
+        row += [f'{result.timings[name]:.1f}s' if name in result.timings else '-' for name in stage_names]
+        row.append(f'{result.total:.1f}s')
+        row.append('ok' if result.ok else f'failed at {result.failed_stage}: {result.error}')
+        rows.append(row)
+
+    print()
+    print_table(header, rows)
+    print()
@@ -0,0 +1,77 @@
+#This module caches ec2 instance metadata locally so ip and state lookups don't hit the EC2 api every time
+import threading
+import time
+
+from launch_control.registry import get_registry
+
+# state changes often, ips only change on stop/start which invalidate the cache
+STATE_TTL = 30
+IP_TTL = 3600
+
+def metadata_from_description(description: dict):
+    '''pick the fields we cache out of a `describe_instances` instance description'''
+    launch_time = description.get('LaunchTime')
+    return {
+        'state': description['State']['Name'],
+        'private_ip_address': description.get('PrivateIpAddress'),
+        'public_ip_address': description.get('PublicIpAddress'),
+        'instance_type': description.get('InstanceType'),
+        'launch_time': launch_time.isoformat() if hasattr(launch_time, 'isoformat') else launch_time,
+    }
+
+class MetadataCache:
+    '''
+    Keeps instance metadata in memory and in the local registry so it survives across lc invocations.
+
+    api_calls counts describe calls made, api_calls_saved counts lookups served from the cache instead.
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.api_calls = 0
+        self.api_calls_saved = 0
+
+    def _load(self, instance_id: str):
+        record = get_registry().get(instance_id)
+        return None if record is None else record['metadata']
+
+    def get(self, instance_id: str, max_age: float = STATE_TTL):
+        '''cached metadata if younger than `max_age` seconds, else None'''
+        with self._lock:
+            entry = self._entries.get(instance_id)
+        if entry is None:
+            entry = self._load(instance_id)
+            if entry is not None:
+                with self._lock:
+                    self._entries[instance_id] = entry
+
+        if entry is None or self.clock() - entry.get('cached_at', 0) > max_age:
+            return None
+
+        with self._lock:
+            self.api_calls_saved += 1
+        return entry
+
+    def put(self, instance_id: str, metadata: dict):
+        entry = dict(metadata, cached_at=self.clock())
+        with self._lock:
+            self._entries[instance_id] = entry
+
+        get_registry().set_metadata(instance_id, entry)
+
+        return entry
+
+    def invalidate(self, instance_id: str):
+        '''drop the cached entry, e.g. on a state transition we caused'''
+        with self._lock:
+            self._entries.pop(instance_id, None)
+
+        get_registry().set_metadata(instance_id, None)
+
+    def count_api_call(self, n: int = 1):
+        with self._lock:
+            self.api_calls += n
+
+# process wide cache used by `EC2Instance`
+metadata_cache = MetadataCache()
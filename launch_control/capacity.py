@@ -0,0 +1,210 @@
+#This module relates to finding ec2 capacity; racing spot requests across instance types and subnets with an on demand fallback
+from launch_control.aws import error_code, gather
+from launch_control.readiness import Backoff, DeadlineExceeded, timing_events
+from launch_control.pricing import max_price_kwargs
+
+# run_instances/request_spot_instances errors that mean "try the next instance type or subnet"
+CAPACITY_ERROR_CODES = {
+    'InsufficientInstanceCapacity',
+    'InsufficientHostCapacity',
+    'InsufficientCapacity',
+    'InsufficientFreeAddressesInSubnet',
+    'Unsupported',
+    'InvalidParameterCombination',
+    'SpotMaxPriceTooLow',
+    'MaxSpotInstanceCountExceeded',
+}
+
+# a spot request in one of these will never fulfil
+FINISHED_SPOT_STATES = ('cancelled', 'failed', 'closed')
+
+class CapacitySpec:
+    '''
+    one acceptable (instance type, subnet or AZ) combination, lower priority is preferred
+
+    spot_price: str = bid for this combination, the launcher's `spot_price` when None
+    '''
+    def __init__(self, instance_type: str, subnet_id: str = None, priority: int = 0, availability_zone: str = None, spot_price: str = None):
+        self.instance_type = instance_type
+        self.subnet_id = subnet_id
+        self.priority = priority
+        self.availability_zone = availability_zone
+        self.spot_price = spot_price
+        self.request_ids = []
+
+    def __repr__(self):
+        return f'{self.instance_type}@{self.subnet_id or self.availability_zone or "default"}'
+
+    def launch_specification(self, image_id: str, key_pair_name: str, security_group_id: str, iam_role_arn: str):
+        specification = {
+            'SecurityGroupIds': [security_group_id],
+            'IamInstanceProfile': {'Arn': iam_role_arn},
+            'ImageId': image_id,
+            'InstanceType': self.instance_type,
+            'KeyName': key_pair_name,
+        }
+        if self.subnet_id:
+            # a subnet pins the request to its AZ
+            specification['SubnetId'] = self.subnet_id
+        elif self.availability_zone:
+            specification['Placement'] = {'AvailabilityZone': self.availability_zone}
+
+        return specification
+
+def specs_from_offers(offers: list, limit: int = 3, spot_price: str = None, market: bool = False):
+    '''
+    `CapacitySpec`s for the `limit` best offers of `rank_spot_offers`
+
+    each bids `spot_price` when given, else its offer's market bid with `market`, else up to the on demand price
+    '''
+    return [
+        CapacitySpec(offer['instance_type'], availability_zone=offer['availability_zone'], spot_price=spot_price or (offer['bid'] if market else None))
+        for offer in offers[:limit]
+    ]
+
+class CapacityLauncher:
+    '''
+    Launches `count` instances of the first (instance type, subnet) combination that has capacity.
+
+    One spot request per combination is submitted at once, the most preferred combination that is fully fulfilled wins and
+    every other request is cancelled (with any instances it already started terminated). If no combination fulfils within
+    `fallback_deadline` seconds the combinations are tried in order as on demand instances.
+
+    instance_types: list = acceptable instance types, most preferred first
+    subnet_ids: list = acceptable subnets (one per AZ), most preferred first, None for the account default
+    on_demand_fallback: bool = try on demand once spot capacity could not be found
+    specs: list = explicit `CapacitySpec`s in order of preference, appended after the instance_types x subnet_ids ones
+    '''
+    def __init__(self, factory, instance_types: list, subnet_ids: list = None, spot_price: str = None, fallback_deadline: float = 300, on_demand_fallback: bool = True, backoff: Backoff = None, specs: list = None):
+        self.factory = factory
+        self.client = factory._ec2_client
+        self.spot_price = spot_price
+        self.fallback_deadline = fallback_deadline
+        self.on_demand_fallback = on_demand_fallback
+        self.backoff = backoff
+
+        self.specs = []
+        for instance_type in instance_types:
+            for subnet_id in (subnet_ids or [None]):
+                self.specs.append(CapacitySpec(instance_type, subnet_id, priority=len(self.specs)))
+        for spec in specs or []:
+            spec.priority = len(self.specs)
+            self.specs.append(spec)
+
+    def launch(self, count: int, tags: list, image_id: str, key_pair_name: str, security_group_id: str, iam_role_arn: str, on_demand: bool = False, **kwargs):
+        '''returns `count` `EC2Instance` objects, tagged with `tags`'''
+        launch_kwargs = dict(image_id=image_id, key_pair_name=key_pair_name, security_group_id=security_group_id, iam_role_arn=iam_role_arn)
+
+        if not on_demand:
+            instances = self.race_spot(count, tags, **launch_kwargs)
+            if instances:
+                return instances
+            if not self.on_demand_fallback:
+                raise BaseException(f'no spot capacity for {count} x any of {self.specs}')
+            print(f'no spot capacity within {self.fallback_deadline}s, falling back to on demand')
+
+        return self.first_on_demand(count, tags, **launch_kwargs)
+
+    async def _request_spot(self, spec: CapacitySpec, count: int, **launch_kwargs):
+        try:
+            response = await self.client.acall(
+                'request_spot_instances',
+                InstanceCount=count,
+                LaunchSpecification=spec.launch_specification(**launch_kwargs),
+                **max_price_kwargs(spec.spot_price or self.spot_price),
+            )
+        except Exception as e:
+            if error_code(e) not in CAPACITY_ERROR_CODES:
+                raise
+            print(f'spot {spec}: {error_code(e)}')
+            return
+        spec.request_ids = [request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']]
+
+    def race_spot(self, count: int, tags: list, **launch_kwargs):
+        '''submit a spot request per spec at once and keep the most preferred one that fulfils, None if none did in time'''
+        gather(*[self._request_spot(spec, count, **launch_kwargs) for spec in self.specs])
+        submitted = [spec for spec in self.specs if spec.request_ids]
+        if not submitted:
+            return None
+        print('Spot request(s) ' + ', '.join(f'{spec}: {",".join(spec.request_ids)}' for spec in submitted))
+
+        backoff = self.backoff or Backoff(initial=2, max_delay=10, deadline=self.fallback_deadline)
+        winner = None
+        requests = {}
+        try:
+            with timing_events.phase('spot_capacity', ','.join(map(str, submitted))) as event:
+                for attempt in backoff:
+                    event['attempts'] = attempt + 1
+                    requests = self._describe_requests([request_id for spec in submitted for request_id in spec.request_ids])
+
+                    for spec in submitted:
+                        states = [requests[request_id]['State'] for request_id in spec.request_ids if request_id in requests]
+                        if len(states) == count and all(state == 'active' for state in states):
+                            winner = spec
+                            break
+                    if winner is not None:
+                        break
+
+                    # stop waiting once every request has failed or been closed
+                    if requests and all(request['State'] in FINISHED_SPOT_STATES for request in requests.values()):
+                        break
+        except DeadlineExceeded:
+            pass
+
+        losers = [spec for spec in submitted if spec is not winner]
+        self.release(losers)
+
+        if winner is None:
+            return None
+
+        print(f'spot capacity found for {count} x {winner}')
+        instance_ids = [requests[request_id]['InstanceId'] for request_id in winner.request_ids]
+        self.client.create_tags(Resources=instance_ids, Tags=tags)
+        return self.factory._track_instances(instance_ids, dict(zip(instance_ids, winner.request_ids)))
+
+    def _describe_requests(self, request_ids: list):
+        try:
+            response = self.client.describe_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+        except Exception as e:
+            # freshly created requests are eventually consistent
+            if 'InvalidSpotInstanceRequestID.NotFound' in str(e):
+                return {}
+            raise
+        return {request['SpotInstanceRequestId']: request for request in response['SpotInstanceRequests']}
+
+    def release(self, specs: list):
+        '''cancel the spot requests of `specs` and terminate any instance they already started'''
+        request_ids = [request_id for spec in specs for request_id in spec.request_ids]
+        if not request_ids:
+            return
+        before = self._describe_requests(request_ids)
+        self.client.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+
+        # describe again after cancelling so requests fulfilled in the meantime are caught too
+        after = self._describe_requests(request_ids)
+        stray = sorted(set(request['InstanceId'] for request in list(before.values()) + list(after.values()) if request.get('InstanceId')))
+        if stray:
+            self.client.terminate_instances(InstanceIds=stray)
+        print(f'cancelled {len(request_ids)} spot request(s), terminated {len(stray)} surplus instance(s)')
+
+    def first_on_demand(self, count: int, tags: list, image_id: str, key_pair_name: str, security_group_id: str, iam_role_arn: str):
+        '''try each spec in order as on demand instances, the first with capacity wins'''
+        for spec in self.specs:
+            try:
+                response = self.client.run_instances(
+                    MinCount=count,
+                    MaxCount=count,
+                    InstanceInitiatedShutdownBehavior='terminate',
+                    TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}],
+                    **spec.launch_specification(image_id, key_pair_name, security_group_id, iam_role_arn),
+                )
+            except Exception as e:
+                if error_code(e) not in CAPACITY_ERROR_CODES:
+                    raise
+                print(f'on demand {spec}: {error_code(e)}')
+                continue
+
+            print(f'on demand capacity found for {count} x {spec}')
+            return self.factory._track_instances([instance['InstanceId'] for instance in response['Instances']])
+
+        raise BaseException(f'no capacity for {count} x any of {self.specs}')
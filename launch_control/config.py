@@ -1,7 +1,5 @@
 #Module repsonsible for managing the config and context of the local lc setup
-import yaml
-
-from launch_control.utils import write_yaml
+from launch_control.utils import read_yaml, write_yaml
 from launch_control.vars import LAUNCH_CONTROL_CONFIG
 
 def load_lc_config(config_path: str = LAUNCH_CONTROL_CONFIG()):
@@ -22,8 +20,7 @@ class _BasicConfig:
         write_yaml(contents,path)
 
     def from_yaml(self,path=None):
-        with open(path) as f:
-            config = yaml.load(f)
+        config = read_yaml(path)
         self.update(**config)
 
 class LaunchControlConfig(_BasicConfig):
@@ -0,0 +1,229 @@
+#This module manages ssh connections to ec2 instances so they can be reused instead of re-handshaking for every command
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from launch_control.vars import LAUNCH_CONTROL_DIR
+
+class RemoteCommandError(BaseException):
+    '''raised when a remote command exits non zero and `warn` was not set'''
+    def __init__(self, result):
+        self.result = result
+        super().__init__(f'command exited with {result.exited} on {result.host}: {result.command}')
+
+class RemoteCommandTimeout(BaseException):
+    '''raised when a remote command runs past its `timeout`'''
+
+class MultiplexedResult:
+    def __init__(self, host: str, command: str, exited: int, stdout: str = '', stderr: str = ''):
+        self.host = host
+        self.command = command
+        self.exited = exited
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.exited == 0
+
+    def __bool__(self):
+        return self.ok
+
+def _pump(pipe, stream, buffer: list):
+    for line in iter(pipe.readline, ''):
+        buffer.append(line)
+        if stream is not None:
+            stream.write(line)
+            stream.flush()
+    pipe.close()
+
+class MultiplexedConnection:
+    '''
+    Runs commands through the OpenSSH client sharing a ControlMaster socket under ~/.launch_control/cm.
+
+    The master outlives the lc process (ControlPersist), so repeated `lc bash` calls against the same host skip the handshake.
+    Mirrors the subset of `fabric.Connection.run` that launch control uses.
+    '''
+    def __init__(self, host: str, user: str, key_filename: str, control_persist: str = '10m'):
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.control_persist = control_persist
+
+    @staticmethod
+    def available():
+        return shutil.which('ssh') is not None
+
+    @property
+    def control_dir(self):
+        return f'{LAUNCH_CONTROL_DIR()}/cm'
+
+    @property
+    def target(self):
+        return f'{self.user}@{self.host}'
+
+    def ssh_args(self):
+        Path(self.control_dir).mkdir(parents=True, exist_ok=True)
+        return [
+            'ssh',
+            '-i', os.path.expanduser(self.key_filename),
+            '-o', 'ControlMaster=auto',
+            # %C is a hash of host/port/user so the socket path stays short
+            '-o', f'ControlPath={self.control_dir}/%C',
+            '-o', f'ControlPersist={self.control_persist}',
+            '-o', 'StrictHostKeyChecking=accept-new',
+            '-o', 'ConnectTimeout=10',
+        ]
+
+    def is_alive(self):
+        '''true if a master connection for this host is already running'''
+        result = subprocess.run(self.ssh_args() + ['-O', 'check', self.target], capture_output=True)
+        return result.returncode == 0
+
+    def run(self, command: str, pty=False, hide=False, warn=False, out_stream=None, err_stream=None, timeout=None):
+        args = self.ssh_args() + (['-tt'] if pty else ['-T']) + [self.target, command]
+
+        if not hide and out_stream is None and err_stream is None:
+            # hand the terminal straight to ssh so interactive commands keep working
+            try:
+                exited = subprocess.run(args, timeout=timeout).returncode
+            except subprocess.TimeoutExpired:
+                raise RemoteCommandTimeout(f'command did not complete within {timeout}s on {self.host}')
+            result = MultiplexedResult(self.host, command, exited)
+        else:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+            stdout, stderr = [], []
+            pumps = [
+                threading.Thread(target=_pump, args=(process.stdout, None if hide else (out_stream or sys.stdout), stdout), daemon=True),
+                threading.Thread(target=_pump, args=(process.stderr, None if hide else (err_stream or sys.stderr), stderr), daemon=True),
+            ]
+            for pump in pumps:
+                pump.start()
+            try:
+                exited = process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                raise RemoteCommandTimeout(f'command did not complete within {timeout}s on {self.host}')
+            finally:
+                for pump in pumps:
+                    pump.join()
+            result = MultiplexedResult(self.host, command, exited, ''.join(stdout), ''.join(stderr))
+
+        if not result.ok and not warn:
+            raise RemoteCommandError(result)
+
+        return result
+
+    def upload(self, command: str, stream, timeout=None):
+        '''run `command` on the host with the binary file object `stream` as its stdin, e.g. `tar -x`'''
+        process = subprocess.run(self.ssh_args() + ['-T', self.target, command], stdin=stream, capture_output=True, timeout=timeout)
+        result = MultiplexedResult(self.host, command, process.returncode, process.stdout.decode(errors='replace'), process.stderr.decode(errors='replace'))
+        if not result.ok:
+            raise RemoteCommandError(result)
+
+        return result
+
+    def close(self):
+        # the master is meant to outlive this process; use `stop` to tear it down
+        pass
+
+    def stop(self):
+        subprocess.run(self.ssh_args() + ['-O', 'exit', self.target], capture_output=True)
+
+class ConnectionPool:
+    '''
+    Keeps ssh connections keyed by (instance_id, user, key) for reuse within a process.
+
+    Connections are health checked before being handed out and closed once idle for `idle_timeout` seconds.
+    '''
+    def __init__(self, idle_timeout: float = 300, clock=time.monotonic):
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._connections = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_healthy(connection):
+        if isinstance(connection, MultiplexedConnection):
+            # the ssh client re-establishes the master on demand
+            return True
+
+        if not connection.is_connected:
+            # never opened yet, fabric connects lazily on first use
+            return connection.client.get_transport() is None
+        transport = connection.client.get_transport()
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return transport.is_active()
+
+    def get(self, instance_id: str, user: str, key_filename: str, host=None, multiplex: bool = False):
+        '''
+        returns a live connection for the key, creating one if needed
+
+        host: str or callable = ip to connect to, only resolved when a new connection has to be made
+        multiplex: bool = use the OpenSSH ControlMaster backed connection that persists across lc invocations
+        '''
+        multiplex = multiplex and MultiplexedConnection.available()
+        key = (instance_id, user, key_filename, multiplex)
+
+        self.evict_idle()
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and not self.is_healthy(connection):
+                connection.close()
+                connection = None
+
+            if connection is None:
+                self.misses += 1
+                ip = host() if callable(host) else host
+                if multiplex:
+                    connection = MultiplexedConnection(ip, user=user, key_filename=key_filename)
+                else:
+                    import fabric
+                    connection = fabric.Connection(ip, user=user, connect_kwargs={'key_filename': [key_filename]})
+                self._connections[key] = connection
+            else:
+                self.hits += 1
+
+            self._last_used[key] = self.clock()
+
+        return connection
+
+    def evict_idle(self):
+        now = self.clock()
+        with self._lock:
+            for key in [key for key, used in self._last_used.items() if now - used > self.idle_timeout]:
+                self._connections.pop(key).close()
+                self._last_used.pop(key)
+
+    def discard(self, instance_id: str):
+        '''drop every connection to an instance, e.g. after it is terminated'''
+        with self._lock:
+            for key in [key for key in self._connections if key[0] == instance_id]:
+                self._connections.pop(key).close()
+                self._last_used.pop(key, None)
+
+    def close_all(self):
+        with self._lock:
+            for connection in self._connections.values():
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            self._connections.clear()
+            self._last_used.clear()
+
+# process wide pool used by `EC2Instance.create_ssh_connection`
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
@@ -0,0 +1,117 @@
+#Module responsible for the state shared by lc subcommands; config, boto3 sessions, clients and factories
+import os
+import sys
+
+from launch_control.config import load_lc_config
+from launch_control.vars import LAUNCH_CONTROL_CONFIG
+
+class LaunchControlContext:
+    '''
+    Shared context object for the lc subcommands.
+
+    The config, boto3 sessions, clients and `EC2InstanceFactory` objects are built lazily, at most once per process,
+    and cached per (region, profile), so chaining several subcommands pays for botocore loading and endpoint resolution once.
+    '''
+    def __init__(self, region: str = None, profile: str = None, key_pair_name: str = None):
+        self._region = region
+        self._profile = profile
+        self._key_pair_name = key_pair_name
+        self._config = None
+        self._sessions = {}
+        self._clients = {}
+        self._factories = {}
+        self._credentials_checked = False
+
+    @property
+    def config(self):
+        if self._config is None:
+            try:
+                self._config = load_lc_config(LAUNCH_CONTROL_CONFIG())
+            except:
+                sys.exit('could not load credentials... Have you run `lc configure`?')
+        return self._config
+
+    @property
+    def region(self):
+        return self._region or self.config.AWS_DEFAULT_REGION
+
+    @property
+    def profile(self):
+        return self._profile or self.config.AWS_PROFILE
+
+    @property
+    def key_pair_name(self):
+        return self._key_pair_name or self.config.EC2_KEY_PAIR_NAME
+
+    def session(self, region: str = None, profile: str = None):
+        region = region or self.region
+        profile = profile or self.profile
+        key = (region, profile)
+        if key not in self._sessions:
+            import boto3
+            session = boto3.session.Session(profile_name=profile, region_name=region)
+            if boto3.DEFAULT_SESSION is None:
+                # lets `EC2Instance` lookups share the same loader and profile
+                boto3.DEFAULT_SESSION = session
+            self._sessions[key] = session
+        return self._sessions[key]
+
+    def client(self, service: str = 'ec2', region: str = None, profile: str = None):
+        region = region or self.region
+        profile = profile or self.profile
+        key = (service, region, profile)
+        if key not in self._clients:
+            from launch_control.aws import api_client
+            self._clients[key] = api_client(self.session(region, profile), service, region)
+        return self._clients[key]
+
+    def factory(self, region: str = None, profile: str = None):
+        from launch_control.ec2 import EC2InstanceFactory
+
+        region = region or self.region
+        profile = profile or self.profile
+        key = (region, profile)
+        if key not in self._factories:
+            factory = EC2InstanceFactory(region=region, profile_name=profile, key_pair_name=self.key_pair_name, session=self.session(region, profile))
+            # share clients with the context rather than building a second set
+            factory._clients[region] = self.client('ec2', region, profile)
+            self._factories[key] = factory
+        return self._factories[key]
+
+    def instance(self, instance_id: str):
+        '''
+        `EC2Instance` in the region the instance was recorded in
+
+        unlike `factory().instance` this only loads the config (and with it yaml) for instances without a recorded region,
+        so `lc info` on a metadata cache hit never imports boto3 or yaml
+        '''
+        from launch_control.ec2 import EC2Instance
+        from launch_control.registry import get_registry
+
+        record = get_registry().get(instance_id)
+        return EC2Instance(instance_id, (record and record['region']) or self.region)
+
+    def check_credentials(self):
+        '''raises if the aws credentials for the current profile have expired, checked once per process'''
+        if self._credentials_checked:
+            return
+        try:
+            self.client('sts').get_caller_identity()
+        except Exception as e:
+            raise BaseException(f'\nCould not validate aws credentials ({e})... \nHave they expired? \nTry running gimme-aws-creds to refresh them.')
+        self._credentials_checked = True
+
+def resolve_project(project_path: str):
+    '''returns (project_name, project) for a project path, ('no_project', None) when no path is given'''
+    from launch_control.project import detect_create_project
+
+    if not project_path:
+        return 'no_project', None
+
+    if project_path == '.':
+        project_path = os.getcwd()
+
+    project_name = os.path.basename(os.path.abspath(project_path))
+    project = detect_create_project(project_path)
+
+    return project_name, project
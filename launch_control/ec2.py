@@ -1,18 +1,97 @@
 #This module relates to classes and functions that interact with ec2
-import os
-from os import listdir
-from os.path import isfile, isdir, join
 import textwrap
-import time
-from pathlib import Path
-import shutil
-import boto3
-import yaml
-import fabric
-
-from launch_control.vars import LAUNCH_CONTROL_INSTANCE_DIR
-from launch_control.utils import read_yaml, write_yaml
-from launch_control.project import Project
+import shlex
+import sys
+import csv
+import json
+import datetime
+
+from launch_control.utils import read_yaml, write_yaml, print_table
+from launch_control.pricing import estimate_cost, max_price_kwargs
+from launch_control.connections import connection_pool
+from launch_control.registry import get_registry
+from launch_control.cache import metadata_cache, metadata_from_description, STATE_TTL, IP_TTL
+from launch_control.readiness import Backoff, DeadlineExceeded, wait_for_ssh, poll_spot_requests, poll_instances_state
+from launch_control.aws import api_client, gather
+from launch_control.trace import traced
+
+_ec2_resources = {}
+
+def _ec2_resource(region: str):
+    '''one boto3 ec2 resource per region for the lifetime of the process, built from the default session'''
+    if region not in _ec2_resources:
+        import boto3
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        _ec2_resources[region] = boto3.DEFAULT_SESSION.resource('ec2', region_name=region)
+    return _ec2_resources[region]
+
+_ec2_apis = {}
+
+def _ec2_api(region: str):
+    '''one rate limited `ApiClient` per region for the lifetime of the process, built from the default session'''
+    if region not in _ec2_apis:
+        import boto3
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        _ec2_apis[region] = api_client(boto3.DEFAULT_SESSION, 'ec2', region)
+    return _ec2_apis[region]
+
+class ProvisioningScript:
+    '''
+    Collects environment variables, git config and arbitrary setup lines and renders them into one idempotent bash script.
+
+    Environment variables are written to a managed block in ~/.profile which is replaced on every run instead of appended to.
+    '''
+    BLOCK_START = '# >>> launch_control managed block >>>'
+    BLOCK_END = '# <<< launch_control managed block <<<'
+
+    def __init__(self):
+        self.environment_variables = {}
+        self.git_config = {}
+        self.lines = []
+
+    def add_environment_variables(self, environment_variables: dict):
+        self.environment_variables.update(environment_variables)
+        return self
+
+    def add_git_config(self, username: str = None, usermail: str = None, **config):
+        if username:
+            config['user.name'] = username
+        if usermail:
+            config['user.email'] = usermail
+        self.git_config.update(config)
+        return self
+
+    def add_lines(self, *lines):
+        self.lines.extend(lines)
+        return self
+
+    def render(self):
+        script = ['set -e', 'touch ~/.profile']
+
+        # drop the previous managed block and write a fresh one
+        script.append(f"sed -i '/^{self.BLOCK_START}$/,/^{self.BLOCK_END}$/d' ~/.profile")
+        if self.environment_variables:
+            script.append("cat >> ~/.profile <<'LC_PROFILE'")
+            script.append(self.BLOCK_START)
+            script += [f'export {key}={shlex.quote(str(value))}' for key, value in self.environment_variables.items()]
+            script.append(self.BLOCK_END)
+            script.append('LC_PROFILE')
+
+        script += [f'git config --global {key} {shlex.quote(str(value))}' for key, value in self.git_config.items()]
+
+        if self.lines:
+            # ~/.profile is not written with `set -e` in mind
+            script += ['set +e', 'source ~/.profile', 'set -e']
+            script += [textwrap.dedent(line).strip() for line in self.lines]
+
+        return '\n'.join(script) + '\n'
+
+# instance-id filter values per describe call
+DESCRIBE_BATCH_SIZE = 200
+# instance ids per terminate_instances call
+TERMINATE_BATCH_SIZE = 1000
 
 class EC2Instance:
     '''This class defines an object that represents a running/created ec2 instance'''
@@ -21,40 +100,57 @@ class EC2Instance:
         self.region = region
 
     def get_instance(self):
-        _ec2 = boto3.resource('ec2', region_name=self.region)
+        _ec2 = _ec2_resource(self.region)
         _instance = _ec2.Instance(self.instance_id)
 
         return _instance
 
-    def create_ssh_connection(self, ssh_key_file: str):
+    def get_metadata(self, max_age: float = STATE_TTL):
+        '''state, ips, type and launch time; served from `metadata_cache` when younger than `max_age` seconds'''
+        metadata = metadata_cache.get(self.instance_id, max_age=max_age)
+        if metadata is None:
+            response = _ec2_api(self.region).describe_instances(InstanceIds=[self.instance_id])
+            metadata_cache.count_api_call()
+            metadata = metadata_cache.put(self.instance_id, metadata_from_description(response['Reservations'][0]['Instances'][0]))
+
+        return metadata
+
+    @traced('ssh')
+    def create_ssh_connection(self, ssh_key_file: str, multiplex: bool = False):
         '''
         ssh_key_file: str = name of the file to use in ~/.ssh
+        multiplex: bool = go through an OpenSSH ControlMaster socket that is reused by later lc invocations
+
+        connections are shared through `connection_pool`, so repeated calls reuse the live connection
         '''
         # ip = self._get_public_ip_address()
-        ip = self._get_private_ip_address()
-        ssh_con = fabric.Connection(ip, user="ubuntu", connect_kwargs={'key_filename': [ssh_key_file]})
-        self.ssh_con = ssh_con
+        self.ssh_con = connection_pool.get(
+            self.instance_id,
+            user='ubuntu',
+            key_filename=ssh_key_file,
+            host=self._get_private_ip_address,
+            multiplex=multiplex,
+        )
 
-    def poll_instance_ready(self, ssh_key_file: str, max_retries = 13):
-        '''tests ssh connection untill machine responds'''
+    @traced('ssh')
+    def poll_instance_ready(self, ssh_key_file: str, deadline: float = 180, backoff: Backoff = None):
+        '''waits for port 22 with cheap tcp probes, then tests the ssh connection untill machine responds'''
 
         self.create_ssh_connection(ssh_key_file=ssh_key_file)
-        #check if instance is available
-        response = ''
-        retries = 0
-        while not response:
-            try:
-                response = self.run_bash_command('uname',pty=True)
-            except:
-                if retries == 0: 
-                    print('No response yet, double check your VPN is connected')
-                time.sleep(5)
-            finally:
-                retries += 1
-                if retries > max_retries:
-                    self.terminate()
-                    raise BaseException(f'tried {retries} times and could not connect to ec2 instance, terminating...')
-                    break
+        backoff = backoff or Backoff(initial=1, max_delay=10, deadline=deadline)
+
+        try:
+            wait_for_ssh(
+                self.ssh_con.host,
+                ssh_check=lambda: self.ssh_con.run('uname', hide=True),
+                # fabric picks up a Port from ~/.ssh/config
+                port=getattr(self.ssh_con, 'port', 22),
+                backoff=backoff,
+            )
+        except DeadlineExceeded:
+            print('No response, double check your VPN is connected')
+            self.terminate()
+            raise BaseException(f'could not connect to ec2 instance within {deadline}s, terminating...')
 
     # def __getstate__(self):
     #     state = self.__dict__.copy()
@@ -62,72 +158,77 @@ class EC2Instance:
     #     return state
 
     def to_yaml(self,path=None):
-        contents = self.__dict__
-        drop_keys = [key for key in contents if key.startswith('_')]
-        for key in drop_keys:
-            contents.pop(key)
+        contents = {key: value for key, value in self.__dict__.items() if not key.startswith('_') and key != 'ssh_con'}
         write_yaml(contents,path)
 
     def from_yaml(self,path=None):
-        with open(path) as f:
-            config = yaml.load(f)
-        self.update(**config)
+        self.__dict__.update(read_yaml(path))
 
     def _get_private_ip_address(self):
-        _instance = self.get_instance()
-        return _instance.private_ip_address
+        return self.get_metadata(max_age=IP_TTL)['private_ip_address']
         
     def _get_public_ip_address(self):
-        _instance = self.get_instance()
-        return _instance.public_ip_address
+        return self.get_metadata(max_age=IP_TTL)['public_ip_address']
+
+    def transfer_engine(self, ssh_key_file: str = None, **kwargs):
+        '''
+        `TransferEngine` for bulk copies to and from this instance, see launch_control.transfer
+
+        ssh_key_file: str = defaults to the key of the connection made by `create_ssh_connection`
+        '''
+        from launch_control.transfer import TransferEngine
+
+        if ssh_key_file is None:
+            connection = getattr(self, 'ssh_con', None)
+            if connection is None:
+                raise BaseException('no ssh key to copy files with, call create_ssh_connection first or pass ssh_key_file')
+            # MultiplexedConnection or fabric.Connection
+            ssh_key_file = getattr(connection, 'key_filename', None) or connection.connect_kwargs['key_filename'][0]
+
+        return TransferEngine(self._get_private_ip_address(), user='ubuntu', key_filename=ssh_key_file, **kwargs)
 
     def _copy_file(self,local_path: str,remote_path: str):
-        '''copies file from local path to remote path for the current ec2 instance id'''
-        raise NotImplementedError
+        '''copies file (or directory) from local path to remote path for the current ec2 instance id'''
+        with self.transfer_engine() as engine:
+            return engine.push(local_path, remote_path)
 
     def _copy_files(self, copy_specification: dict):
         '''copy files into the ec2 instance from {key} to {value} on the remote'''
 
-        for key, value in copy_specification.items():
-            self._copy_file(key,value)
+        with self.transfer_engine() as engine:
+            return {key: engine.push(key, value) for key, value in copy_specification.items()}
 
     def _setup_git(self, username: str, usermail: str):
         '''take your local git configuration and replicate it on the ec2 machine'''
-        if not self.ssh_con:
-            raise BaseException('ssh connection not established yet')
-
-        
-        # setup name and email
-        result = self.run_bash_command(f'git config --global user.name {username}')
-        result = self.run_bash_command(f'git config --global user.email {usermail}')
+        self.provision(ProvisioningScript().add_git_config(username=username, usermail=usermail))
 
         # # setup ssh key on ec2 machine (not any docker image we may run later)
         # scp_conn = fabric.transfer.Transfer(self.ssh_con)
         # scp_conn.put(ssh_key_path, remote='/root/.ssh/id_rsa')
 
-    def _set_environment_variable(self, name: str, value: str):
-        # export GITHUB_PAT=$GITHUB_PAT
-        response = self.run_bash_command(f'echo "export {name}={value}" >> ~/.profile')
+    @traced('ssh')
+    def provision(self, script: ProvisioningScript, pty=False):
+        '''upload and run a rendered `ProvisioningScript` in a single remote command'''
+        if not self.ssh_con:
+            raise BaseException('ssh connection not established yet')
 
-    def _set_environment_variables(self, environment_variables: dict):
-        '''set environment variables inside the ec2 instance'''
-        
-        for key, value in environment_variables.items():
-            self._set_environment_variable(key,value)
+        command = f"bash -s <<'LC_SCRIPT'\n{script.render()}LC_SCRIPT\n"
+
+        return self.ssh_con.run(command, pty=pty)
 
-    def get_instance_state(self):
-        _instance = self.get_instance()
+    def get_instance_state(self, max_age: float = STATE_TTL):
         try:
-            print(_instance)
-            state = _instance.state['Name']
+            state = self.get_metadata(max_age=max_age)['state']
         except:
             raise BaseException('Could not get instance state')
 
         return state
 
-    def run_bash_command(self, command:str, pty=False):
+    @traced('ssh')
+    def run_bash_command(self, command:str, pty=False, **kwargs):
         '''
         pty: bool = should we use a terminal echoing standard in or run the command wihtout a psuedo terminal?
+        kwargs are passed on to `run`, e.g. warn, hide, out_stream, err_stream and timeout
         '''
         command_template = textwrap.dedent(f'''
         source ~/.profile;
@@ -139,77 +240,135 @@ class EC2Instance:
         
         ssh_con = self.ssh_con
 
-        result = ssh_con.run(command_template,pty=pty)
+        result = ssh_con.run(command_template,pty=pty,**kwargs)
 
         return result
 
+    @traced('ec2')
     def terminate(self):
         '''terminate the ec2/spot instance'''
 
-        if not self.get_instance_state() == 'running':
+        if not self.get_instance_state(max_age=0) == 'running':
             print('instance is not running')
         else:
-            _instance = self.get_instance()
-            _instance.terminate()
+            _ec2_api(self.region).terminate_instances(InstanceIds=[self.instance_id])
+            metadata_cache.invalidate(self.instance_id)
+
+        connection_pool.discard(self.instance_id)
 
 
 
 class EC2InstanceFactory:
     '''This class is responsible for spinning up on demand and spot instances and creating `EC2Instance` objects'''
-    def __init__(self, region: str, profile_name:str, key_pair_name: str):
+    def __init__(self, region: str, profile_name:str, key_pair_name: str, session=None):
+        '''
+        session: boto3.session.Session = shared session to build clients from, created lazily when not given
+        '''
         self.region = region
         self.profile_name = profile_name
         self.key_pair = key_pair_name
 
-        self._session=boto3.session.Session(profile_name=profile_name,region_name=region)
-        self._ec2=self._session.resource('ec2')
-        self._ec2_client = boto3.client('ec2',region_name = region)
+        # boto3 objects are only built on first use
+        self._lazy_session = session
+        self._lazy_ec2 = None
+        self._clients = {}
         self.instances = []
 
+    @property
+    def _session(self):
+        if self._lazy_session is None:
+            import boto3
+            self._lazy_session = boto3.session.Session(profile_name=self.profile_name,region_name=self.region)
+        return self._lazy_session
+
+    @property
+    def _ec2(self):
+        if self._lazy_ec2 is None:
+            self._lazy_ec2 = self._session.resource('ec2', region_name=self.region)
+        return self._lazy_ec2
+
+    @property
+    def _ec2_client(self):
+        return self._client(self.region)
+
+    def _client(self, region: str = None):
+        '''one rate limited ec2 `ApiClient` per region, built from this factory's session'''
+        region = region or self.region
+        if region not in self._clients:
+            self._clients[region] = api_client(self._session, 'ec2', region)
+        return self._clients[region]
+
     def __getstate__(self):
         state = self.__dict__.copy()
         del state['hidden']
         return state
 
     def poll_instance_until_running(self, instance_id, delay = 5, max_attempts = 30):
-        waiter = self._ec2_client.get_waiter('instance_running')
-        waiter.wait(
-            InstanceIds=[
-                instance_id,
-            ],
-            WaiterConfig={
-                'Delay': delay,
-                'MaxAttempts': max_attempts
-            }
+        self.poll_instances_until_running(instance_ids=[instance_id], delay=delay, max_attempts=max_attempts)
+
+    @traced('ec2')
+    def poll_instances_until_running(self, instance_ids: list, delay = 5, max_attempts = 30, region: str = None):
+        '''wait on all `instance_ids` together, one describe call per backoff attempt'''
+        descriptions = poll_instances_state(
+            self._client(region),
+            instance_ids=list(instance_ids),
+            state='running',
+            backoff=Backoff(initial=2, max_delay=delay * 2, deadline=delay * max_attempts),
         )
-        print('instance running')
+        # the final describe already has ips and state, cache them for the rest of the launch
+        for instance_id, description in descriptions.items():
+            metadata_cache.put(instance_id, metadata_from_description(description))
+        print(f'{len(instance_ids)} instance(s) running')
 
     def poll_instance_untill_stopped(self, instance_id, delay = 5, max_attempts = 30):
-        waiter = self._ec2_client.get_waiter('instance_stopped')
-        waiter.wait(
-            InstanceIds=[
-                instance_id,
-            ],
-            WaiterConfig={
-                'Delay': delay,
-                'MaxAttempts': max_attempts
-            }
+        self.poll_instances_until_stopped(instance_ids=[instance_id], delay=delay, max_attempts=max_attempts)
+
+    @traced('ec2')
+    def poll_instances_until_stopped(self, instance_ids: list, delay = 5, max_attempts = 60, region: str = None):
+        '''wait on all `instance_ids` together untill they are stopped'''
+        poll_instances_state(
+            self._client(region),
+            instance_ids=list(instance_ids),
+            state='stopped',
+            backoff=Backoff(initial=2, max_delay=delay * 2, deadline=delay * max_attempts),
         )
-        print('instance terminate')
+        for instance_id in instance_ids:
+            # the public ip is released on stop
+            metadata_cache.invalidate(instance_id)
+        print(f'{len(instance_ids)} instance(s) stopped')
 
     #Launch with or without a project, default behavior -> project.run()
+    @traced('ec2')
     def boto_request_instance(self, tags: dict, key_pair_name: str, aws_profile: str, aws_region: str, image_id: str, instance_type: str, security_group_id: str, iam_role_arn: str):
 
-        new_instance = self._ec2.create_instances(
+        return self.boto_request_instances(
+            count=1,
+            tags=tags,
+            key_pair_name=key_pair_name,
+            aws_profile=aws_profile,
+            aws_region=aws_region,
+            image_id=image_id,
+            instance_type=instance_type,
+            security_group_id=security_group_id,
+            iam_role_arn=iam_role_arn
+        )[0]
+
+    @traced('ec2')
+    def boto_request_instances(self, count: int, tags: dict, key_pair_name: str, aws_profile: str, aws_region: str, image_id: str, instance_type: str, security_group_id: str, iam_role_arn: str):
+        '''request `count` on demand instances in a single `run_instances` call'''
+
+        response = self._ec2_client.run_instances(
                 ImageId = image_id,
-                MinCount = 1,
-                MaxCount = 1,
+                MinCount = count,
+                MaxCount = count,
                 InstanceType = instance_type,
                 KeyName = key_pair_name,
                 SecurityGroupIds=[security_group_id],
                 IamInstanceProfile={
                     'Arn': iam_role_arn
                 },
+                # lets the idle watchdog terminate the instance by shutting it down
+                InstanceInitiatedShutdownBehavior='terminate',
                 TagSpecifications=[
                     {
                         'ResourceType': 'instance',
@@ -218,16 +377,31 @@ class EC2InstanceFactory:
                     },
                 ],
         )
-        # print(new_instance)
-        # self.instances.append(new_instance["Instances"][0]["InstanceId"])
-        self.instances.append(new_instance[0].instance_id)
 
-        return EC2Instance(instance_id = new_instance[0].instance_id, region=self.region)
+        return self._track_instances([instance['InstanceId'] for instance in response['Instances']])
 
+    @traced('ec2')
     def boto_request_spot_instance(self, tags: dict, key_pair_name: str, aws_profile: str, aws_region: str, image_id: str, instance_type: str, spot_price: str, security_group_id: str, iam_role_arn: str):
-        
+
+        return self.boto_request_spot_instances(
+            count=1,
+            tags=tags,
+            key_pair_name=key_pair_name,
+            aws_profile=aws_profile,
+            aws_region=aws_region,
+            image_id=image_id,
+            instance_type=instance_type,
+            spot_price=spot_price,
+            security_group_id=security_group_id,
+            iam_role_arn=iam_role_arn
+        )[0]
+
+    @traced('ec2')
+    def boto_request_spot_instances(self, count: int, tags: dict, key_pair_name: str, aws_profile: str, aws_region: str, image_id: str, instance_type: str, spot_price: str, security_group_id: str, iam_role_arn: str):
+        '''request `count` spot instances in a single `request_spot_instances` call and wait for all requests to be fulfilled'''
+
         response = self._ec2_client.request_spot_instances(
-                InstanceCount = 1,
+                InstanceCount = count,
                 LaunchSpecification={
                         'SecurityGroupIds': [
                             security_group_id,
@@ -239,104 +413,336 @@ class EC2InstanceFactory:
                         'InstanceType': instance_type,
                         'KeyName': key_pair_name,
                 },
-                SpotPrice=spot_price,
+                **max_price_kwargs(spot_price),
         )
 
-        state = 'open'
-        while state == 'open':
-            time.sleep(5)
-            spot = self._ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds = [response['SpotInstanceRequests'][0]['SpotInstanceRequestId']])
-            state = spot['SpotInstanceRequests'][0]['State']
-            print('Spot request ' + str(response['SpotInstanceRequests'][0]['SpotInstanceRequestId']) )
+        request_ids = [request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']]
+        print('Spot request(s) ' + ', '.join(request_ids))
 
-        # Exit if there is an error
-        if (state != 'active'):
-            exit(1)
+        try:
+            requests = poll_spot_requests(self._ec2_client, request_ids)
+        except DeadlineExceeded:
+            requests = {}
+
+        if len(requests) != len(request_ids) or any(request['State'] != 'active' for request in requests.values()):
+            # don't leave open requests behind to fulfil later, nor instances from a partial fill
+            self._ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+            fulfilled = [request['InstanceId'] for request in requests.values() if request.get('InstanceId')]
+            if fulfilled:
+                self._ec2_client.terminate_instances(InstanceIds=fulfilled)
+            raise BaseException(f'spot request(s) for {count} x {instance_type} were not fulfilled, cancelled them')
 
         # List of resources to tag
-        ids_to_tag = [spot['SpotInstanceRequests'][0]['InstanceId']]
+        ids_to_tag = [requests[request_id]['InstanceId'] for request_id in request_ids]
 
         self._ec2_client.create_tags(Resources = ids_to_tag, Tags = tags)
 
-        self.instances.append(spot['SpotInstanceRequests'][0]['InstanceId'])
+        return self._track_instances(ids_to_tag, dict(zip(ids_to_tag, request_ids)))
 
-        return EC2Instance(instance_id = spot['SpotInstanceRequests'][0]['InstanceId'], region=self.region)
+    def _track_instances(self, instance_ids: list, spot_request_ids: dict = None, region: str = None):
+        '''`EC2Instance` objects for newly launched `instance_ids`, spot_request_ids maps instance id -> spot request id'''
+        self.instances.extend(instance_ids)
+
+        instances = []
+        for instance_id in instance_ids:
+            instance = EC2Instance(instance_id = instance_id, region=region or self.region)
+            if spot_request_ids and instance_id in spot_request_ids:
+                # recorded so terminate can cancel the request along with the instance
+                instance.spot_request_id = spot_request_ids[instance_id]
+            instances.append(instance)
+
+        return instances
+
+    @traced('ec2')
+    def launch_fleet(self, count: int, project_name: str, on_demand: bool = False, spot_price: str = None, instance_types: list = None, subnet_ids: list = None, fallback_deadline: float = None, capacity_specs: list = None, **launch_kwargs):
+        '''
+        launch `count` instances in one batched request, record each in the registry and wait for all of them to run
+
+        instance_types: list = acceptable instance types in order of preference, raced as spot requests together with `instance_type`
+        subnet_ids: list = acceptable subnets/AZs in order of preference
+        fallback_deadline: float = seconds to wait for spot capacity before falling back to on demand
+        capacity_specs: list = explicit `CapacitySpec`s to race, e.g. from `rank_spot_offers`
+        '''
+
+        if instance_types or subnet_ids or capacity_specs or fallback_deadline is not None:
+            from launch_control.capacity import CapacityLauncher
+
+            instance_type = launch_kwargs.pop('instance_type', None)
+            instance_types = list(dict.fromkeys(([instance_type] if instance_type else []) + list(instance_types or [])))
+            launcher = CapacityLauncher(
+                self,
+                instance_types=instance_types,
+                subnet_ids=subnet_ids,
+                spot_price=spot_price,
+                fallback_deadline=300 if fallback_deadline is None else fallback_deadline,
+                specs=capacity_specs,
+            )
+            instances = launcher.launch(count=count, on_demand=on_demand, **launch_kwargs)
+        elif on_demand:
+            instances = self.boto_request_instances(count=count, **launch_kwargs)
+        else:
+            instances = self.boto_request_spot_instances(count=count, spot_price=spot_price, **launch_kwargs)
+
+        print('request submitted...')
+        registry = get_registry()
+        for instance in instances:
+            registry.add(instance.instance_id, project=project_name, region=instance.region, spot_request_id=getattr(instance, 'spot_request_id', None))
+
+        print(f'polling {len(instances)} instance(s) untill running...')
+        self.poll_instances_until_running(instance_ids=[instance.instance_id for instance in instances])
+
+        return instances
 
     @staticmethod
     def list_instances(verbose: bool = True, project: str=None, region: str=None):
-        '''step through known instances and list them and their status'''
-
-        path = LAUNCH_CONTROL_INSTANCE_DIR()
-        
-        projects_paths = [join(path, dir) for dir in listdir(path) if isdir(join(path, dir))]
-        projects = [dir for dir in listdir(path) if isdir(join(path, dir))]
+        '''list known instances per project from the local registry, returns project -> [instance ids] when not verbose'''
 
         resources = {}
-        resource_paths = {}
-
-        for proj, proj_path in zip(projects,projects_paths):
-            if project is not None:
-                if proj != project:
-                    next
-            resources[proj] = []
-            resource_paths[proj_path] = []
-            instances = [f.replace('.yaml','') for f in listdir(proj_path) if isfile(join(proj_path, f))]
-            instance_paths = [join(proj_path, f) for f in listdir(proj_path) if isfile(join(proj_path, f))]
-            for ins, instance_path in zip(instances, instance_paths):
-                resources[proj].append(ins)
-                resource_paths[proj_path].append(instance_path)
+        for record in get_registry().instances(project=project):
+            resources.setdefault(record['project'], []).append(record['instance_id'])
 
         if verbose:
             print('found resources;')
             print(resources)
             print()
 
-            if len(resources) > 0:
-                print('collecting information...')
-                for proj, proj_path in zip(resources,resource_paths):
-                    for ins in resources[proj]:
-                        instance = EC2Instance(ins, region).get_instance()
-                        print(instance)
+        else:
+            return resources
+
+    @staticmethod
+    def recorded_instances(project: str = None):
+        '''every instance record (project, instance_id, region, spot_request_id, metadata), optionally for one project'''
+        return get_registry().instances(project=project)
+
+    def region_of(self, instance_id: str):
+        '''region the instance was recorded in, this factory's region for instances the registry doesn't know'''
+        record = get_registry().get(instance_id)
+        return (record and record['region']) or self.region
+
+    def instance(self, instance_id: str):
+        '''`EC2Instance` for a recorded instance in the region it was launched in'''
+        return EC2Instance(instance_id, self.region_of(instance_id))
+
+    @traced('ec2')
+    def describe_records(self, records: list):
+        '''
+        describe recorded instances across regions, one batched describe per region and all regions concurrently
+
+        returns instance id -> description, instances that no longer exist are left out
+        records: list = as returned by `recorded_instances`
+        '''
+        by_region = {}
+        for record in records:
+            by_region.setdefault(record['region'] or self.region, []).append(record['instance_id'])
+
+        descriptions = {}
+        for result in gather(*[self._describe_instances(instance_ids, region=region) for region, instance_ids in by_region.items()]):
+            descriptions.update(result)
+
+        return descriptions
+
+    def describe_instances(self, instance_ids: list, region: str = None):
+        '''
+        describe many instances with batched, paginated calls
+
+        returns instance id -> description, ids that no longer exist are left out instead of failing the whole call
+        '''
+        return gather(self._describe_instances(instance_ids, region=region))[0]
+
+    async def _describe_batch(self, client, batch: list):
+        descriptions = {}
+        kwargs = {'Filters': [{'Name': 'instance-id', 'Values': batch}], 'MaxResults': 1000}
+        while True:
+            page = await client.acall('describe_instances', **kwargs)
+            metadata_cache.count_api_call()
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    descriptions[instance['InstanceId']] = instance
+            if not page.get('NextToken'):
+                return descriptions
+            kwargs['NextToken'] = page['NextToken']
+
+    async def _describe_instances(self, instance_ids: list, region: str = None):
+        '''`describe_instances` as a coroutine, the batches run concurrently'''
+        import asyncio
+
+        client = self._client(region)
+        batches = [list(instance_ids[i:i + DESCRIBE_BATCH_SIZE]) for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE)]
+
+        descriptions = {}
+        for result in await asyncio.gather(*[self._describe_batch(client, batch) for batch in batches]):
+            descriptions.update(result)
+
+        return descriptions
+
+    @traced('ec2')
+    def instance_details(self):
+        '''state, type, ips, uptime and estimated cost for every recorded instance, batched describes with all regions concurrently'''
+        records = self.recorded_instances()
+        descriptions = self.describe_records(records)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = []
+        for record in records:
+            description = descriptions.get(record['instance_id'])
+            row = {
+                'project': record['project'],
+                'instance_id': record['instance_id'],
+                'region': record['region'] or self.region,
+                'state': 'not-found',
+                'instance_type': None,
+                'lifecycle': None,
+                'private_ip_address': None,
+                'public_ip_address': None,
+                'uptime_hours': None,
+                'estimated_cost_usd': None,
+            }
+            if description is not None:
+                metadata = metadata_cache.put(record['instance_id'], metadata_from_description(description))
+                row.update({key: metadata[key] for key in ['state', 'instance_type', 'private_ip_address', 'public_ip_address']})
+                row['lifecycle'] = description.get('InstanceLifecycle', 'on-demand')
+                if metadata['state'] == 'running' and description.get('LaunchTime'):
+                    row['uptime_hours'] = round((now - description['LaunchTime']).total_seconds() / 3600, 2)
+                    row['estimated_cost_usd'] = estimate_cost(metadata['instance_type'], row['uptime_hours'])
+            rows.append(row)
+
+        return rows
 
+    @staticmethod
+    def print_instance_details(rows: list, output: str = 'table'):
+        '''render `instance_details` rows as a table, json or csv'''
+        if output == 'json':
+            print(json.dumps(rows, indent=2, default=str))
+        elif output == 'csv':
+            if rows:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
         else:
-            return resources, resource_paths
+            header = ['project', 'instance_id', 'region', 'state', 'type', 'lifecycle', 'private_ip', 'public_ip', 'uptime_h', 'est_cost_usd']
+            print_table(header, [['-' if value is None else value for value in row.values()] for row in rows])
+            total = sum(row['estimated_cost_usd'] or 0 for row in rows)
+            print(f'{len(rows)} instances, estimated running cost ${total:.2f} (on demand rates)')
 
     def list_ips(self):
-        resources, resource_paths = self.list_instances(verbose=False)
-        for proj, proj_path in zip(resources,resource_paths):
-            for ins in resources[proj]:
-
-                instance = EC2Instance(ins, self.region)
+        records = self.recorded_instances()
+        descriptions = self.describe_records(records)
+        for record in records:
+            description = descriptions.get(record['instance_id'])
+            if description is None:
+                print({'instance_id': record['instance_id'], 'private_ip_address': None, 'public_ip_address': None})
+                continue
+            metadata = metadata_cache.put(record['instance_id'], metadata_from_description(description))
 
-                print({'instance_id': instance.instance_id ,'private_ip_address' : instance.instance.private_ip_address, 'public_ip_address' : instance.instance.public_ip_address})
+            print({'instance_id': record['instance_id'] ,'private_ip_address' : metadata['private_ip_address'], 'public_ip_address' : metadata['public_ip_address']})
 
     def shutdown_instance(self, instance_id: str):
-        instance = EC2Instance(instance_id, self.region)
+        instance = self.instance(instance_id)
         print(f'loaded instance id {instance_id}')
         print('terminating...')
         instance.terminate()
 
-    def shutdown_project(self, project_name: str = None):
+    async def _cancel_spot_requests(self, client, instance_ids: list, request_ids: list):
+        '''cancel recorded spot requests plus any open/active request that fulfilled one of `instance_ids`'''
+        import asyncio
+
+        request_ids = set(request_ids)
+        responses = await asyncio.gather(*[
+            client.acall('describe_spot_instance_requests', Filters=[
+                {'Name': 'instance-id', 'Values': list(instance_ids[i:i + DESCRIBE_BATCH_SIZE])},
+                {'Name': 'state', 'Values': ['open', 'active']},
+            ])
+            for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE)
+        ])
+        for response in responses:
+            request_ids.update(request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests'])
+
+        request_ids = sorted(request_ids)
+        results = await asyncio.gather(*[
+            client.acall('cancel_spot_instance_requests', SpotInstanceRequestIds=request_ids[i:i + TERMINATE_BATCH_SIZE])
+            for i in range(0, len(request_ids), TERMINATE_BATCH_SIZE)
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f'could not cancel spot requests: {result}')
+
+        return request_ids
+
+    async def _terminate_region(self, region: str, records: list, wait: bool = False):
+        '''terminate every recorded instance in one region, returns the instance ids confirmed gone'''
+        import asyncio
+
+        client = self._client(region)
+        instance_ids = [record['instance_id'] for record in records]
+
+        # instances that no longer exist would fail the whole terminate call, so only send live ones
+        descriptions = await self._describe_instances(instance_ids, region=region)
+        live = [instance_id for instance_id, description in descriptions.items() if description['State']['Name'] not in ('shutting-down', 'terminated')]
+        confirmed = set(instance_id for instance_id in instance_ids if instance_id not in live)
+
+        responses = await asyncio.gather(*[
+            client.acall('terminate_instances', InstanceIds=live[i:i + TERMINATE_BATCH_SIZE])
+            for i in range(0, len(live), TERMINATE_BATCH_SIZE)
+        ])
+        for response in responses:
+            for change in response['TerminatingInstances']:
+                if change['CurrentState']['Name'] in ('shutting-down', 'terminated'):
+                    confirmed.add(change['InstanceId'])
+
+        spot_request_ids = [record['spot_request_id'] for record in records if record.get('spot_request_id')]
+        cancelled = await self._cancel_spot_requests(client, instance_ids, spot_request_ids)
+        print(f'{region}: terminating {len(live)} instance(s), cancelled {len(cancelled)} spot request(s)')
+
+        if wait and live:
+            waiter = client.get_waiter('instance_terminated')
+            await asyncio.gather(*[
+                asyncio.to_thread(waiter.wait, InstanceIds=live[i:i + TERMINATE_BATCH_SIZE], WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
+                for i in range(0, len(live), TERMINATE_BATCH_SIZE)
+            ])
+            print(f'{region}: {len(live)} instance(s) terminated')
+
+        for instance_id in instance_ids:
+            metadata_cache.invalidate(instance_id)
+            connection_pool.discard(instance_id)
+
+        return confirmed
+
+    @traced('ec2')
+    def terminate_instances(self, records: list, wait: bool = False):
+        '''
+        batch terminate recorded instances, up to 1000 ids per call and all regions concurrently
+
+        local records are only removed once the terminate is confirmed by EC2
+        records: list = as returned by `recorded_instances`
+        wait: bool = also wait for `instance_terminated` before cleaning up
+        '''
+        by_region = {}
+        for record in records:
+            by_region.setdefault(record['region'] or self.region, []).append(record)
+
+        confirmed = set()
+        results = gather(*[self._terminate_region(region, region_records, wait) for region, region_records in by_region.items()], return_exceptions=True)
+        for region, result in zip(by_region, results):
+            if isinstance(result, BaseException):
+                print(f'could not terminate instances in {region}: {result}')
+            else:
+                confirmed.update(result)
+
+        for record in records:
+            if record['instance_id'] not in confirmed:
+                print(f"cannot confirm termination of {record['instance_id']} for project {record['project']}, keeping its record")
+        get_registry().remove([record['instance_id'] for record in records if record['instance_id'] in confirmed])
+
+        return confirmed
+
+    def shutdown_project(self, project_name: str = None, wait: bool = False):
         '''shutdown all aws resources for this project'''
 
-        resources, resource_paths = self.list_instances(verbose=False)
-        for proj, proj_path in zip(resources,resource_paths):
-            #if we match the project
-            if proj == project_name:
-                for ins, ins_path in zip(resources[proj],resource_paths[proj_path]):
-                    try:
-                        self.shutdown_instance(ins)
-                    except:
-                        print(f'cannot load and terminate instance {ins} for project {proj}')
-                        print('deleting instance reference...')
-                    finally:
-                        os.remove(ins_path) 
-
-                shutil.rmtree(proj_path) 
-            
+        self.terminate_instances(self.recorded_instances(project=project_name), wait=wait)
+
         print('Done!')
 
-    def shutdown_all(self):
-        resources, resource_paths = self.list_instances(verbose=False)
-        for proj, _ in zip(resources,resource_paths):
-            self.shutdown_project(proj)
+    def shutdown_all(self, wait: bool = False):
+        self.terminate_instances(self.recorded_instances(), wait=wait)
+
+        print('Done!')
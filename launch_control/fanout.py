@@ -0,0 +1,129 @@
+#This module runs one bash command across many ec2 instances in parallel with host prefixed, streamed output
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from launch_control.utils import print_table
+
+_print_lock = threading.Lock()
+
+class PrefixedStream:
+    '''file like object that writes complete lines to `target` prefixed with the host name'''
+    def __init__(self, prefix: str, target=None):
+        self.prefix = prefix
+        self.target = target or sys.stdout
+        self._buffer = ''
+
+    def write(self, text: str):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split('\n')
+        if lines:
+            with _print_lock:
+                for line in lines:
+                    self.target.write(f'[{self.prefix}] {line.rstrip(chr(13))}\n')
+                self.target.flush()
+
+    def flush(self):
+        # fabric flushes after every chunk, partial lines stay buffered untill `finish`
+        self.target.flush()
+
+    def finish(self):
+        if self._buffer:
+            self.write('\n')
+
+def error_status(e: BaseException):
+    '''`timeout` for an exception raised by a remote command running past its timeout, `error` for anything else'''
+    # fabric raises CommandTimedOut, the multiplexed connection RemoteCommandTimeout
+    name = type(e).__name__.lower()
+    return 'timeout' if 'timedout' in name or 'timeout' in name else 'error'
+
+class HostResult:
+    def __init__(self, instance_id: str):
+        self.instance_id = instance_id
+        self.exited = None
+        self.duration = None
+        self.error = None
+        self.status = 'pending'
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+def _run_on_instance(ec2_instance, command: str, ssh_key_file: str, deadline: float, cancelled: threading.Event):
+    result = HostResult(ec2_instance.instance_id)
+    if cancelled.is_set():
+        result.status = 'skipped'
+        return result
+
+    out_stream = PrefixedStream(ec2_instance.instance_id, sys.stdout)
+    err_stream = PrefixedStream(ec2_instance.instance_id, sys.stderr)
+    start = time.monotonic()
+    try:
+        ec2_instance.create_ssh_connection(ssh_key_file=ssh_key_file, multiplex=True)
+        timeout = None if deadline is None else max(1, deadline - time.monotonic())
+        response = ec2_instance.run_bash_command(command, pty=False, warn=True, out_stream=out_stream, err_stream=err_stream, timeout=timeout)
+        result.exited = response.exited
+        result.status = 'ok' if response.exited == 0 else 'failed'
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except BaseException as e:
+        result.error = e
+        result.status = error_status(e)
+    finally:
+        out_stream.finish()
+        err_stream.finish()
+        result.duration = time.monotonic() - start
+
+    return result
+
+def run_parallel(ec2_instances: list, command: str, ssh_key_file: str, parallel: int = 10, fail_fast: bool = False, timeout: float = None):
+    '''
+    run `command` on every instance with up to `parallel` hosts at once, streaming output as it arrives
+
+    fail_fast: bool = stop starting new hosts once any host fails
+    timeout: float = overall time budget in seconds for the whole fan out
+
+    returns a `HostResult` per instance in input order
+    '''
+    deadline = None if timeout is None else time.monotonic() + timeout
+    cancelled = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        futures = {pool.submit(_run_on_instance, ins, command, ssh_key_file, deadline, cancelled): ins for ins in ec2_instances}
+        pending = set(futures)
+        while pending:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                # overall timeout hit, stop waiting on hosts that have not started
+                cancelled.set()
+                break
+            if fail_fast and any(not future.result().ok for future in done):
+                cancelled.set()
+
+        results = []
+        for future, ins in futures.items():
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                result = HostResult(ins.instance_id)
+                result.status = 'timeout'
+                results.append(result)
+
+    return results
+
+def print_summary_table(results: list):
+    '''per host exit code summary'''
+    header = ['instance_id', 'status', 'exit', 'duration']
+    rows = [[r.instance_id, r.status, '-' if r.exited is None else str(r.exited), '-' if r.duration is None else f'{r.duration:.1f}s'] for r in results]
+
+    print()
+    print_table(header, rows)
+
+    failed = [r for r in results if not r.ok]
+    print(f'{len(results) - len(failed)}/{len(results)} hosts succeeded')
+    for r in failed:
+        if r.error is not None:
+            print(f'{r.instance_id}: {r.error}')
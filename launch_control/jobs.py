@@ -0,0 +1,287 @@
+#This module runs commands as detached jobs on ec2 instances and streams their logs into local files
+import base64
+import datetime
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from launch_control.registry import get_registry
+from launch_control.fanout import PrefixedStream
+from launch_control.utils import print_table
+from launch_control.vars import LAUNCH_CONTROL_DIR
+
+# where jobs keep their script, pid, logs and exit code on the instance
+REMOTE_JOBS_DIR = '$HOME/.lc_jobs'
+
+STREAMS = ['stdout', 'stderr']
+
+# most bytes fetched per stream per poll, bigger backlogs are caught up over consecutive polls
+FETCH_LIMIT = 4 * 2 ** 20
+
+# seconds a start waits for the job to write its pid before the start counts as failed
+START_TIMEOUT = 10
+
+def new_job_id():
+    return f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+
+def local_log_path(job_id: str, instance_id: str, stream: str = 'stdout'):
+    return f'{LAUNCH_CONTROL_DIR()}/jobs/{job_id}/{instance_id}.{stream}'
+
+def start_script(job_id: str, command: str):
+    '''
+    bash that starts `command` in its own session, so it survives the ssh connection dropping, and returns once it runs
+
+    the job writes its pid on start and its exit code on completion next to its stdout/stderr logs; the script fails when
+    the pid doesn't show up within `START_TIMEOUT` seconds, so a job without one afterwards is lost rather than starting
+    '''
+    return '\n'.join([
+        'set -e',
+        f'D="{REMOTE_JOBS_DIR}/{job_id}"',
+        'mkdir -p "$D"',
+        "cat > \"$D/cmd.sh\" <<'LC_JOB'",
+        command,
+        'LC_JOB',
+        # $0 is the job dir inside the wrapper
+        'nohup setsid bash -c \'echo $$ > "$0/pid.tmp"; mv "$0/pid.tmp" "$0/pid"; source ~/.profile > /dev/null 2>&1; '
+        'bash "$0/cmd.sh" > "$0/stdout.log" 2> "$0/stderr.log"; echo $? > "$0/exit.tmp"; mv "$0/exit.tmp" "$0/exit"\' "$D" '
+        '< /dev/null > /dev/null 2>&1 &',
+        f'for i in $(seq {START_TIMEOUT * 10}); do [ -f "$D/pid" ] && exit 0; sleep 0.1; done',
+        f'echo "job did not start within {START_TIMEOUT}s" >&2; exit 1',
+    ]) + '\n'
+
+def poll_script(jobs: list):
+    '''
+    bash reporting the state of every job and the log bytes past the given offsets, for all jobs on one host at once
+
+    jobs: list = of (job_id, {stream: offset})
+    per job prints `LC_JOB <job_id> <state>`, then the byte count and base64 of each stream in `STREAMS` order
+    '''
+    lines = []
+    for job_id, offsets in jobs:
+        lines += [
+            f'J="{REMOTE_JOBS_DIR}/{job_id}"',
+            # the exit file is checked again after the pid so a job finishing in between isn't reported lost; the start
+            # only returns once the pid is written, so a job without one is lost too
+            'if [ -f "$J/exit" ]; then s=$(cat "$J/exit"); '
+            'elif kill -0 "$(cat "$J/pid" 2>/dev/null)" 2> /dev/null; then s=running; '
+            'elif [ -f "$J/exit" ]; then s=$(cat "$J/exit"); '
+            'else s=lost; fi',
+            f'echo "LC_JOB {job_id} $s"',
+        ]
+        for stream in STREAMS:
+            offset = offsets.get(stream, 0)
+            lines += [
+                f'f="$J/{stream}.log"; n=$(( $(stat -c %s "$f" 2> /dev/null || echo 0) - {offset} ))',
+                f'[ $n -gt {FETCH_LIMIT} ] && n={FETCH_LIMIT}; [ $n -lt 0 ] && n=0',
+                f'echo $n; tail -c +{offset + 1} "$f" 2> /dev/null | head -c $n | base64 -w0; echo',
+            ]
+    return '\n'.join(lines) + '\n'
+
+def parse_poll_output(output: str):
+    '''dict of job_id -> (state, {stream: bytes}) from the output of `poll_script`'''
+    lines = output.splitlines()
+    results = {}
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith('LC_JOB '):
+            # ~/.profile noise and the like
+            i += 1
+            continue
+        _, job_id, state = lines[i].split(' ', 2)
+        i += 1
+        chunks = {}
+        for stream in STREAMS:
+            count = int(lines[i])
+            data = base64.b64decode(lines[i + 1]) if i + 1 < len(lines) else b''
+            chunks[stream] = data[:count]
+            i += 2
+        results[job_id] = (state.strip(), chunks)
+    return results
+
+class JobRunner:
+    '''
+    Starts commands as detached jobs on instances and tracks them in the registry `jobs` table.
+
+    Logs are mirrored into ~/.launch_control/jobs/<job id>/<instance id>.stdout|stderr. Every poll fetches only the bytes
+    past the size of the local files, so an interrupted `lc logs` resumes where it stopped. One remote command per host
+    covers all of that host's jobs, so one controller can watch hundreds of jobs cheaply.
+    '''
+    def __init__(self, ssh_key_file: str, parallel: int = 32, clock=time.monotonic, sleep=time.sleep):
+        self.ssh_key_file = ssh_key_file
+        self.parallel = parallel
+        self.clock = clock
+        self.sleep = sleep
+
+    def _connection(self, instance_id: str, region: str):
+        from launch_control.ec2 import EC2Instance
+
+        ec2_instance = EC2Instance(instance_id, region)
+        ec2_instance.create_ssh_connection(ssh_key_file=self.ssh_key_file, multiplex=True)
+        return ec2_instance.ssh_con
+
+    def start(self, ec2_instances: list, command: str, project: str = None):
+        '''
+        start `command` on every instance as one job, returns (job id, {instance id: error} of the instances it didn't start on)
+
+        a host failing doesn't stop the others, the job id stays valid for every instance it did start on
+        '''
+        job_id = new_job_id()
+        script = start_script(job_id, command)
+        registry = get_registry()
+
+        def _start(ec2_instance):
+            try:
+                connection = self._connection(ec2_instance.instance_id, ec2_instance.region)
+                connection.run(f"bash -s <<'LC_SCRIPT'\n{script}LC_SCRIPT\n", hide=True)
+                registry.add_job(job_id, ec2_instance.instance_id, project, ec2_instance.region, command)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                return ec2_instance.instance_id, e
+
+        with ThreadPoolExecutor(max_workers=max(1, self.parallel)) as pool:
+            failed = dict(failure for failure in pool.map(_start, ec2_instances) if failure is not None)
+
+        return job_id, failed
+
+    @staticmethod
+    def offsets(record: dict):
+        offsets = {}
+        for stream in STREAMS:
+            path = local_log_path(record['job_id'], record['instance_id'], stream)
+            offsets[stream] = os.path.getsize(path) if os.path.exists(path) else 0
+        return offsets
+
+    def _poll_host(self, instance_id: str, region: str, records: list):
+        connection = self._connection(instance_id, region)
+        script = poll_script([(record['job_id'], self.offsets(record)) for record in records])
+        output = connection.run(f"bash -s <<'LC_SCRIPT'\n{script}LC_SCRIPT\n", hide=True).stdout
+        return parse_poll_output(output)
+
+    def poll(self, records: list):
+        '''
+        fetch new log bytes for the job records and update finished ones in the registry
+
+        returns a list of (record, {stream: new bytes}, more) where `more` means a stream hit `FETCH_LIMIT`
+        '''
+        by_host = {}
+        for record in records:
+            by_host.setdefault((record['instance_id'], record['region']), []).append(record)
+
+        def _poll(item):
+            (instance_id, region), host_records = item
+            try:
+                return host_records, self._poll_host(instance_id, region, host_records)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                print(f'{instance_id}: could not poll jobs: {e}', file=sys.stderr)
+                return host_records, {}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.parallel)) as pool:
+            polled = list(pool.map(_poll, by_host.items()))
+
+        registry = get_registry()
+        updates = []
+        for host_records, results in polled:
+            for record in host_records:
+                if record['job_id'] not in results:
+                    continue
+                state, chunks = results[record['job_id']]
+                for stream, data in chunks.items():
+                    if data:
+                        path = local_log_path(record['job_id'], record['instance_id'], stream)
+                        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+                        with open(path, 'ab') as f:
+                            f.write(data)
+
+                more = any(len(data) >= FETCH_LIMIT for data in chunks.values())
+                if state != 'running' and record['state'] == 'running' and not more:
+                    exit_code = None if state == 'lost' else int(state)
+                    registry.finish_job(record['job_id'], record['instance_id'], 'lost' if state == 'lost' else 'exited', exit_code)
+                    record.update(state='lost' if state == 'lost' else 'exited', exit_code=exit_code)
+
+                updates.append((record, chunks, more))
+
+        return updates
+
+    def follow(self, records: list, interval: float = 2, timeout: float = None, out_stream=None, err_stream=None):
+        '''
+        poll untill every job has finished, writing new output as it arrives; prefixed by instance with several instances
+
+        returns the records with their final state, unfinished ones are left running when `timeout` seconds pass
+        '''
+        out_stream = out_stream or sys.stdout
+        err_stream = err_stream or sys.stderr
+        prefixed = len(records) > 1
+        streams = {}
+        for record in records:
+            key = (record['job_id'], record['instance_id'])
+            if prefixed:
+                streams[key] = {'stdout': PrefixedStream(record['instance_id'], out_stream), 'stderr': PrefixedStream(record['instance_id'], err_stream)}
+            else:
+                streams[key] = {'stdout': out_stream, 'stderr': err_stream}
+
+        start = self.clock()
+        active = [record for record in records if record['state'] == 'running']
+        while active:
+            more = False
+            for record, chunks, record_more in self.poll(active):
+                more = more or record_more
+                for stream, data in chunks.items():
+                    if data:
+                        streams[(record['job_id'], record['instance_id'])][stream].write(data.decode('utf-8', errors='replace'))
+            active = [record for record in active if record['state'] == 'running']
+            if not active or (timeout is not None and self.clock() - start > timeout):
+                break
+            if not more:
+                self.sleep(interval)
+
+        for stream_pair in streams.values():
+            for stream in stream_pair.values():
+                if isinstance(stream, PrefixedStream):
+                    stream.finish()
+
+        return records
+
+    def wait(self, records: list, interval: float = 5, timeout: float = None):
+        '''poll (without printing) untill every job has finished or `timeout` seconds pass'''
+        start = self.clock()
+        active = [record for record in records if record['state'] == 'running']
+        while active:
+            self.poll(active)
+            active = [record for record in active if record['state'] == 'running']
+            if not active or (timeout is not None and self.clock() - start > timeout):
+                break
+            self.sleep(interval)
+
+        return records
+
+def print_job_started(job_id: str, ec2_instances: list, failed: dict):
+    '''report the outcome of `JobRunner.start`'''
+    for instance_id, error in failed.items():
+        print(f'{instance_id}: could not start job {job_id}: {error}', file=sys.stderr)
+
+    started = len(ec2_instances) - len(failed)
+    if started:
+        print(f'started job {job_id} on {started}/{len(ec2_instances)} instance(s), follow it with `lc logs {job_id} -f`')
+    else:
+        print(f'job {job_id} did not start on any instance', file=sys.stderr)
+
+def print_jobs(records: list):
+    header = ['job_id', 'instance_id', 'project', 'state', 'exit', 'started', 'duration', 'command']
+    now = time.time()
+    rows = []
+    for record in records:
+        end = record['finished_at'] or now
+        command = record['command'] if len(record['command']) <= 40 else record['command'][:37] + '...'
+        rows.append([
+            record['job_id'], record['instance_id'], record['project'] or '-', record['state'],
+            '-' if record['exit_code'] is None else record['exit_code'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(record['started_at'])),
+            f"{(end - record['started_at']) / 60:.1f}m", command,
+        ])
+    print_table(header, rows)
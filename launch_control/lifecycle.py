@@ -0,0 +1,222 @@
+#This module relates to instance lifetimes; ttl and idle tags, the on instance idle watchdog and reaping expired instances
+import datetime
+import re
+import time
+
+from launch_control.aws import gather
+from launch_control.registry import get_registry
+from launch_control.pricing import estimate_cost
+from launch_control.utils import print_table
+
+EXPIRES_AT_TAG = 'ExpiresAt'
+TTL_TAG = 'TTL'
+IDLE_TAG = 'IdleShutdownMinutes'
+
+# idle minutes before the watchdog shuts an instance down unless `--idle` says otherwise; off, so instances left up on purpose stay up
+DEFAULT_IDLE_MINUTES = 0
+
+# 5 minute load average per vCPU below which an instance counts as idle
+IDLE_LOAD = 0.1
+
+# the watchdog leaves freshly (re)started instances alone for this long, so a started warm pool member is reprovisioned
+# with its new ttl before an old expiry is acted on
+BOOT_GRACE_MINUTES = 10
+
+WATCHDOG_PATH = '/usr/local/bin/lc-watchdog'
+WATCHDOG_CONF = '/etc/lc-watchdog.conf'
+WATCHDOG_CRON = '/etc/cron.d/lc-watchdog'
+
+# runs every minute from cron as root; instances launch with InstanceInitiatedShutdownBehavior=terminate,
+# so halting the machine terminates it
+WATCHDOG_SCRIPT = f'''#!/bin/bash
+# installed by launch control, see {WATCHDOG_CONF}
+IDLE_MINUTES=0
+EXPIRES_AT=0
+IDLE_LOAD={IDLE_LOAD}
+[ -f {WATCHDOG_CONF} ] && . {WATCHDOG_CONF}
+now=$(date +%s)
+[ "$(cut -d. -f1 /proc/uptime)" -lt {BOOT_GRACE_MINUTES * 60} ] && exit 0
+if [ "$EXPIRES_AT" -gt 0 ] && [ "$now" -ge "$EXPIRES_AT" ]; then
+    logger -t lc-watchdog "ttl expired, shutting down"; shutdown -h now; exit 0
+fi
+[ "$IDLE_MINUTES" -gt 0 ] || exit 0
+busy=0
+awk -v n="$(nproc)" -v t="$IDLE_LOAD" '{{ exit !($2 / n > t) }}' /proc/loadavg && busy=1
+[ -n "$(ss -Htn state established '( sport = :22 )' 2> /dev/null)" ] && busy=1
+for pid in /home/*/.lc_jobs/*/pid; do
+    [ -f "$pid" ] && [ ! -f "$(dirname "$pid")/exit" ] && kill -0 "$(cat "$pid")" 2> /dev/null && busy=1
+done
+# /run is emptied on boot, so a stopped and started instance starts a fresh idle period
+state=/run/lc-watchdog-idle-since
+if [ $busy = 1 ]; then rm -f $state; exit 0; fi
+[ -f $state ] || echo "$now" > $state
+if [ $(( now - $(cat $state) )) -ge $(( IDLE_MINUTES * 60 )) ]; then
+    logger -t lc-watchdog "idle for $IDLE_MINUTES minutes, shutting down"; shutdown -h now
+fi
+'''
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(text: str):
+    '''seconds in a duration like `90m`, `8h`, `2d` or `1h30m`; a bare number is minutes'''
+    text = str(text).strip().lower()
+    if re.fullmatch(r'\d+(\.\d+)?', text):
+        return float(text) * 60
+
+    parts = re.findall(r'(\d+(?:\.\d+)?)([smhd])', text)
+    if not parts or ''.join(number + unit for number, unit in parts) != text:
+        raise BaseException(f'could not parse duration {text}, expected e.g. 90m, 8h or 2d')
+
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def expiry_time(ttl_seconds: float, now: float = None):
+    return (time.time() if now is None else now) + ttl_seconds
+
+def lifecycle_tags(ttl_seconds: float = None, idle_minutes: int = None, now: float = None):
+    '''tags recording when an instance expires and its idle shutdown, added to the launch `tags`'''
+    tags = []
+    if ttl_seconds:
+        expires_at = datetime.datetime.fromtimestamp(expiry_time(ttl_seconds, now), datetime.timezone.utc)
+        tags.append({'Key': EXPIRES_AT_TAG, 'Value': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')})
+        tags.append({'Key': TTL_TAG, 'Value': f'{int(ttl_seconds // 60)}m'})
+    if idle_minutes:
+        tags.append({'Key': IDLE_TAG, 'Value': str(int(idle_minutes))})
+    return tags
+
+def watchdog_lines(idle_minutes: int = None, expires_at: float = None):
+    '''
+    provisioning lines installing the watchdog, or removing it when neither an idle limit nor an expiry is set
+
+    always part of the provisioning script so a reused instance (warm pool, baked image) never keeps a stale config
+    '''
+    if not idle_minutes and not expires_at:
+        return [f'sudo rm -f {WATCHDOG_CRON} {WATCHDOG_CONF}']
+
+    return [
+        f"sudo tee {WATCHDOG_PATH} > /dev/null <<'LC_WATCHDOG'\n{WATCHDOG_SCRIPT}LC_WATCHDOG",
+        f'sudo chmod 755 {WATCHDOG_PATH}',
+        f"printf 'IDLE_MINUTES=%s\\nEXPIRES_AT=%s\\n' {int(idle_minutes or 0)} {int(expires_at or 0)} | sudo tee {WATCHDOG_CONF} > /dev/null",
+        f"echo '* * * * * root {WATCHDOG_PATH}' | sudo tee {WATCHDOG_CRON} > /dev/null",
+    ]
+
+def _tag(description: dict, key: str):
+    for tag in description.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+def _parse_expiry(value: str):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+class Reaper:
+    '''
+    Finds and terminates expired instances in bulk.
+
+    One paginated `describe_instances` per region, all regions concurrently, lists every live instance carrying an `ExpiresAt` tag. Those past
+    their expiry are terminated with the batched `terminate_instances` when they are in the local registry or tagged
+    with our username; `everyone` widens that to instances launched by anyone. `prune` drops registry records of
+    instances that no longer exist.
+
+    clock: callable = seconds since the epoch, swap for a fake in tests
+    '''
+    def __init__(self, factory, username: str = None, everyone: bool = False, clock=time.time):
+        self.factory = factory
+        self.username = username
+        self.everyone = everyone
+        self.clock = clock
+
+    async def _scan_region(self, region: str):
+        '''every live instance with an `ExpiresAt` tag in one region, paginated'''
+        client = self.factory._client(region)
+        kwargs = {'Filters': [
+            {'Name': 'tag-key', 'Values': [EXPIRES_AT_TAG]},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']},
+        ]}
+        descriptions = []
+        while True:
+            page = await client.acall('describe_instances', **kwargs)
+            for reservation in page['Reservations']:
+                descriptions += reservation['Instances']
+            if not page.get('NextToken'):
+                return descriptions
+            kwargs['NextToken'] = page['NextToken']
+
+    def scan(self, regions: list = None):
+        '''list of dicts describing every tagged instance and whether it is expired and ours to reap, all regions concurrently'''
+        registry = get_registry()
+        records = {record['instance_id']: record for record in registry.instances()}
+        regions = regions or sorted(set([self.factory.region] + [record['region'] for record in records.values() if record['region']]))
+
+        now = self.clock()
+        rows = []
+        results = gather(*[self._scan_region(region) for region in regions], return_exceptions=True)
+        for region, result in zip(regions, results):
+            if isinstance(result, BaseException):
+                print(f'could not scan {region}: {result}')
+                continue
+            for description in result:
+                instance_id = description['InstanceId']
+                expires_at = _parse_expiry(_tag(description, EXPIRES_AT_TAG))
+                record = records.get(instance_id)
+                ours = record is not None or (self.username is not None and _tag(description, 'Username') == self.username)
+                launched = description.get('LaunchTime')
+                hours = (now - launched.timestamp()) / 3600 if hasattr(launched, 'timestamp') else None
+                rows.append({
+                    'instance_id': instance_id,
+                    'region': region,
+                    'project': record['project'] if record else None,
+                    'instance_type': description.get('InstanceType'),
+                    'state': description['State']['Name'],
+                    'expires_at': expires_at,
+                    'expired': expires_at is not None and now >= expires_at,
+                    'reap': expires_at is not None and now >= expires_at and (ours or self.everyone),
+                    'estimated_cost_usd': estimate_cost(description.get('InstanceType'), hours),
+                    'spot_request_id': record['spot_request_id'] if record else description.get('SpotInstanceRequestId'),
+                })
+
+        return rows
+
+    def prune(self):
+        '''drop registry records of instances EC2 no longer knows about or has terminated, returns their ids'''
+        registry = get_registry()
+        records = registry.instances()
+        descriptions = self.factory.describe_records(records)
+        gone = [
+            record['instance_id'] for record in records
+            if record['instance_id'] not in descriptions or descriptions[record['instance_id']]['State']['Name'] == 'terminated'
+        ]
+        registry.remove(gone)
+
+        return gone
+
+    def reap(self, rows: list = None):
+        '''
+        terminate every expired instance that is ours to reap, returns the scan rows of those reaped
+
+        rows: list = result of an earlier `scan`, scanned afresh when not given
+        '''
+        rows = self.scan() if rows is None else rows
+        doomed = [row for row in rows if row['reap']]
+        if doomed:
+            records = [
+                get_registry().get(row['instance_id']) or {'instance_id': row['instance_id'], 'region': row['region'], 'project': row['project'], 'spot_request_id': row['spot_request_id']}
+                for row in doomed
+            ]
+            self.factory.terminate_instances(records)
+
+        return doomed
+
+def print_reap_report(rows: list, now: float = None):
+    now = time.time() if now is None else now
+    header = ['instance_id', 'region', 'project', 'instance_type', 'state', 'expires', 'est_cost_usd', 'action']
+    table = []
+    for row in rows:
+        minutes = (row['expires_at'] - now) / 60 if row['expires_at'] else None
+        expires = '-' if minutes is None else (f'{-minutes:.0f}m ago' if minutes < 0 else f'in {minutes:.0f}m')
+        action = 'reap' if row['reap'] else ('expired, not ours' if row['expired'] else 'keep')
+        table.append([row['instance_id'], row['region'], row['project'] or '-', row['instance_type'], row['state'], expires,
+                      '-' if row['estimated_cost_usd'] is None else row['estimated_cost_usd'], action])
+    print_table(header, table)
@@ -0,0 +1,336 @@
+#This module spreads a parameterised command over a queue of work items across the worker slots of many ec2 instances
+import glob
+import json
+import os
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from launch_control.fanout import error_status
+from launch_control.jobs import new_job_id
+from launch_control.registry import get_registry
+from launch_control.trace import tracer
+from launch_control.utils import print_table
+from launch_control.vars import LAUNCH_CONTROL_DIR
+
+# commands multiplexed over one ssh connection at a time, sshd's default MaxSessions
+MAX_SLOTS = 10
+
+# consecutive errors (not commands exiting non zero) after which a host is given up on and its slots stop taking work
+HOST_ERROR_LIMIT = 3
+
+def load_items(source: str, root: str = None):
+    '''
+    work items from a file with one item per line (blank lines and # comments skipped), otherwise the sorted paths matching a glob
+
+    root: str = local project folder; glob matches are made relative to it, since that is where the commands run on the
+    instances, and must lie inside it
+    '''
+    if os.path.isfile(source):
+        with open(source) as f:
+            items = [line.strip() for line in f]
+        return [item for item in items if item and not item.startswith('#')]
+
+    items = sorted(glob.glob(source, recursive=True))
+    if not items:
+        raise BaseException(f'{source} is neither a file of items nor a glob matching any paths')
+    if root is None:
+        return items
+
+    relative = [os.path.relpath(os.path.abspath(item), os.path.abspath(root)) for item in items]
+    outside = [item for item, path in zip(items, relative) if path == os.pardir or path.startswith(os.pardir + os.sep)]
+    if outside:
+        raise BaseException(f"{', '.join(outside[:3])}{' ...' if len(outside) > 3 else ''} outside the project folder {root}, glob items must be inside it")
+    return [path.replace(os.sep, '/') for path in relative]
+
+def render_command(template: str, item: str, index: int):
+    '''
+    the command for one work item
+
+    `{item}` becomes the shell quoted item, `{stem}` its file name without extension and `{index}` its position in the
+    input; a template without `{item}` gets the item appended as its last argument, like xargs
+    '''
+    # plain replaces rather than str.format, so ${VAR} and awk braces in the template survive
+    if '{item}' not in template:
+        template = template + ' {item}'
+    stem = os.path.splitext(os.path.basename(item.rstrip('/')))[0]
+    return template.replace('{item}', shlex.quote(item)).replace('{stem}', shlex.quote(stem)).replace('{index}', str(index))
+
+def load_manifest(path: str):
+    '''records of a results manifest, [] when it doesn't exist yet'''
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class MapItem:
+    def __init__(self, index: int, item: str, estimate: float = None):
+        self.index = index
+        self.item = item
+        self.estimate = estimate
+        self.status = 'pending'
+        self.attempts = []
+        self.failed_on = set()
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+class MapHost:
+    def __init__(self, ec2_instance, slots: int = 0):
+        self.ec2_instance = ec2_instance
+        self.instance_id = ec2_instance.instance_id
+        self.slots = slots
+        self.errors = 0
+        self.lost = None
+        self.ok = 0
+        self.failed = 0
+        self.busy = 0.0
+
+class MapScheduler:
+    '''
+    Runs `template` once per work item across the slots of every instance.
+
+    Each slot is a thread holding one remote command at a time over the host's multiplexed ssh connection, and takes the
+    next item off a shared queue as soon as it is free, so fast hosts and short items never wait on slow ones. The queue
+    is ordered longest first by the runtime each item took the last time this template ran (from the registry), so the
+    long items start early instead of trailing at the end. A failed item goes back to the front of the queue for a host
+    it hasn't failed on yet, up to `retries` times; a host erroring `HOST_ERROR_LIMIT` times in a row is given up on.
+
+    Every finished item is appended to a json lines manifest with its status, exit code, host, attempts and local log
+    files. Items already `ok` in an existing manifest are skipped, so an interrupted map resumes where it stopped.
+    '''
+    def __init__(self, ec2_instances: list, template: str, items: list, ssh_key_file: str, project: str = None, cd: str = None, slots: int = 0,
+                 retries: int = 2, timeout: float = None, manifest_path: str = None, progress=print, clock=time.monotonic):
+        '''
+        cd: str = remote directory to run the commands in
+        slots: int = commands run at the same time per instance, 0 for its cpu count; at most `MAX_SLOTS`
+        retries: int = times a failed item is run again
+        timeout: float = seconds a single item may run
+        '''
+        self.template = template
+        self.ssh_key_file = ssh_key_file
+        self.project = project
+        self.cd = cd
+        self.slots = min(slots, MAX_SLOTS)
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.clock = clock
+        self.map_id = new_job_id()
+        self.log_dir = f'{LAUNCH_CONTROL_DIR()}/maps/{self.map_id}'
+        self.manifest_path = manifest_path or f'{self.log_dir}/manifest.jsonl'
+        self.hosts = [MapHost(ec2_instance) for ec2_instance in ec2_instances]
+        self.runtimes = {}
+        self.wall = None
+
+        if slots > MAX_SLOTS:
+            progress(f'at most {MAX_SLOTS} commands share an ssh connection, using {MAX_SLOTS} slots per instance')
+
+        done = set(record['item'] for record in load_manifest(self.manifest_path) if record['status'] == 'ok')
+        self.skipped = sum(item in done for item in items)
+        history = get_registry().map_runtimes(project or '', template)
+        known = [history[item] for item in items if item in history]
+        # items never seen before are assumed to take as long as the average one
+        default = sum(known) / len(known) if known else 0
+        self.items = [MapItem(index, item, history.get(item, default)) for index, item in enumerate(items) if item not in done]
+
+        self._queue = sorted(self.items, key=lambda item: -item.estimate)
+        self._running = 0
+        self._finished = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def _connect(self, host: MapHost):
+        '''open the host's connection and size its slots'''
+        try:
+            host.ec2_instance.create_ssh_connection(ssh_key_file=self.ssh_key_file, multiplex=True)
+            # always run one command first; it brings up the ControlMaster, so the slots don't race each other to create it
+            response = host.ec2_instance.run_bash_command('nproc', hide=True)
+            # ~/.profile may print, the count is the last word
+            slots = self.slots or int(response.stdout.split()[-1])
+            host.slots = max(1, min(slots, MAX_SLOTS))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            host.lost = f'{type(e).__name__}: {e}'
+            self.progress(f'{host.instance_id}: could not connect, leaving it out: {host.lost}')
+
+    def _eligible(self, item: MapItem, host: MapHost):
+        if host.instance_id not in item.failed_on:
+            return True
+        # every host still taking work has failed it, let any of them have another go
+        return all(other.instance_id in item.failed_on for other in self.hosts if other.lost is None)
+
+    def _take(self, host: MapHost):
+        '''the next item this host should run, None once there is nothing left for it'''
+        with self._cond:
+            while True:
+                if self._stopped or host.lost:
+                    return None
+                for i, item in enumerate(self._queue):
+                    if self._eligible(item, host):
+                        del self._queue[i]
+                        item.status = 'running'
+                        self._running += 1
+                        return item
+                if not self._queue and not self._running:
+                    return None
+                # a running item may fail and come back, or a host be given up on
+                self._cond.wait()
+
+    def _attempt(self, host: MapHost, item: MapItem):
+        number = len(item.attempts) + 1
+        command = render_command(self.template, item.item, item.index)
+        if self.cd:
+            command = f'cd {self.cd} && {command}'
+        attempt = {
+            'instance_id': host.instance_id,
+            'attempt': number,
+            'exit': None,
+            'stdout': f'{self.log_dir}/{item.index}.{number}.stdout',
+            'stderr': f'{self.log_dir}/{item.index}.{number}.stderr',
+        }
+
+        start = self.clock()
+        with tracer.span('map_item', 'map', target=host.instance_id, item=item.item) as span, \
+                open(attempt['stdout'], 'w') as out_stream, open(attempt['stderr'], 'w') as err_stream:
+            try:
+                response = host.ec2_instance.run_bash_command(command, pty=False, warn=True, out_stream=out_stream, err_stream=err_stream, timeout=self.timeout)
+                attempt['exit'] = response.exited
+                attempt['status'] = 'ok' if response.exited == 0 else 'failed'
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                attempt['status'] = error_status(e)
+                attempt['error'] = f'{type(e).__name__}: {e}'
+            span['status'] = attempt['status']
+        attempt['duration'] = self.clock() - start
+
+        return attempt
+
+    def _finish(self, host: MapHost, item: MapItem, attempt: dict):
+        with self._cond:
+            self._running -= 1
+            item.attempts.append(attempt)
+            host.busy += attempt['duration']
+
+            if attempt['status'] == 'error':
+                host.errors += 1
+                if host.errors >= HOST_ERROR_LIMIT and host.lost is None:
+                    host.lost = attempt['error']
+                    self.progress(f'{host.instance_id}: {host.errors} errors in a row, no more work for it: {host.lost}')
+            else:
+                host.errors = 0
+
+            if attempt['status'] == 'ok':
+                item.status = 'ok'
+                host.ok += 1
+                self.runtimes[item.item] = attempt['duration']
+            else:
+                host.failed += 1
+                item.failed_on.add(host.instance_id)
+                if len(item.attempts) <= self.retries:
+                    # retries go first so they don't end up trailing the run
+                    item.status = 'pending'
+                    self._queue.insert(0, item)
+                else:
+                    item.status = attempt['status']
+
+            if item.status == 'pending':
+                self.progress(f"{item.item} {attempt['status']} on {host.instance_id}, retrying ({len(item.attempts)}/{self.retries})")
+            else:
+                self._finished += 1
+                self._record(item)
+                self.progress(f"[{self._finished}/{len(self.items)}] {item.item} {item.status} on {host.instance_id} in {attempt['duration']:.1f}s")
+
+            self._cond.notify_all()
+
+    def _record(self, item: MapItem):
+        '''append the final state of an item to the manifest'''
+        last = item.attempts[-1] if item.attempts else {}
+        record = {
+            'map_id': self.map_id,
+            'index': item.index,
+            'item': item.item,
+            'status': item.status,
+            'exit': last.get('exit'),
+            'instance_id': last.get('instance_id'),
+            'duration': last.get('duration'),
+            'command': render_command(self.template, item.item, item.index),
+            'attempts': item.attempts,
+        }
+        with open(self.manifest_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _slot(self, host: MapHost):
+        while True:
+            item = self._take(host)
+            if item is None:
+                return
+            self._finish(host, item, self._attempt(host, item))
+
+    def run(self):
+        '''run every item, returns the `MapItem`s in input order'''
+        Path(self.log_dir).mkdir(parents=True, exist_ok=True)
+        Path(os.path.dirname(os.path.abspath(self.manifest_path))).mkdir(parents=True, exist_ok=True)
+        start = self.clock()
+
+        if self.items:
+            with ThreadPoolExecutor(max_workers=max(1, min(len(self.hosts), 32))) as pool:
+                list(pool.map(self._connect, self.hosts))
+
+        threads = [
+            threading.Thread(target=self._slot, args=(host,), name=f'{host.instance_id}/{slot}', daemon=True)
+            for host in self.hosts if host.lost is None for slot in range(host.slots)
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # join in short waits so ctrl-c gets through
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            raise
+        finally:
+            self.wall = self.clock() - start
+            if self.runtimes:
+                get_registry().set_map_runtimes(self.project or '', self.template, self.runtimes)
+
+        # no host left that could take them
+        for item in self._queue:
+            item.status = 'not_run'
+            self._record(item)
+
+        return self.items
+
+def print_map_report(scheduler: MapScheduler):
+    '''per host throughput, the items that did not succeed and where the manifest is'''
+    wall = scheduler.wall or 0
+    header = ['instance_id', 'slots', 'ok', 'failed', 'busy', 'utilisation', '']
+    rows = [
+        [host.instance_id, host.slots, host.ok, host.failed, f'{host.busy:.1f}s',
+         f'{host.busy / (host.slots * wall):.0%}' if host.slots and wall else '-', f'lost: {host.lost}' if host.lost else '']
+        for host in scheduler.hosts
+    ]
+    print()
+    print_table(header, rows)
+
+    items = scheduler.items
+    failed = [item for item in items if not item.ok]
+    retried = sum(len(item.attempts) > 1 for item in items)
+    print(f'{len(items) - len(failed)}/{len(items)} items succeeded in {wall:.1f}s, {retried} after a retry')
+    if scheduler.skipped:
+        print(f'{scheduler.skipped} item(s) already ok in the manifest were skipped')
+    for item in failed[:20]:
+        last = item.attempts[-1] if item.attempts else {}
+        print(f"{item.item}: {item.status} after {len(item.attempts)} attempt(s){', see ' + last['stderr'] if last else ''}")
+    if len(failed) > 20:
+        print(f'... and {len(failed) - 20} more')
+    print(f'manifest written to {scheduler.manifest_path}')
@@ -0,0 +1,239 @@
+#This module keeps warm pools of stopped, already bootstrapped instances so launches start an instance instead of creating one
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from launch_control.aws import error_code
+from launch_control.cache import metadata_cache
+from launch_control.lifecycle import EXPIRES_AT_TAG, TTL_TAG
+from launch_control.registry import get_registry
+from launch_control.utils import print_table
+from launch_control.vars import LAUNCH_CONTROL_DIR
+
+# pool row states; launched and being bootstrapped/stopped, ready to start, being started by a launch
+POOL_STATES = ['warming', 'stopped', 'claimed']
+
+# a fill that has not finished within this many seconds is assumed dead and another one may start
+FILL_LEASE_TTL = 1800
+
+# instance states that can no longer be started
+GONE_STATES = ('shutting-down', 'terminated')
+
+class WarmPool:
+    '''
+    Up to `size` stopped instances of one (project, instance type, region) that already went through the bootstrap.
+
+    Pooled instances are on demand (one time spot instances can't be stopped) and are recorded in the registry under
+    `<project>.pool` so they show up in `lc list` and `lc terminate --all`. Pool membership and state live in the registry
+    `pool` table; claims take the sqlite write lock first, so concurrent `lc` runs never start the same instance.
+    '''
+    def __init__(self, factory, project_name: str, instance_type: str, region: str = None):
+        self.factory = factory
+        self.project_name = project_name
+        self.instance_type = instance_type
+        self.region = region or factory.region
+
+    @property
+    def pool_project(self):
+        return f'{self.project_name}.pool'
+
+    @property
+    def lease_name(self):
+        return f'pool_fill:{self.project_name}:{self.instance_type}:{self.region}'
+
+    @property
+    def size(self):
+        return get_registry().pool_size(self.project_name, self.instance_type, self.region)
+
+    @size.setter
+    def size(self, size: int):
+        get_registry().set_pool_size(self.project_name, self.instance_type, self.region, size)
+
+    def members(self):
+        return get_registry().pool_instances(self.project_name, self.instance_type, self.region)
+
+    def claim(self, count: int, tags: list = None):
+        '''
+        start up to `count` pooled instances for the project, returns the running `EC2Instance`s (possibly fewer, or none)
+
+        claimed instances leave the pool and are recorded under the project like freshly launched ones
+        tags: list = tags of the launch, e.g. its name and expiry, replacing those of the pool
+        '''
+        registry = get_registry()
+        instance_ids = registry.claim_pool_instances(self.project_name, self.instance_type, self.region, count)
+        if not instance_ids:
+            return []
+
+        client = self.factory._client(self.region)
+        descriptions = self.factory.describe_instances(instance_ids, region=self.region)
+        gone = [instance_id for instance_id in instance_ids if instance_id not in descriptions or descriptions[instance_id]['State']['Name'] in GONE_STATES]
+        startable = [instance_id for instance_id in instance_ids if instance_id in descriptions and descriptions[instance_id]['State']['Name'] == 'stopped']
+        # still stopping, leave them for the next launch
+        registry.set_pool_state([instance_id for instance_id in instance_ids if instance_id not in gone + startable], 'stopped')
+        if gone:
+            print(f'dropping {len(gone)} pooled instance(s) that no longer exist')
+            registry.remove(gone)
+
+        if not startable:
+            return []
+
+        try:
+            client.start_instances(InstanceIds=startable)
+        except Exception as e:
+            # e.g. InsufficientInstanceCapacity; hand them back and let the caller launch cold
+            print(f'could not start pooled instances ({error_code(e) or e}), launching new ones instead')
+            registry.set_pool_state(startable, 'stopped')
+            return []
+
+        registry.remove_pool_instances(startable)
+        if tags:
+            client.create_tags(Resources=startable, Tags=tags)
+        for instance_id in startable:
+            registry.add(instance_id, project=self.project_name, region=self.region)
+            metadata_cache.invalidate(instance_id)
+
+        print(f'started {len(startable)} warm instance(s) from the pool, polling untill running...')
+        self.factory.poll_instances_until_running(instance_ids=startable, region=self.region)
+
+        return self.factory._track_instances(startable, region=self.region)
+
+    def fill(self, pipeline, **launch_kwargs):
+        '''
+        launch, bootstrap and stop instances untill the pool holds `size` of them, returns how many were added
+
+        pipeline: BootstrapPipeline = bootstraps new members exactly like a regular launch
+        launch_kwargs are passed on to `launch_fleet`, e.g. tags, image_id and key_pair_name
+        '''
+        registry = get_registry()
+        if not registry.acquire_lease(self.lease_name, FILL_LEASE_TTL):
+            print('the pool is already being filled by another lc process')
+            return 0
+
+        try:
+            missing = self.size - len(self.members())
+            if missing <= 0:
+                return 0
+
+            print(f'filling the {self.project_name} {self.instance_type} pool with {missing} instance(s)...')
+            launch_kwargs['instance_type'] = self.instance_type
+            instances = self.factory.launch_fleet(count=missing, project_name=self.pool_project, on_demand=True, **launch_kwargs)
+            registry.add_pool_instances([instance.instance_id for instance in instances], self.project_name, self.instance_type, self.region, 'warming')
+
+            results = pipeline.run(instances)
+            ready = [result.instance_id for result in results if result.ok]
+            failed = [result.instance_id for result in results if not result.ok]
+            for result in results:
+                if not result.ok:
+                    print(f'{result.instance_id}: bootstrap failed at {result.failed_stage}: {result.error}')
+            if failed:
+                self.factory.terminate_instances([registry.get(instance_id) for instance_id in failed])
+
+            if ready:
+                self.stop(ready)
+
+            return len(ready)
+        finally:
+            registry.release_lease(self.lease_name)
+
+    def stop(self, instance_ids: list):
+        '''stop instances and make them claimable members of the pool'''
+        registry = get_registry()
+        registry.add_pool_instances(instance_ids, self.project_name, self.instance_type, self.region, 'warming')
+        for instance_id in instance_ids:
+            registry.add(instance_id, project=self.pool_project, region=self.region)
+
+        client = self.factory._client(self.region)
+        # a stopped member must not look expired to `lc reap`, claims tag it afresh
+        client.delete_tags(Resources=list(instance_ids), Tags=[{'Key': key} for key in (EXPIRES_AT_TAG, TTL_TAG)])
+        client.stop_instances(InstanceIds=list(instance_ids))
+        self.factory.poll_instances_until_stopped(instance_ids=instance_ids, region=self.region)
+        registry.set_pool_state(instance_ids, 'stopped')
+
+    def release(self, records: list):
+        '''
+        idle policy for instances the project is done with; stop them back into the pool while it has room, terminate the rest
+
+        records: list = registry records of instances of this pool's instance type
+        '''
+        room = max(0, self.size - len(self.members()))
+        keep, surplus = records[:room], records[room:]
+
+        if surplus:
+            self.factory.terminate_instances(surplus)
+        if keep:
+            print(f'stopping {len(keep)} instance(s) back into the {self.project_name} {self.instance_type} pool')
+            self.stop([record['instance_id'] for record in keep])
+
+        return len(keep)
+
+    def drain(self):
+        '''terminate every member of the pool'''
+        registry = get_registry()
+        records = [registry.get(member['instance_id']) or dict(member, spot_request_id=None) for member in self.members()]
+        if records:
+            self.factory.terminate_instances(records)
+        registry.remove_pool_instances([record['instance_id'] for record in records])
+
+def release_instances(factory, project_name: str, records: list):
+    '''
+    stop a project's instances into its warm pools where configured and terminate everything else
+
+    returns the number of instances stopped
+    '''
+    if not records:
+        return 0
+
+    descriptions = factory.describe_records(records)
+    by_pool = {}
+    for record in records:
+        description = descriptions.get(record['instance_id'])
+        if description is None or description['State']['Name'] != 'running' or description.get('InstanceLifecycle') == 'spot':
+            # spot instances can't be stopped
+            by_pool.setdefault(None, []).append(record)
+        else:
+            by_pool.setdefault((description['InstanceType'], record['region'] or factory.region), []).append(record)
+
+    stopped = 0
+    for key, pool_records in by_pool.items():
+        if key is None:
+            factory.terminate_instances(pool_records)
+        else:
+            stopped += WarmPool(factory, project_name, *key).release(pool_records)
+
+    return stopped
+
+def has_pool(project_name: str, region: str = None):
+    '''whether the project has a warm pool configured, in any region when `region` is None'''
+    return any(size > 0 and region in (None, key[2]) for key, size in get_registry().pool_sizes(project_name).items())
+
+def refill_in_background(project_path: str, instance_type: str, region: str, profile: str = None):
+    '''top the pool back up in a detached `lc pool --fill` so the launch that claimed from it doesn't wait'''
+    log_dir = f'{LAUNCH_CONTROL_DIR()}/pool'
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+    log_path = f'{log_dir}/{os.path.basename(os.path.abspath(project_path))}.log'
+
+    command = [sys.executable, '-m', 'launch_control', '--region', region]
+    if profile:
+        command += ['--profile', profile]
+    command += ['pool', os.path.abspath(project_path), '--instance_type', instance_type, '--fill']
+
+    with open(log_path, 'a') as log:
+        subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    print(f'refilling the pool in the background, see {log_path}')
+
+def print_pool(records: list, sizes: dict):
+    '''
+    records: list = pool rows
+    sizes: dict = (project, instance_type, region) -> configured size
+    '''
+    counts = {}
+    for record in records:
+        key = (record['project'], record['instance_type'], record['region'])
+        counts.setdefault(key, {state: 0 for state in POOL_STATES})[record['state']] += 1
+    for key in sizes:
+        counts.setdefault(key, {state: 0 for state in POOL_STATES})
+
+    header = ['project', 'instance_type', 'region', 'size'] + POOL_STATES
+    rows = [list(key) + [sizes.get(key, 0)] + [state_counts[state] for state in POOL_STATES] for key, state_counts in sorted(counts.items())]
+    print_table(header, rows)
@@ -0,0 +1,182 @@
+#This module relates to instance pricing and cost estimates; on demand rates, live spot prices and picking the cheapest instance type
+import datetime
+import time
+
+from launch_control.registry import get_registry
+from launch_control.utils import print_table
+
+# approximate on demand linux prices in USD/hour (eu-west-1), used for rough cost estimates and as the spot bid ceiling
+ON_DEMAND_HOURLY_USD = {
+    'm5.xlarge': 0.214,
+    'm5.2xlarge': 0.428,
+    'm5.4xlarge': 0.856,
+    'm5.12xlarge': 2.568,
+    'm5.24xlarge': 5.136,
+    'r4.4xlarge': 1.186,
+    'r4.8xlarge': 2.371,
+    'r4.16xlarge': 4.742,
+    'r3.8xlarge': 2.964,
+    'r5.4xlarge': 1.128,
+    'r5.8xlarge': 2.256,
+    'r5.12xlarge': 3.384,
+    'r5.16xlarge': 4.512,
+    'r5.24xlarge': 6.768,
+    'r5d.4xlarge': 1.28,
+    'r5d.8xlarge': 2.56,
+    'r5d.12xlarge': 3.84,
+    'r5d.16xlarge': 5.12,
+    'r5d.24xlarge': 7.68,
+}
+
+# (vCPUs, memory GiB) of the instance types we are willing to launch
+INSTANCE_SPECS = {
+    'm5.xlarge': (4, 16),
+    'm5.2xlarge': (8, 32),
+    'm5.4xlarge': (16, 64),
+    'm5.12xlarge': (48, 192),
+    'm5.24xlarge': (96, 384),
+    'r4.4xlarge': (16, 122),
+    'r4.8xlarge': (32, 244),
+    'r4.16xlarge': (64, 488),
+    'r3.8xlarge': (32, 244),
+    'r5.4xlarge': (16, 128),
+    'r5.8xlarge': (32, 256),
+    'r5.12xlarge': (48, 384),
+    'r5.16xlarge': (64, 512),
+    'r5.24xlarge': (96, 768),
+    'r5d.4xlarge': (16, 128),
+    'r5d.8xlarge': (32, 256),
+    'r5d.12xlarge': (48, 384),
+    'r5d.16xlarge': (64, 512),
+    'r5d.24xlarge': (96, 768),
+}
+
+# spot prices move slowly, refetching them on every launch only costs api calls
+SPOT_PRICE_TTL = 600
+
+# `--bid market` bids this much above the current spot price, capped at the on demand price
+BID_HEADROOM = 1.25
+
+# on_demand: no max price, AWS caps the price at the on demand rate of the region; market: a little above the current spot price
+BID_STRATEGIES = ['on_demand', 'market']
+
+def estimate_cost(instance_type: str, hours: float):
+    '''estimated cost in USD of running `instance_type` for `hours`, None if we have no price for it'''
+    price = ON_DEMAND_HOURLY_USD.get(instance_type)
+    if price is None or hours is None:
+        return None
+
+    return round(price * hours, 2)
+
+def candidate_types(min_vcpu: int = 0, min_mem: float = 0):
+    '''known instance types with at least `min_vcpu` vCPUs and `min_mem` GiB of memory'''
+    return [instance_type for instance_type, (vcpu, mem) in INSTANCE_SPECS.items() if vcpu >= min_vcpu and mem >= min_mem]
+
+def max_price_kwargs(spot_price: str = None):
+    '''the SpotPrice parameter of a spot request, left out without a bid so AWS caps at the on demand price'''
+    return {'SpotPrice': spot_price} if spot_price else {}
+
+def bid_price(instance_type: str, spot_price: float, headroom: float = BID_HEADROOM):
+    '''spot bid for `instance_type` as the string boto3 expects; a little above the market, never above on demand'''
+    bid = spot_price * headroom
+    on_demand = ON_DEMAND_HOURLY_USD.get(instance_type)
+    if on_demand is not None:
+        bid = min(bid, on_demand)
+
+    return f'{bid:.5f}'
+
+class SpotPriceBook:
+    '''
+    Current spot prices per (instance type, AZ) for one region.
+
+    Prices come from `describe_spot_price_history` and are cached in the local registry for `ttl` seconds, so repeated
+    launches and `lc prices` don't hit the api every time.
+    '''
+    def __init__(self, ec2_client, region: str, ttl: float = SPOT_PRICE_TTL, clock=time.time):
+        self.client = ec2_client
+        self.region = region
+        self.ttl = ttl
+        self.clock = clock
+
+    def prices(self, instance_types: list):
+        '''dict of (instance_type, availability_zone) -> USD/hour, types not offered as spot are left out'''
+        registry = get_registry()
+        cached = registry.spot_prices(self.region, list(instance_types))
+
+        fresh = {}
+        for row in cached:
+            if self.clock() - row['fetched_at'] <= self.ttl:
+                fresh[(row['instance_type'], row['availability_zone'])] = row['price']
+
+        stale = [instance_type for instance_type in instance_types if not any(key[0] == instance_type for key in fresh)]
+        if stale:
+            fetched = self._fetch(stale)
+            registry.set_spot_prices(self.region, fetched, self.clock())
+            fresh.update(fetched)
+
+        return fresh
+
+    def _fetch(self, instance_types: list):
+        '''latest price per (instance type, AZ), one paginated call for all types'''
+        prices = {}
+        timestamps = {}
+        paginator = self.client.get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(
+            InstanceTypes=list(instance_types),
+            ProductDescriptions=['Linux/UNIX'],
+            # a start time of now returns just the current price of every AZ
+            StartTime=datetime.datetime.now(datetime.timezone.utc),
+        )
+        for page in pages:
+            for entry in page['SpotPriceHistory']:
+                key = (entry['InstanceType'], entry['AvailabilityZone'])
+                if key not in timestamps or entry['Timestamp'] > timestamps[key]:
+                    timestamps[key] = entry['Timestamp']
+                    prices[key] = float(entry['SpotPrice'])
+
+        return prices
+
+def rank_spot_offers(price_book: SpotPriceBook, min_vcpu: int = 0, min_mem: float = 0, rank_by: str = 'vcpu', instance_types: list = None):
+    '''
+    every (instance type, AZ) meeting the resource spec, cheapest first
+
+    rank_by: str = 'vcpu' (USD per vCPU hour), 'mem' (USD per GiB hour) or 'price' (USD per instance hour)
+    instance_types: list = candidates, defaults to every known type meeting the spec
+    '''
+    instance_types = instance_types or candidate_types(min_vcpu, min_mem)
+    if not instance_types:
+        raise BaseException(f'no known instance type has {min_vcpu} vCPUs and {min_mem} GiB of memory')
+
+    offers = []
+    for (instance_type, availability_zone), price in price_book.prices(instance_types).items():
+        vcpu, mem = INSTANCE_SPECS.get(instance_type, (None, None))
+        unit = {'vcpu': vcpu, 'mem': mem, 'price': 1}[rank_by]
+        offers.append({
+            'instance_type': instance_type,
+            'availability_zone': availability_zone,
+            'vcpu': vcpu,
+            'memory_gib': mem,
+            'spot_price': price,
+            'on_demand_price': ON_DEMAND_HOURLY_USD.get(instance_type),
+            'unit_price': price / unit if unit else None,
+            'bid': bid_price(instance_type, price),
+        })
+
+    return sorted(offers, key=lambda offer: (offer['unit_price'] is None, offer['unit_price'], offer['instance_type'], offer['availability_zone']))
+
+def market_bid(price_book: SpotPriceBook, instance_types: list):
+    '''one bid covering every AZ of `instance_types`, None when there is no spot price data for them'''
+    bids = [float(bid_price(instance_type, price)) for (instance_type, _), price in price_book.prices(instance_types).items()]
+    if not bids:
+        return None
+
+    return f'{max(bids):.5f}'
+
+def print_spot_offers(offers: list, rank_by: str = 'vcpu', limit: int = 10):
+    header = ['instance_type', 'az', 'vcpu', 'mem_gib', 'spot_usd_h', 'on_demand_usd_h', f'usd_per_{rank_by}_h', 'bid']
+    rows = [
+        [offer['instance_type'], offer['availability_zone'], offer['vcpu'], offer['memory_gib'], f"{offer['spot_price']:.4f}",
+         '-' if offer['on_demand_price'] is None else offer['on_demand_price'], f"{offer['unit_price']:.5f}", offer['bid']]
+        for offer in offers[:limit]
+    ]
+    print_table(header, rows)
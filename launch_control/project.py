@@ -1,11 +1,14 @@
 #This module relates to classes and helper functions for creating and managing project folders.
 import os
-import time
 import subprocess
 import textwrap
 
 from launch_control.utils import run_bash
 from launch_control.config import _BasicConfig
+from launch_control.trace import traced
+
+# github org projects are cloned from when neither the config nor the local origin say otherwise
+DEFAULT_GITHUB_ORG = 'jumo'
 
 def determine_project_type(path: str):
     files = os.listdir(path)
@@ -70,60 +73,91 @@ class GitProject(Project):
         super().__init__(**kwargs)
 
     def _get_repo_name(self):
+        if getattr(self, '_repo_name', None):
+            return self._repo_name
+
         bashCommand = "echo $(basename `git rev-parse --show-toplevel`)"
         try:
             process = subprocess.Popen(bashCommand, stdout=subprocess.PIPE,cwd=self.path,shell=True)
             output, error = process.communicate()
-            return output.decode('utf-8').strip()
+            self._repo_name = output.decode('utf-8').strip()
+            return self._repo_name
         except:
             raise BaseException(error)
         
 
     def _get_current_branch(self):
+        if getattr(self, '_branch', None):
+            return self._branch
+
         bashCommand = "echo $(git rev-parse --symbolic-full-name --abbrev-ref HEAD)"
         try:
             process = subprocess.Popen(bashCommand, stdout=subprocess.PIPE,cwd=self.path,shell=True)
             output, error = process.communicate()
-            return output.decode('utf-8').strip()
+            self._branch = output.decode('utf-8').strip()
+            return self._branch
         except:
             raise BaseException(error)
 
         return run_bash(f"$(cd {self.path} & git rev-parse --symbolic-full-name --abbrev-ref HEAD)")
 
-    def clone_remote(self, ec2_instance, ssh_key_file: str, pat: str):
+    def _get_origin_url(self):
+        process = subprocess.run(['git', 'config', '--get', 'remote.origin.url'], capture_output=True, cwd=self.path)
+        return process.stdout.decode('utf-8').strip()
+
+    def remote_url(self, pat: str, org: str = None):
         '''
-        use github pat to clone the project on remote
+        https url to clone the project from on remote, authenticated with the github pat
+
+        pat: str = github personal access token, None for the bare url without credentials
+        org: str = github org (or user) to clone from, defaults to the org of the local origin remote, then `DEFAULT_GITHUB_ORG`
+        '''
+        PACKAGE = self._get_repo_name()
+        if org is None:
+            origin = self._get_origin_url()
+            if 'github.com' in origin:
+                # git@github.com:org/repo.git or https://github.com/org/repo.git
+                org = origin.split('github.com')[1].lstrip(':/').split('/')[0]
+            else:
+                org = DEFAULT_GITHUB_ORG
+
+        auth = f'{pat}@' if pat else ''
+        return f'https://{auth}github.com/{org}/{PACKAGE}.git'
+
+    def clone_command(self, pat: str, org: str = None, depth: int = 1):
+        '''
+        idempotent bash snippet that clones the project on remote, or fetches it if already cloned
+
+        depth: int = history to fetch, 1 for a shallow clone of the branch tip, 0 for a blobless partial clone of the full history
         '''
         PACKAGE=self._get_repo_name()
         VERSION=self._get_current_branch()
+        url = self.remote_url(pat, org=org)
 
-        ec2_instance.poll_instance_ready(ssh_key_file=ssh_key_file)
-
-        # ec2_instance.create_ssh_connection(ssh_key_file=ssh_key_file)
-        # #check if instance is available
-        # print('waiting for ssh')
-        # response = ''
-        # retries = 0
-        # while not response:
-        #     try:
-        #         response = ec2_instance.run_bash_command('uname',pty=True)
-        #     except:
-        #         time.sleep(5)
-        #     finally:
-        #         retries += 1
-        #         if retries > 13:
-        #             print(f'tried {retries} times and could not connect to ec2 instance')
-        #             break
+        if depth:
+            clone_args = f'--depth {depth} --single-branch --branch {VERSION}'
+            fetch_args = f' --depth {depth}'
+        else:
+            clone_args = f'--filter=blob:none --branch {VERSION}'
+            fetch_args = ''
 
-        command = textwrap.dedent(f'''
+        return textwrap.dedent(f'''
             cd /home/ubuntu;
-            ssh-keyscan -H github.com >> ~/.ssh/known_hosts;
-            git clone https://{pat}@github.com/jumo/{PACKAGE}.git;
+            if [ -d {PACKAGE}/.git ]; then git -C {PACKAGE} fetch -q{fetch_args} {url} {VERSION} && git -C {PACKAGE} checkout -q -B {VERSION} FETCH_HEAD; else git clone -q {clone_args} {url} {PACKAGE}; fi;
             cd {PACKAGE};
-            git checkout {VERSION};
             ''')
 
-        ec2_instance.run_bash_command(command,pty=True)
+    @traced('project')
+    def clone_remote(self, ec2_instance, ssh_key_file: str, pat: str, wait_ready: bool = True):
+        '''
+        use github pat to clone the project on remote
+
+        wait_ready: bool = poll the instance for ssh first, skip if the caller already did so
+        '''
+        if wait_ready:
+            ec2_instance.poll_instance_ready(ssh_key_file=ssh_key_file)
+
+        ec2_instance.run_bash_command(self.clone_command(pat),pty=True)
 
 class MakeProject(GitProject):
 
@@ -131,6 +165,7 @@ class MakeProject(GitProject):
         super().__init__(**kwargs)
 
     # use EC2Instance to ssh into instance and call `make run`
+    @traced('project')
     def run(self, *args, ec2_instance=None, ssh_key_file=None):
         ec2_instance.create_ssh_connection(ssh_key_file=ssh_key_file)
 
@@ -0,0 +1,183 @@
+#This module relates to waiting for ec2 resources to become ready; backoff, cheap tcp probes and batched describe polling
+import random
+import socket
+import time
+from contextlib import contextmanager
+
+from launch_control.trace import tracer
+
+class DeadlineExceeded(BaseException):
+    '''raised when a readiness poll runs past its overall deadline'''
+
+class InstanceStateError(BaseException):
+    '''raised when an instance being waited on enters a state it can't get to the wanted one from'''
+
+# states an instance can't reach the wanted state from, the same ones boto3's instance_running/instance_stopped waiters fail on
+UNREACHABLE_STATES = {
+    'running': {'shutting-down', 'terminated', 'stopping'},
+    'stopped': {'shutting-down', 'terminated'},
+}
+
+class Backoff:
+    '''
+    Exponential backoff with jitter and an overall deadline.
+
+    Iterating yields the attempt number and sleeps between attempts, raising `DeadlineExceeded` once the deadline has passed.
+    The deadline starts on first use and is shared by every phase iterating the same object.
+    clock/sleep can be swapped for fakes in tests.
+    '''
+    def __init__(self, initial: float = 1, factor: float = 2, max_delay: float = 15, jitter: float = 0.25, deadline: float = 300, clock=time.monotonic, sleep=time.sleep):
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.started = None
+
+    def delay(self, attempt: int):
+        '''delay before attempt number `attempt + 1`'''
+        delay = min(self.max_delay, self.initial * self.factor ** attempt)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __iter__(self):
+        if self.started is None:
+            self.started = self.clock()
+
+        attempt = 0
+        while True:
+            yield attempt
+
+            remaining = self.deadline - (self.clock() - self.started)
+            if remaining <= 0:
+                raise DeadlineExceeded(f'gave up after {attempt + 1} attempts and {self.deadline}s')
+
+            self.sleep(min(self.delay(attempt), remaining))
+            attempt += 1
+
+class TimingEvents:
+    '''collects structured timing events for each readiness phase'''
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.events = []
+
+    @contextmanager
+    def phase(self, name: str, target: str = None):
+        event = {'phase': name, 'target': target, 'attempts': 0, 'ok': False}
+        # also a `tracer` span, so readiness waits show up in `lc --trace` next to the calls they make
+        with tracer.span(name, 'readiness', target=target) as span:
+            start = self.clock()
+            try:
+                yield event
+                event['ok'] = True
+            finally:
+                event['duration'] = self.clock() - start
+                self.events.append(event)
+                span['attempts'] = event['attempts']
+
+    def summary(self):
+        return [f"{e['phase']} {e['target'] or ''} {e['duration']:.1f}s ({e['attempts']} attempts){'' if e['ok'] else ' FAILED'}" for e in self.events]
+
+# module level collector so launch paths can report where time went
+timing_events = TimingEvents()
+
+def tcp_probe(host: str, port: int = 22, timeout: float = 2):
+    '''true if a tcp connection to host:port can be opened, much cheaper than a full ssh handshake'''
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def wait_for_port(host: str, port: int = 22, backoff: Backoff = None, events: TimingEvents = None, timeout: float = 2):
+    '''poll `host:port` with tcp connects untill it accepts connections'''
+    backoff = backoff or Backoff()
+    events = events or timing_events
+
+    with events.phase('tcp_probe', host) as event:
+        for attempt in backoff:
+            event['attempts'] = attempt + 1
+            if tcp_probe(host, port, timeout=timeout):
+                return True
+
+def wait_for_ssh(host: str, ssh_check, port: int = 22, backoff: Backoff = None, events: TimingEvents = None):
+    '''
+    wait untill sshd answers on `host` and `ssh_check()` succeeds
+
+    ssh_check: callable = runs a trivial remote command, raising if the ssh session is not usable yet
+    '''
+    backoff = backoff or Backoff()
+    wait_for_port(host, port=port, backoff=backoff, events=events)
+
+    events = events or timing_events
+    with events.phase('ssh_handshake', host) as event:
+        for attempt in backoff:
+            event['attempts'] = attempt + 1
+            try:
+                return ssh_check()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException:
+                # sshd can accept tcp before the key/user is set up by cloud-init
+                pass
+
+def poll_spot_requests(ec2_client, request_ids: list, backoff: Backoff = None, events: TimingEvents = None):
+    '''
+    poll many spot requests with a single describe call per attempt untill none are `open`
+
+    returns a dict of request id -> spot request description
+    '''
+    backoff = backoff or Backoff(initial=2, max_delay=10)
+    events = events or timing_events
+
+    with events.phase('spot_fulfilment', ','.join(request_ids)) as event:
+        for attempt in backoff:
+            event['attempts'] = attempt + 1
+            try:
+                response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=list(request_ids))
+            except Exception as e:
+                # freshly created requests are eventually consistent
+                if 'InvalidSpotInstanceRequestID.NotFound' in str(e):
+                    continue
+                raise
+
+            requests = {request['SpotInstanceRequestId']: request for request in response['SpotInstanceRequests']}
+            states = [request['State'] for request in requests.values()]
+            print(f"Spot requests: {states.count('active')}/{len(request_ids)} active")
+
+            if 'open' not in states:
+                return requests
+
+def poll_instances_state(ec2_client, instance_ids: list, state: str = 'running', backoff: Backoff = None, events: TimingEvents = None):
+    '''
+    poll many instances with a single paginated describe per attempt untill all are in `state`
+
+    returns a dict of instance id -> instance description
+    '''
+    backoff = backoff or Backoff(initial=2, max_delay=10)
+    events = events or timing_events
+
+    with events.phase(f'instance_{state}', ','.join(instance_ids)) as event:
+        for attempt in backoff:
+            event['attempts'] = attempt + 1
+            instances = {}
+            paginator = ec2_client.get_paginator('describe_instances')
+            try:
+                for page in paginator.paginate(InstanceIds=list(instance_ids)):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            instances[instance['InstanceId']] = instance
+            except Exception as e:
+                if 'InvalidInstanceID.NotFound' in str(e):
+                    continue
+                raise
+
+            # a reclaimed spot instance or a failed launch will never get there, don't wait out the deadline
+            stuck = sorted(instance_id for instance_id, i in instances.items() if i['State']['Name'] in UNREACHABLE_STATES.get(state, ()))
+            if stuck:
+                states = ', '.join(f"{instance_id} ({instances[instance_id]['State']['Name']})" for instance_id in stuck)
+                raise InstanceStateError(f"instance(s) {states} can't become {state}")
+
+            if len(instances) == len(instance_ids) and all(i['State']['Name'] == state for i in instances.values()):
+                return instances
@@ -0,0 +1,403 @@
+#This module is the local registry of launched instances, an sqlite index replacing the per instance yaml files
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from os import listdir
+from os.path import isfile, isdir, join
+from pathlib import Path
+
+from launch_control.utils import read_yaml
+from launch_control.vars import LAUNCH_CONTROL_REGISTRY, LAUNCH_CONTROL_INSTANCE_DIR
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS instances (
+        instance_id TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        region TEXT,
+        spot_request_id TEXT,
+        metadata TEXT,
+        created_at REAL,
+        updated_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS instances_project ON instances (project)',
+    '''CREATE TABLE IF NOT EXISTS spot_prices (
+        region TEXT NOT NULL,
+        instance_type TEXT NOT NULL,
+        availability_zone TEXT NOT NULL,
+        price REAL NOT NULL,
+        fetched_at REAL NOT NULL,
+        PRIMARY KEY (region, instance_type, availability_zone)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS amis (
+        project TEXT NOT NULL,
+        commit_hash TEXT NOT NULL,
+        region TEXT NOT NULL,
+        base_image_id TEXT NOT NULL,
+        image_id TEXT NOT NULL,
+        build_command TEXT,
+        created_at REAL,
+        PRIMARY KEY (project, commit_hash, region, base_image_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS pool (
+        instance_id TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        instance_type TEXT NOT NULL,
+        region TEXT NOT NULL,
+        state TEXT NOT NULL,
+        updated_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS pool_key ON pool (project, instance_type, region, state)',
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT NOT NULL,
+        instance_id TEXT NOT NULL,
+        project TEXT,
+        region TEXT,
+        command TEXT,
+        state TEXT NOT NULL,
+        exit_code INTEGER,
+        started_at REAL,
+        finished_at REAL,
+        PRIMARY KEY (job_id, instance_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS map_runtimes (
+        project TEXT NOT NULL,
+        template TEXT NOT NULL,
+        item TEXT NOT NULL,
+        duration REAL NOT NULL,
+        updated_at REAL,
+        PRIMARY KEY (project, template, item)
+    )''',
+]
+
+class Registry:
+    '''
+    sqlite backed index of launched instances keyed by instance id and project.
+
+    Every call opens its own short lived connection, so the registry is safe to use from threads and from several
+    `lc` processes at once; writes are atomic transactions and WAL mode lets readers run alongside a writer.
+    '''
+    def __init__(self, path: str = None, migrate: bool = True):
+        self.path = path or LAUNCH_CONTROL_REGISTRY()
+        Path(os.path.dirname(os.path.abspath(self.path))).mkdir(parents=True, exist_ok=True)
+
+        with self.transaction() as con:
+            for statement in SCHEMA:
+                con.execute(statement)
+
+        if migrate:
+            self.migrate_yaml_records()
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        '''
+        yields a connection inside a transaction that commits on success and rolls back on error
+
+        immediate: bool = take the write lock up front, for read-modify-write sequences
+        '''
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield con
+                con.execute('COMMIT')
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+        finally:
+            con.close()
+
+    @staticmethod
+    def _record(row):
+        record = dict(row)
+        record['metadata'] = json.loads(record['metadata']) if record['metadata'] else None
+        return record
+
+    def add(self, instance_id: str, project: str, region: str = None, spot_request_id: str = None):
+        now = time.time()
+        with self.transaction() as con:
+            con.execute(
+                '''INSERT INTO instances (instance_id, project, region, spot_request_id, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (instance_id) DO UPDATE SET project = excluded.project, region = excluded.region,
+                   spot_request_id = COALESCE(excluded.spot_request_id, spot_request_id), updated_at = excluded.updated_at''',
+                (instance_id, project, region, spot_request_id, now, now),
+            )
+
+    def get(self, instance_id: str):
+        with self.transaction() as con:
+            row = con.execute('SELECT * FROM instances WHERE instance_id = ?', (instance_id,)).fetchone()
+        return None if row is None else self._record(row)
+
+    def instances(self, project: str = None):
+        '''all instance records, optionally only those of `project`'''
+        with self.transaction() as con:
+            if project is None:
+                rows = con.execute('SELECT * FROM instances ORDER BY project, created_at').fetchall()
+            else:
+                rows = con.execute('SELECT * FROM instances WHERE project = ? ORDER BY created_at', (project,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def projects(self):
+        with self.transaction() as con:
+            rows = con.execute('SELECT DISTINCT project FROM instances ORDER BY project').fetchall()
+        return [row['project'] for row in rows]
+
+    def remove(self, instance_ids: list):
+        with self.transaction() as con:
+            con.executemany('DELETE FROM instances WHERE instance_id = ?', [(instance_id,) for instance_id in instance_ids])
+            con.executemany('DELETE FROM pool WHERE instance_id = ?', [(instance_id,) for instance_id in instance_ids])
+
+    def set_metadata(self, instance_id: str, metadata: dict = None):
+        with self.transaction() as con:
+            con.execute(
+                'UPDATE instances SET metadata = ?, updated_at = ? WHERE instance_id = ?',
+                (None if metadata is None else json.dumps(metadata), time.time(), instance_id),
+            )
+
+    def get_meta(self, key: str):
+        with self.transaction() as con:
+            row = con.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row['value']
+
+    def set_meta(self, key: str, value: str):
+        with self.transaction() as con:
+            con.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value', (key, value))
+
+    def spot_prices(self, region: str, instance_types: list):
+        '''cached spot price rows (instance_type, availability_zone, price, fetched_at) for `instance_types` in `region`'''
+        with self.transaction() as con:
+            rows = con.execute(
+                f'''SELECT instance_type, availability_zone, price, fetched_at FROM spot_prices
+                    WHERE region = ? AND instance_type IN ({','.join('?' * len(instance_types))})''',
+                (region, *instance_types),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def set_spot_prices(self, region: str, prices: dict, fetched_at: float):
+        '''replace the cached prices of every instance type in `prices`, a dict of (instance_type, availability_zone) -> price'''
+        instance_types = set(instance_type for instance_type, _ in prices)
+        with self.transaction() as con:
+            con.executemany('DELETE FROM spot_prices WHERE region = ? AND instance_type = ?', [(region, instance_type) for instance_type in instance_types])
+            con.executemany(
+                'INSERT INTO spot_prices (region, instance_type, availability_zone, price, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                [(region, instance_type, availability_zone, price, fetched_at) for (instance_type, availability_zone), price in prices.items()],
+            )
+
+    def add_ami(self, project: str, commit_hash: str, region: str, base_image_id: str, image_id: str, build_command: str = None):
+        with self.transaction() as con:
+            con.execute(
+                '''INSERT INTO amis (project, commit_hash, region, base_image_id, image_id, build_command, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (project, commit_hash, region, base_image_id) DO UPDATE SET image_id = excluded.image_id,
+                   build_command = excluded.build_command, created_at = excluded.created_at''',
+                (project, commit_hash, region, base_image_id, image_id, build_command, time.time()),
+            )
+
+    def ami(self, project: str, commit_hash: str, region: str, base_image_id: str):
+        '''the baked image record for a project commit, None if it was never baked'''
+        with self.transaction() as con:
+            row = con.execute(
+                'SELECT * FROM amis WHERE project = ? AND commit_hash = ? AND region = ? AND base_image_id = ?',
+                (project, commit_hash, region, base_image_id),
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def amis(self, project: str = None):
+        '''all baked image records, newest first, optionally only those of `project`'''
+        with self.transaction() as con:
+            if project is None:
+                rows = con.execute('SELECT * FROM amis ORDER BY created_at DESC').fetchall()
+            else:
+                rows = con.execute('SELECT * FROM amis WHERE project = ? ORDER BY created_at DESC', (project,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def remove_ami(self, image_id: str):
+        with self.transaction() as con:
+            con.execute('DELETE FROM amis WHERE image_id = ?', (image_id,))
+
+    def acquire_lease(self, name: str, ttl: float):
+        '''true if this caller now holds the named lease, false while someone else's is younger than `ttl` seconds'''
+        now = time.time()
+        with self.transaction(immediate=True) as con:
+            row = con.execute('SELECT value FROM meta WHERE key = ?', (f'lease:{name}',)).fetchone()
+            if row is not None and now - float(row['value']) < ttl:
+                return False
+            con.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value', (f'lease:{name}', str(now)))
+        return True
+
+    def release_lease(self, name: str):
+        with self.transaction() as con:
+            con.execute('DELETE FROM meta WHERE key = ?', (f'lease:{name}',))
+
+    def pool_size(self, project: str, instance_type: str, region: str):
+        size = self.get_meta(f'pool_size:{project}:{instance_type}:{region}')
+        return 0 if size is None else int(size)
+
+    def set_pool_size(self, project: str, instance_type: str, region: str, size: int):
+        self.set_meta(f'pool_size:{project}:{instance_type}:{region}', str(size))
+
+    def pool_sizes(self, project: str = None):
+        '''configured pool sizes as (project, instance_type, region) -> size'''
+        with self.transaction() as con:
+            rows = con.execute("SELECT key, value FROM meta WHERE key LIKE 'pool_size:%'").fetchall()
+
+        sizes = {}
+        for row in rows:
+            key = tuple(row['key'][len('pool_size:'):].rsplit(':', 2))
+            if project is None or key[0] == project:
+                sizes[key] = int(row['value'])
+        return sizes
+
+    def add_pool_instances(self, instance_ids: list, project: str, instance_type: str, region: str, state: str):
+        now = time.time()
+        with self.transaction() as con:
+            con.executemany(
+                '''INSERT INTO pool (instance_id, project, instance_type, region, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (instance_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at''',
+                [(instance_id, project, instance_type, region, state, now) for instance_id in instance_ids],
+            )
+
+    def set_pool_state(self, instance_ids: list, state: str):
+        now = time.time()
+        with self.transaction() as con:
+            con.executemany('UPDATE pool SET state = ?, updated_at = ? WHERE instance_id = ?', [(state, now, instance_id) for instance_id in instance_ids])
+
+    def remove_pool_instances(self, instance_ids: list):
+        with self.transaction() as con:
+            con.executemany('DELETE FROM pool WHERE instance_id = ?', [(instance_id,) for instance_id in instance_ids])
+
+    def pool_instances(self, project: str = None, instance_type: str = None, region: str = None):
+        '''warm pool rows, optionally filtered'''
+        filters = {'project': project, 'instance_type': instance_type, 'region': region}
+        where = [f'{column} = ?' for column, value in filters.items() if value is not None]
+        with self.transaction() as con:
+            rows = con.execute(
+                f"SELECT * FROM pool {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY project, instance_type, updated_at",
+                [value for value in filters.values() if value is not None],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim_pool_instances(self, project: str, instance_type: str, region: str, count: int):
+        '''
+        atomically mark up to `count` stopped pool instances as claimed and return their ids
+
+        the write lock is taken before reading, so concurrent `lc` processes never claim the same instance
+        '''
+        with self.transaction(immediate=True) as con:
+            rows = con.execute(
+                '''SELECT instance_id FROM pool WHERE project = ? AND instance_type = ? AND region = ? AND state = 'stopped'
+                   ORDER BY updated_at LIMIT ?''',
+                (project, instance_type, region, count),
+            ).fetchall()
+            instance_ids = [row['instance_id'] for row in rows]
+            con.executemany(
+                "UPDATE pool SET state = 'claimed', updated_at = ? WHERE instance_id = ?",
+                [(time.time(), instance_id) for instance_id in instance_ids],
+            )
+        return instance_ids
+
+    def add_job(self, job_id: str, instance_id: str, project: str, region: str, command: str):
+        with self.transaction() as con:
+            con.execute(
+                '''INSERT INTO jobs (job_id, instance_id, project, region, command, state, started_at)
+                   VALUES (?, ?, ?, ?, ?, 'running', ?)''',
+                (job_id, instance_id, project, region, command, time.time()),
+            )
+
+    def jobs(self, project: str = None, job_ids: list = None, active: bool = False):
+        '''job records newest first, optionally filtered by project, job ids and still running'''
+        where, params = [], []
+        if project is not None:
+            where.append('project = ?')
+            params.append(project)
+        if job_ids:
+            where.append(f"job_id IN ({','.join('?' * len(job_ids))})")
+            params += list(job_ids)
+        if active:
+            where.append("state = 'running'")
+        with self.transaction() as con:
+            rows = con.execute(f"SELECT * FROM jobs {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY started_at DESC, instance_id", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def finish_job(self, job_id: str, instance_id: str, state: str, exit_code: int = None):
+        with self.transaction() as con:
+            con.execute(
+                'UPDATE jobs SET state = ?, exit_code = ?, finished_at = ? WHERE job_id = ? AND instance_id = ?',
+                (state, exit_code, time.time(), job_id, instance_id),
+            )
+
+    def map_runtimes(self, project: str, template: str):
+        '''item -> seconds its last successful run of `template` took'''
+        with self.transaction() as con:
+            rows = con.execute('SELECT item, duration FROM map_runtimes WHERE project = ? AND template = ?', (project, template)).fetchall()
+        return {row['item']: row['duration'] for row in rows}
+
+    def set_map_runtimes(self, project: str, template: str, runtimes: dict):
+        now = time.time()
+        with self.transaction() as con:
+            con.executemany(
+                '''INSERT INTO map_runtimes (project, template, item, duration, updated_at) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (project, template, item) DO UPDATE SET duration = excluded.duration, updated_at = excluded.updated_at''',
+                [(project, template, item, duration, now) for item, duration in runtimes.items()],
+            )
+
+    def migrate_yaml_records(self):
+        '''one off import of the per instance yaml files under ~/.launch_control/instances'''
+        if self.get_meta('yaml_migrated'):
+            return 0
+
+        path = LAUNCH_CONTROL_INSTANCE_DIR()
+        imported = 0
+        with self.transaction(immediate=True) as con:
+            # another lc process may have migrated while we waited for the lock
+            if con.execute("SELECT value FROM meta WHERE key = 'yaml_migrated'").fetchone():
+                return 0
+
+            projects = [dir for dir in listdir(path) if isdir(join(path, dir))] if isdir(path) else []
+            for proj in projects:
+                for f in listdir(join(path, proj)):
+                    if not (f.endswith('.yaml') and isfile(join(path, proj, f))):
+                        continue
+                    try:
+                        record = read_yaml(join(path, proj, f)) or {}
+                    except Exception:
+                        record = {}
+                    metadata = record.get('metadata')
+                    con.execute(
+                        '''INSERT OR IGNORE INTO instances (instance_id, project, region, spot_request_id, metadata, created_at, updated_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                        (
+                            record.get('instance_id', f[:-len('.yaml')]),
+                            proj,
+                            record.get('region'),
+                            record.get('spot_request_id'),
+                            None if metadata is None else json.dumps(metadata),
+                            os.path.getmtime(join(path, proj, f)),
+                            time.time(),
+                        ),
+                    )
+                    imported += 1
+
+            con.execute("INSERT INTO meta (key, value) VALUES ('yaml_migrated', ?)", (str(time.time()),))
+
+        if imported:
+            print(f'imported {imported} instance record(s) from {path} into {self.path}')
+
+        return imported
+
+_registry = None
+
+def get_registry():
+    '''process wide registry, opened (and migrated) on first use'''
+    global _registry
+    if _registry is None or _registry.path != LAUNCH_CONTROL_REGISTRY():
+        _registry = Registry()
+    return _registry
@@ -0,0 +1,274 @@
+#This module relates to getting project code onto instances fast; shallow clones, working tree deltas and git bundles
+import hashlib
+import io
+import json
+import os
+import shlex
+import subprocess
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+from launch_control.vars import LAUNCH_CONTROL_DIR
+from launch_control.trace import tracer
+
+SYNC_MODES = ['clone', 'tree', 'bundle']
+
+REMOTE_HOME = '/home/ubuntu'
+
+# per file content hashes of the last tree synced to a host, kept next to the code on remote
+MANIFEST_NAME = '.lc_manifest.json'
+
+def git(path: str, *args):
+    '''stdout of a local git command run in `path`'''
+    process = subprocess.run(['git', '-C', path, *args], capture_output=True)
+    if process.returncode != 0:
+        raise BaseException(f"git {' '.join(args)} failed: {process.stderr.decode('utf-8').strip()}")
+    return process.stdout.decode('utf-8').strip()
+
+def _hash_file(path: str):
+    digest = hashlib.sha256()
+    if os.path.islink(path):
+        digest.update(os.readlink(path).encode('utf-8'))
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+class TreeManifest:
+    '''
+    Content hashes of every file git would commit from a working tree; tracked files plus untracked ones not ignored
+    by `.gitignore`, uncommitted changes included.
+
+    Hashes are cached locally by (size, mtime) so only files touched since the last sync are read again.
+    '''
+    def __init__(self, root: str, cache_path: str = None):
+        self.root = root
+        self.cache_path = cache_path or f'{LAUNCH_CONTROL_DIR()}/sync/{hashlib.sha1(root.encode()).hexdigest()[:12]}.json'
+
+    def files(self):
+        output = subprocess.run(['git', '-C', self.root, 'ls-files', '-z', '--cached', '--others', '--exclude-standard'], capture_output=True, check=True).stdout
+        # deleted but still tracked files are listed too, and submodules as their directory (a gitlink), keep regular files and symlinks
+        paths = set(path for path in output.decode('utf-8').split('\0') if path)
+        return sorted(path for path in paths if os.path.islink(os.path.join(self.root, path)) or os.path.isfile(os.path.join(self.root, path)))
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def build(self):
+        '''dict of relative path -> sha256'''
+        cache = self._load_cache()
+        stats = {}
+        manifest = {}
+        for path in self.files():
+            full_path = os.path.join(self.root, path)
+            stat = os.lstat(full_path)
+            key = [stat.st_size, stat.st_mtime_ns]
+            cached = cache.get(path)
+            manifest[path] = cached[2] if cached and cached[:2] == key else _hash_file(full_path)
+            stats[path] = key + [manifest[path]]
+
+        Path(os.path.dirname(self.cache_path)).mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(stats, f)
+
+        return manifest
+
+def manifest_digest(manifest: dict):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+class SyncResult:
+    def __init__(self, host: str, mode: str):
+        self.host = host
+        self.mode = mode
+        self.skipped = False
+        self.files_sent = 0
+        self.files_deleted = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        if self.skipped:
+            return f'{self.host}: {self.mode} up to date ({self.seconds:.1f}s)'
+        return f'{self.host}: {self.mode} sent {self.files_sent} file(s), {self.bytes_sent / 1e6:.1f}MB, deleted {self.files_deleted} ({self.seconds:.1f}s)'
+
+class CodeSync:
+    '''
+    Puts a git project on an instance under /home/ubuntu/<repo name> using one of three modes;
+
+    clone: shallow clone (or fetch) of the pushed branch from github, run on the instance
+    tree: delta upload of the local working tree, uncommitted changes included; only files whose content hash differs from the
+        manifest left by the previous sync are sent (as one tar stream), files deleted locally are deleted remotely
+    bundle: `git bundle` of the commits the instance is missing, for subnets without github access
+
+    An unchanged tree (or commit for clone/bundle) is detected with a single remote command and skipped.
+    tree and bundle need the OpenSSH client, they upload through a `MultiplexedConnection`.
+    '''
+    def __init__(self, project, mode: str = 'clone', pat: str = None, org: str = None, depth: int = 1, full: bool = False):
+        '''
+        project: GitProject = project to sync
+        full: bool = ignore what the instance reports it has and send everything
+        '''
+        if mode not in SYNC_MODES:
+            raise BaseException(f'unknown sync mode {mode}, expected one of {SYNC_MODES}')
+
+        self.project = project
+        self.mode = mode
+        self.pat = pat
+        self.org = org
+        self.depth = depth
+        self.full = full
+        self.root = git(project.path, 'rev-parse', '--show-toplevel')
+        self.remote_dir = f'{REMOTE_HOME}/{os.path.basename(self.root)}'
+        self._manifest = None
+
+    def clone_command(self):
+        return self.project.clone_command(self.pat, org=self.org, depth=self.depth)
+
+    @property
+    def manifest(self):
+        '''local tree manifest, built once per sync run and shared by every host'''
+        if self._manifest is None:
+            self._manifest = TreeManifest(self.root).build()
+        return self._manifest
+
+    def sync(self, connection):
+        '''sync the project to the host behind `connection`, returns a `SyncResult`'''
+        start = time.monotonic()
+        result = SyncResult(connection.host, self.mode)
+
+        with tracer.span(f'sync_{self.mode}', 'sync', target=connection.host) as span:
+            if self.mode == 'clone':
+                self._sync_clone(connection, result)
+            elif self.mode == 'tree':
+                self._sync_tree(connection, result)
+            else:
+                self._sync_bundle(connection, result)
+            span.update(bytes=result.bytes_sent, files=result.files_sent, skipped=result.skipped)
+
+        result.seconds = time.monotonic() - start
+        return result
+
+    def _remote_head(self, connection):
+        if self.full:
+            return None
+        output = connection.run(f'git -C {self.remote_dir} rev-parse HEAD 2>/dev/null', hide=True, warn=True).stdout.strip()
+        return output or None
+
+    def _sync_clone(self, connection, result):
+        head = git(self.root, 'rev-parse', 'HEAD')
+        if self._remote_head(connection) == head:
+            result.skipped = True
+            return
+        connection.run(f"bash -s <<'LC_SCRIPT'\n{self.clone_command()}LC_SCRIPT\n", hide=True)
+
+    def _remote_manifest(self, connection):
+        if self.full:
+            return {}
+        output = connection.run(f'cat {self.remote_dir}/{MANIFEST_NAME} 2>/dev/null', hide=True, warn=True).stdout
+        try:
+            return json.loads(output) if output.strip() else {}
+        except ValueError:
+            return {}
+
+    def _sync_tree(self, connection, result):
+        local = self.manifest
+        remote = self._remote_manifest(connection)
+        if remote and manifest_digest(remote) == manifest_digest(local):
+            result.skipped = True
+            return
+
+        changed = [path for path, digest in local.items() if remote.get(path) != digest]
+        deleted = [path for path in remote if path not in local]
+
+        with tempfile.TemporaryFile() as stream:
+            with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+                for path in changed:
+                    tar.add(os.path.join(self.root, path), arcname=path, recursive=False)
+                # written last so an interrupted upload leaves the old manifest and gets resent
+                manifest = json.dumps(local, sort_keys=True).encode('utf-8')
+                info = tarfile.TarInfo(MANIFEST_NAME)
+                info.size = len(manifest)
+                info.mtime = time.time()
+                tar.addfile(info, fileobj=io.BytesIO(manifest))
+            result.bytes_sent = stream.tell()
+            stream.seek(0)
+
+            remove = ''
+            if deleted:
+                remove = f"cd {self.remote_dir} && printf '%s\\0' {' '.join(shlex.quote(path) for path in deleted)} | xargs -0 rm -f && "
+            connection.upload(f'mkdir -p {self.remote_dir} && {remove}tar -xzf - -C {self.remote_dir}', stream)
+
+        result.files_sent = len(changed)
+        result.files_deleted = len(deleted)
+
+    def _sync_bundle(self, connection, result):
+        head = git(self.root, 'rev-parse', 'HEAD')
+        remote_head = self._remote_head(connection)
+        if remote_head == head:
+            result.skipped = True
+            return
+
+        branch = git(self.root, 'rev-parse', '--abbrev-ref', 'HEAD')
+        ref = 'HEAD' if branch == 'HEAD' else branch
+        revisions = [ref]
+        if remote_head and subprocess.run(['git', '-C', self.root, 'merge-base', '--is-ancestor', remote_head, head]).returncode == 0:
+            # only the commits the instance is missing
+            revisions.append(f'^{remote_head}')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bundle = os.path.join(tmp, 'project.bundle')
+            git(self.root, 'bundle', 'create', bundle, *revisions)
+            result.bytes_sent = os.path.getsize(bundle)
+
+            remote_bundle = f'/tmp/lc-{os.path.basename(self.root)}.bundle'
+            local_branch = 'lc-sync' if ref == 'HEAD' else ref
+            with open(bundle, 'rb') as stream:
+                connection.upload(
+                    f'cat > {remote_bundle} && mkdir -p {self.remote_dir} && cd {self.remote_dir} && '
+                    f'(git rev-parse --git-dir > /dev/null 2>&1 || git init -q) && '
+                    f'git fetch -q {remote_bundle} {ref} && git checkout -q -f -B {local_branch} FETCH_HEAD && rm -f {remote_bundle}',
+                    stream,
+                )
+
+        result.files_sent = 1
+
+def sync_instances(code_sync: CodeSync, ec2_instances: list, ssh_key_file: str, parallel: int = 10):
+    '''sync every instance concurrently over multiplexed connections, returns a `SyncResult` (or the exception) per instance'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if code_sync.mode == 'tree':
+        # hash the local tree once up front, not once per thread
+        code_sync.manifest
+
+    def _sync(ec2_instance):
+        try:
+            return code_sync.sync(multiplexed_connection(ec2_instance, ssh_key_file))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        return list(pool.map(_sync, ec2_instances))
+
+def multiplexed_connection(ec2_instance, ssh_key_file: str):
+    from launch_control.connections import MultiplexedConnection
+
+    ec2_instance.create_ssh_connection(ssh_key_file=ssh_key_file, multiplex=True)
+    if not isinstance(ec2_instance.ssh_con, MultiplexedConnection):
+        raise BaseException('code sync needs the OpenSSH client (`ssh`) on your PATH')
+    return ec2_instance.ssh_con
+
+def print_sync_report(ec2_instances: list, results: list):
+    for ec2_instance, result in zip(ec2_instances, results):
+        if isinstance(result, BaseException):
+            print(f'{ec2_instance.instance_id}: sync failed: {result}')
+        else:
+            print(f'{ec2_instance.instance_id} {result}')
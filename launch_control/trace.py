@@ -0,0 +1,151 @@
+#This module relates to tracing; named spans around aws calls, ssh commands and bootstrap stages, written out as a chrome trace or a timings table
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from launch_control.utils import print_table
+
+class Tracer:
+    '''
+    Collects named spans from every thread; each has a category, start, duration, thread and free form args such as
+    the target instance, retries or bytes moved.
+
+    Disabled by default, a disabled `span` only checks a flag so instrumentation can stay on every hot path.
+    clock can be swapped for a fake in tests.
+    '''
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.enabled = False
+        self.origin = clock()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def enable(self):
+        '''start collecting, dropping anything collected before'''
+        with self._lock:
+            self.enabled = True
+            self.origin = self.clock()
+            self.spans = []
+
+    def record(self, name: str, category: str, start: float, duration: float, args: dict = None):
+        '''add a finished span, `start` is a reading of `clock`'''
+        thread = threading.current_thread()
+        span = {
+            'name': name,
+            'category': category,
+            'start': start - self.origin,
+            'duration': duration,
+            'tid': thread.ident,
+            'thread': thread.name,
+            'args': args or {},
+        }
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, category: str = 'lc', **args):
+        '''
+        time the body as one span, yields the args dict so the body can add e.g. retries or bytes
+
+        a span left by an exception records the exception type under `error`
+        '''
+        if not self.enabled:
+            yield args
+            return
+
+        start = self.clock()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self.record(name, category, start, self.clock() - start, args)
+
+    def chrome_trace(self):
+        '''the spans in chrome trace event format, loads in chrome://tracing and ui.perfetto.dev'''
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+
+        events = []
+        threads = {}
+        for span in spans:
+            threads.setdefault(span['tid'], span['thread'])
+            events.append({
+                'name': span['name'],
+                'cat': span['category'],
+                'ph': 'X',
+                'ts': round(span['start'] * 1e6, 3),
+                'dur': round(span['duration'] * 1e6, 3),
+                'pid': pid,
+                'tid': span['tid'],
+                'args': {key: value if isinstance(value, (int, float, bool)) or value is None else str(value) for key, value in span['args'].items()},
+            })
+        for tid, thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def timings(self):
+        '''one row per (category, name); count, total/mean/max seconds and summed retries, attempts and bytes'''
+        with self._lock:
+            spans = list(self.spans)
+
+        rows = {}
+        for span in spans:
+            row = rows.setdefault((span['category'], span['name']), {
+                'category': span['category'], 'name': span['name'], 'count': 0, 'errors': 0,
+                'total': 0.0, 'max': 0.0, 'retries': 0, 'attempts': 0, 'bytes': 0,
+            })
+            row['count'] += 1
+            row['errors'] += int('error' in span['args'])
+            row['total'] += span['duration']
+            row['max'] = max(row['max'], span['duration'])
+            for key in ('retries', 'attempts', 'bytes'):
+                row[key] += span['args'].get(key) or 0
+
+        for row in rows.values():
+            row['mean'] = row['total'] / row['count']
+
+        return sorted(rows.values(), key=lambda row: row['total'], reverse=True)
+
+# process wide tracer, enabled by `lc --trace` / `lc --timings`
+tracer = Tracer()
+
+def traced(category: str, name: str = None):
+    '''
+    decorator running the function in a `tracer` span named after it
+
+    methods of objects with an `instance_id` (e.g. `EC2Instance`) record it as the span's target
+    '''
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            target = getattr(args[0], 'instance_id', None) if args else None
+            with tracer.span(span_name, category, **({'target': target} if target else {})):
+                return function(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+def print_timings(rows: list):
+    '''print `Tracer.timings` rows'''
+    header = ['category', 'span', 'count', 'total_s', 'mean_s', 'max_s', 'retries', 'attempts', 'MB', 'errors']
+    table = [
+        [row['category'], row['name'], row['count'], f"{row['total']:.3f}", f"{row['mean']:.3f}", f"{row['max']:.3f}",
+         row['retries'] or '-', row['attempts'] or '-', f"{row['bytes'] / 1e6:.1f}" if row['bytes'] else '-', row['errors'] or '-']
+        for row in rows
+    ]
+    print_table(header, table)
@@ -0,0 +1,393 @@
+#This module moves files to and from instances; chunked, resumable sftp transfers over several ssh streams at once
+import fnmatch
+import hashlib
+import os
+import posixpath
+import shlex
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from launch_control.trace import tracer
+
+# files are split into chunks of this size, each chunk is sent by whichever stream is free
+CHUNK_SIZE = 64 * 2 ** 20
+
+# parallel ssh connections, each with its own sftp session; one TCP stream rarely fills a fast link
+STREAMS = 8
+
+# read/write block size within a chunk
+BLOCK_SIZE = 2 ** 20
+
+def _matches(relative_path: str, include: list = None, exclude: list = None):
+    '''true if `relative_path` matches any include glob (all files when none) and no exclude glob'''
+    name = posixpath.basename(relative_path)
+    def match(patterns):
+        return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+    if include and not match(include):
+        return False
+    return not (exclude and match(exclude))
+
+def _chunks(size: int, chunk_size: int):
+    '''(offset, length) of every chunk of a file of `size` bytes, one empty chunk for an empty file'''
+    if size == 0:
+        return [(0, 0)]
+    return [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+
+def _read_into(stream, streams: dict, name: str):
+    streams[name] = stream.read()
+
+def _local_chunk_hashes(path: str, chunks: list):
+    hashes = []
+    with open(path, 'rb') as f:
+        for offset, length in chunks:
+            f.seek(offset)
+            digest = hashlib.sha256()
+            remaining = length
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+            hashes.append(digest.hexdigest())
+    return hashes
+
+class FileTransfer:
+    '''one file to move, and the chunks of it that still have to be sent'''
+    def __init__(self, source: str, destination: str, size: int):
+        self.source = source
+        self.destination = destination
+        self.size = size
+        self.direction = None
+        # chunks still to send, and chunks the destination may already hold
+        self.chunks = []
+        self.compare = []
+        self.exists = False
+        self.destination_size = None
+
+class TransferStats:
+    '''bytes moved and skipped by a push/pull, updated by every stream'''
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.finished = None
+        self.files = 0
+        self.files_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        self._lock = threading.Lock()
+
+    def add(self, sent: int = 0, skipped: int = 0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_skipped += skipped
+
+    @property
+    def seconds(self):
+        return (self.finished or self.clock()) - self.started
+
+    @property
+    def throughput(self):
+        '''MB/s actually sent'''
+        return self.bytes_sent / 1e6 / max(self.seconds, 1e-9)
+
+    def __repr__(self):
+        return (f'{self.files} file(s), {self.files_skipped} already up to date; sent {self.bytes_sent / 1e6:.1f}MB, '
+                f'skipped {self.bytes_skipped / 1e6:.1f}MB in {self.seconds:.1f}s ({self.throughput:.1f}MB/s)')
+
+class TransferEngine:
+    '''
+    Moves files and directories between this machine and an instance over `streams` parallel ssh connections.
+
+    Files are split into `chunk_size` chunks that are sent concurrently, so a single large file also uses every stream.
+    Before sending, chunk hashes are compared on both ends (sha256sum on the instance), so an interrupted or repeated
+    transfer only sends the chunks that differ and identical files are skipped.
+
+    host/user/key_filename: connection details, as used by `EC2Instance.create_ssh_connection`
+    compress: bool = zlib compress the ssh stream, worth it for text-like data on slow links only
+    '''
+    def __init__(self, host: str, user: str, key_filename: str, streams: int = STREAMS, chunk_size: int = CHUNK_SIZE, compress: bool = False, port: int = 22, progress=None):
+        '''progress: callable = called with the `TransferStats` after every chunk'''
+        self.host = host
+        self.user = user
+        self.key_filename = key_filename
+        self.streams = max(1, streams)
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.port = port
+        self.progress = progress
+        self._local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._control = None
+
+    def _connect(self):
+        import paramiko
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            self.host,
+            port=self.port,
+            username=self.user,
+            key_filename=os.path.expanduser(self.key_filename) if self.key_filename else None,
+            compress=self.compress,
+            allow_agent=False,
+            look_for_keys=False,
+        )
+        with self._clients_lock:
+            self._clients.append(client)
+        return client
+
+    def _sftp(self):
+        '''sftp session of the calling thread, each stream thread gets its own connection'''
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._local.sftp = self._connect().open_sftp()
+        return sftp
+
+    def _exec(self, command: str, stdin: bytes = None):
+        '''run a command on the instance over the control connection, returns stdout'''
+        if self._control is None:
+            self._control = self._connect()
+        channel_in, channel_out, channel_err = self._control.exec_command(command)
+        # drain both streams while stdin is written, a full stdout or stderr window would otherwise stall the command
+        streams = {}
+        readers = [threading.Thread(target=_read_into, args=(stream, streams, name), daemon=True) for name, stream in [('stdout', channel_out), ('stderr', channel_err)]]
+        for reader in readers:
+            reader.start()
+        if stdin is not None:
+            channel_in.write(stdin)
+        channel_in.channel.shutdown_write()
+        for reader in readers:
+            reader.join()
+        if channel_out.channel.recv_exit_status() != 0:
+            raise BaseException(f'`{command}` failed on {self.host}: {streams["stderr"].decode("utf-8").strip()}')
+        return streams['stdout'].decode('utf-8')
+
+    def close(self):
+        with self._clients_lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        self._control = None
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _remote_hashes(self, transfers: list):
+        '''sha256 per chunk of the remote side of `transfers`, one exec for all of them'''
+        lines = []
+        for transfer in transfers:
+            path = transfer.destination if transfer.direction == 'push' else transfer.source
+            for offset, length in transfer.compare:
+                lines.append(f'tail -c +{offset + 1} {shlex.quote(path)} | head -c {length} | sha256sum')
+        if not lines:
+            return []
+        output = self._exec('bash -s', stdin='\n'.join(lines).encode('utf-8') + b'\n')
+        return [line.split()[0] for line in output.splitlines() if line.strip()]
+
+    def _plan(self, transfers: list, direction: str):
+        '''work out which chunks of every file have to be sent, comparing hashes of what the destination already has'''
+        for transfer in transfers:
+            transfer.direction = direction
+            chunks = _chunks(transfer.size, self.chunk_size)
+            # chunks the destination may already hold in full
+            transfer.compare = [(offset, length) for offset, length in chunks if transfer.exists and length and offset + length <= transfer.destination_size]
+            transfer.chunks = chunks
+
+        remote_hashes = iter(self._remote_hashes(transfers))
+        for transfer in transfers:
+            if not transfer.compare:
+                continue
+            if direction == 'push':
+                source_hashes = _local_chunk_hashes(transfer.source, transfer.compare)
+                destination_hashes = [next(remote_hashes) for _ in transfer.compare]
+            else:
+                source_hashes = [next(remote_hashes) for _ in transfer.compare]
+                destination_hashes = _local_chunk_hashes(transfer.destination, transfer.compare)
+            same = set(chunk for chunk, source, destination in zip(transfer.compare, source_hashes, destination_hashes) if source == destination)
+            transfer.chunks = [chunk for chunk in transfer.chunks if chunk not in same]
+
+        return transfers
+
+    def _push_chunk(self, transfer: FileTransfer, offset: int, length: int, stats: TransferStats):
+        sftp = self._sftp()
+        with open(transfer.source, 'rb') as source, sftp.open(transfer.destination, 'r+b') as destination:
+            destination.set_pipelined(True)
+            source.seek(offset)
+            destination.seek(offset)
+            remaining = length
+            while remaining > 0:
+                block = source.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                destination.write(block)
+                remaining -= len(block)
+                stats.add(sent=len(block))
+
+    def _pull_chunk(self, transfer: FileTransfer, offset: int, length: int, stats: TransferStats):
+        sftp = self._sftp()
+        with sftp.open(transfer.source, 'rb') as source, open(transfer.destination, 'r+b') as destination:
+            source.seek(offset)
+            destination.seek(offset)
+            remaining = length
+            while remaining > 0:
+                if not source._prefetching:
+                    # prefetch queues reads from the read position up to an end offset, not a length; paramiko also stops
+                    # prefetching when the responses outrun its request thread, and reads one request at a time from there
+                    source.prefetch(offset + length)
+                block = source.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                destination.write(block)
+                remaining -= len(block)
+                stats.add(sent=len(block))
+
+    def _run(self, transfers: list, direction: str, stats: TransferStats):
+        '''send every pending chunk over the stream pool'''
+        jobs = []
+        for transfer in transfers:
+            stats.files += 1
+            pending = sum(length for _, length in transfer.chunks)
+            stats.add(skipped=transfer.size - pending)
+            if not transfer.chunks or (pending == 0 and transfer.exists and transfer.destination_size == transfer.size):
+                stats.files_skipped += 1
+                continue
+            for offset, length in transfer.chunks:
+                jobs.append((transfer, offset, length))
+
+        work = self._push_chunk if direction == 'push' else self._pull_chunk
+
+        def _job(job):
+            transfer, offset, length = job
+            with tracer.span(f'{direction}_chunk', 'transfer', target=transfer.source, offset=offset, bytes=length):
+                work(*job, stats)
+            if self.progress is not None:
+                self.progress(stats)
+
+        with tracer.span(direction, 'transfer', target=self.host, files=len(transfers), chunks=len(jobs)) as span:
+            with ThreadPoolExecutor(max_workers=self.streams) as pool:
+                # raises the first chunk error after every other chunk has finished
+                for _ in pool.map(_job, jobs):
+                    pass
+            span['bytes'] = stats.bytes_sent
+            span['bytes_skipped'] = stats.bytes_skipped
+
+        stats.finished = stats.clock()
+        return stats
+
+    def push(self, local_path: str, remote_path: str, include: list = None, exclude: list = None):
+        '''
+        copy a local file or directory (recursively) to `remote_path` on the instance, returns `TransferStats`
+
+        include/exclude: list = globs matched against paths relative to `local_path` and file names
+        '''
+        stats = TransferStats()
+        local_path = os.path.expanduser(local_path)
+        sftp = self._sftp()
+
+        if os.path.isdir(local_path):
+            transfers = []
+            for root, _, files in os.walk(local_path):
+                for name in sorted(files):
+                    source = os.path.join(root, name)
+                    relative = os.path.relpath(source, local_path).replace(os.sep, '/')
+                    if _matches(relative, include, exclude) and os.path.isfile(source):
+                        transfers.append(FileTransfer(source, posixpath.join(remote_path, relative), os.path.getsize(source)))
+        else:
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    # like cp/scp, a file pushed onto a directory goes inside it
+                    remote_path = posixpath.join(remote_path, os.path.basename(local_path))
+            except IOError:
+                pass
+            transfers = [FileTransfer(local_path, remote_path, os.path.getsize(local_path))]
+
+        remote_sizes = self._remote_sizes(sftp, remote_path, is_dir=os.path.isdir(local_path))
+        for transfer in transfers:
+            transfer.destination_size = remote_sizes.get(transfer.destination)
+            transfer.exists = transfer.destination_size is not None
+
+        self._plan(transfers, 'push')
+
+        # create directories and size destination files up front so chunks can be written at any offset
+        directories = sorted(set(posixpath.dirname(transfer.destination) for transfer in transfers if transfer.chunks))
+        if directories:
+            self._exec('xargs -0 mkdir -p', stdin=b'\0'.join(directory.encode('utf-8') for directory in directories))
+        for transfer in transfers:
+            if transfer.chunks and transfer.destination_size != transfer.size:
+                with sftp.open(transfer.destination, 'r+b' if transfer.exists else 'wb') as f:
+                    f.truncate(transfer.size)
+
+        return self._run(transfers, 'push', stats)
+
+    def _remote_sizes(self, sftp, remote_path: str, is_dir: bool):
+        '''remote path -> size of the regular files at or under `remote_path`, one listing per directory'''
+        sizes = {}
+        try:
+            attributes = sftp.stat(remote_path)
+        except IOError:
+            return sizes
+
+        if not stat.S_ISDIR(attributes.st_mode):
+            if not is_dir:
+                sizes[remote_path] = attributes.st_size
+            return sizes
+
+        pending = [remote_path]
+        while pending:
+            directory = pending.pop()
+            for entry in sftp.listdir_attr(directory):
+                path = posixpath.join(directory, entry.filename)
+                if stat.S_ISDIR(entry.st_mode):
+                    pending.append(path)
+                elif stat.S_ISREG(entry.st_mode):
+                    sizes[path] = entry.st_size
+        return sizes
+
+    def pull(self, remote_path: str, local_path: str, include: list = None, exclude: list = None):
+        '''
+        copy a remote file or directory (recursively) to `local_path`, returns `TransferStats`
+
+        include/exclude: list = globs matched against paths relative to `remote_path` and file names
+        '''
+        stats = TransferStats()
+        local_path = os.path.expanduser(local_path)
+        sftp = self._sftp()
+
+        remote_is_dir = stat.S_ISDIR(sftp.stat(remote_path).st_mode)
+        transfers = []
+        for path, size in sorted(self._remote_sizes(sftp, remote_path, is_dir=remote_is_dir).items()):
+            if remote_is_dir:
+                relative = posixpath.relpath(path, remote_path)
+                if not _matches(relative, include, exclude):
+                    continue
+                destination = os.path.join(local_path, *relative.split('/'))
+            else:
+                destination = os.path.join(local_path, posixpath.basename(path)) if os.path.isdir(local_path) else local_path
+            transfer = FileTransfer(path, destination, size)
+            transfer.exists = os.path.isfile(destination)
+            transfer.destination_size = os.path.getsize(destination) if transfer.exists else None
+            transfers.append(transfer)
+
+        self._plan(transfers, 'pull')
+
+        for transfer in transfers:
+            if transfer.chunks and transfer.destination_size != transfer.size:
+                os.makedirs(os.path.dirname(os.path.abspath(transfer.destination)), exist_ok=True)
+                with open(transfer.destination, 'r+b' if transfer.exists else 'wb') as f:
+                    f.truncate(transfer.size)
+
+        return self._run(transfers, 'pull', stats)
+
+def print_throughput(stats: TransferStats):
+    '''progress callback printing a single updating line'''
+    print(f'\r{stats.bytes_sent / 1e6:.1f}MB sent, {stats.throughput:.1f}MB/s', end='', flush=True)
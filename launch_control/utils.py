@@ -1,26 +1,26 @@
 #common utilities
-import yaml
 import subprocess
 import os
 from os import listdir
 from os.path import isfile, join
 from pathlib import Path
 
-from launch_control.vars import LAUNCH_CONTROL_CONFIG, LAUNCH_CONTROL_PROJECT_DIR, LAUNCH_CONTROL_INSTANCE_DIR
-
 def read_yaml(path: str):
+    import yaml
     with open(path) as f:
-        contents = yaml.load(f)
+        contents = yaml.safe_load(f)
 
     return contents
 
 def write_yaml(contents, path):
+    import yaml
     dir = os.path.dirname(os.path.abspath(path))
     Path(dir).mkdir(parents=True,exist_ok=True)
     with open(path,'w') as f:
         yaml.dump(contents,f)
 
 def update_yaml_file(file: str, contents: dict):
+    import yaml
 
     for key, value in contents.items():
         with open(file,'r') as yamlfile:
@@ -69,3 +69,11 @@ def detect_ssh_keys(path: str = None):
         ssh_keys = [join(path, f) for f in listdir(path) if isfile(join(path, f))]
 
     return ssh_keys
+
+def print_table(header: list, rows: list):
+    '''print rows as left aligned, space separated columns'''
+    rows = [[str(col) for col in row] for row in rows]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    print('  '.join(str(col).ljust(width) for col, width in zip(header, widths)))
+    for row in rows:
+        print('  '.join(col.ljust(width) for col, width in zip(row, widths)))
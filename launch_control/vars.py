@@ -17,7 +17,6 @@ def LAUNCH_CONTROL_DIR():
 
 def LAUNCH_CONTROL_INSTANCE_DIR():
 
-    home = str(Path.home())
     p = LAUNCH_CONTROL_DIR() + '/instances'
 
     return p
@@ -26,4 +25,10 @@ def LAUNCH_CONTROL_PROJECT_DIR(project_name: str):
 
     p = LAUNCH_CONTROL_INSTANCE_DIR() + '/' + project_name
 
-    return p
\ No newline at end of file
+    return p
+
+def LAUNCH_CONTROL_REGISTRY():
+
+    p = LAUNCH_CONTROL_DIR() + '/registry.db'
+
+    return p
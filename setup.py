@@ -14,5 +14,9 @@ setuptools.setup(
         'fabric',
         'PyNaCl'
     ],
-    python_requires='>=3.5'
+    extras_require={
+        # python -m benchmarks
+        'bench': ['moto[server]'],
+    },
+    python_requires='>=3.9'
 )
\ No newline at end of file